@@ -70,10 +70,7 @@ get_next_run() {
 }
 
 make_bs() {
-(
-  flock -w 10 8 || exit 1
-  make -C "$BOOTSTRAP_MAKEDIR" "$BS_ROOT"/"$1".rund
-) 8>"$BS_ROOT"/make.lck
+  "$SCRIPTS_DIR"/pandacap.py --run-id="$1" bootstrap --bs-root="$BS_ROOT" --bootstrap-makedir="$BOOTSTRAP_MAKEDIR"
 }
 #####################################################################
 
@@ -98,13 +95,15 @@ printf "%s:%s:%s\n" "$runid" "$SUPERVISOR_PROCESS_NAME" "$sshfwd" > "$RR_ROOT"/"
 cat > "$RR_ROOT"/"$runid"/cmd.txt <<EOF
 "$SCRIPTS_DIR"/pandacap.py -vvv \
   --run-id="$runid" \
+  --timing-file="$RR_ROOT"/"$runid"/timings.json \
+  --cpu-slot="$spn" \
   -d "$VM_IMAGE_DIR"/"$VM_IMAGE" \
   --port-fwd=ssh:10000 --port-fwd=sftp:10001 \
   --docker-image=pandacap --docker-port-fwd="$sshfwd:10000:*:tcp" \
   -M rr:"$RR_ROOT"/"$runid" \
   -M qcow:"$VM_IMAGE_DIR" \
   -M bootstrap:"$BS_ROOT"/"$runid"/docker \
-  rec --usbdisk="$BS_ROOT"/"$runid"/vm --panda="recctrl:session_rec=y,nrec=1,timeout=1800"
+  rec --usbdisk-dir="$BS_ROOT"/"$runid"/vm --panda="recctrl:session_rec=y,nrec=1,timeout=1800"
 EOF
 
 # Run command.
@@ -0,0 +1,256 @@
+#!/usr/bin/env python3
+
+import argparse
+import concurrent.futures
+import json
+import logging
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from pathlib import Path
+
+LOGLEVELS = [logging.WARNING, logging.INFO, logging.DEBUG]
+LOGFORMAT = '%(levelname)s: %(message)s'
+logging.basicConfig(format=LOGFORMAT, level=LOGLEVELS[0])
+
+#: The wrapper being benchmarked.
+PANDACAP = Path(__file__).resolve().parent / 'pandacap.py'
+
+#: Executables replaced by stubs, with the option setting their latency.
+STUBS = {
+    'panda-system-i386':    'panda-latency',
+    'panda-system-x86_64':  'panda-latency',
+    'panda-system-arm':     'panda-latency',
+    'docker':               'docker-latency',
+    'qemu-img':             'qemu-img-latency',
+    'mke2fs':               'mke2fs-latency',
+}
+
+#: Source of the stub executables. Each stub sleeps for its latency and
+#: creates the files the wrapper expects from the real tool.
+STUB_SOURCE = '''#!{python} -S
+import os, struct, sys, time
+LATENCY = {latency!r}
+name, argv = os.path.basename(sys.argv[0]), sys.argv[1:]
+time.sleep(LATENCY)
+if name == 'qemu-img' and argv[0] in ('create', 'rebase'):
+    if argv[0] == 'create':
+        opts = argv[argv.index('-o') + 1] if '-o' in argv else ''
+        opts = dict(o.split('=', 1) for o in opts.split(',') if '=' in o)
+        backing = opts.get('backing_file', '').encode()
+        image = argv[-2] if argv[-1][0].isdigit() else argv[-1]
+    else:
+        backing = argv[argv.index('-b') + 1].encode()
+        image = argv[-1]
+    with open(image, 'wb') as f:
+        f.write(b'QFI\\xfb' + struct.pack('>IQI', 3, 104 if backing else 0, len(backing)) + bytes(84) + backing)
+elif name == 'mke2fs':
+    with open(argv[-2], 'wb') as f:
+        f.truncate(32 << 20)
+elif name == 'docker' and argv[0] == 'run':
+    # run the panda stub in place of the container
+    panda = next(a for a in argv if a.startswith('panda-system-'))
+    os.execvp(panda, argv[argv.index(panda):])
+'''
+
+#: Wrapper arguments for each benchmark scenario.
+SCENARIOS = {
+    'host':     [],
+    'docker':   ['--docker-image=pandacap-bench'],
+    'pool':     [],
+}
+
+def make_stubs(bin_dir, args):
+    """ Creates the stub executables in bin_dir.
+    """
+    bin_dir.mkdir(parents=True, exist_ok=True)
+    for name, opt in STUBS.items():
+        stub = bin_dir / name
+        stub.write_text(STUB_SOURCE.format(python=sys.executable,
+                latency=getattr(args, opt.replace('-', '_'))))
+        stub.chmod(0o755)
+
+def make_workdir(work_dir):
+    """ Creates the base image and bootstrap directory used by the launches.
+    """
+    qcow_dir = work_dir / 'qcow'
+    qcow_dir.mkdir(parents=True)
+    base_disk = qcow_dir / 'base.qcow2'
+    subprocess.run(['qemu-img', 'create', '-f', 'qcow2', str(base_disk), '8G'], check=True)
+    bs_dir = work_dir / 'bs'
+    (bs_dir / 'files').mkdir(parents=True)
+    (bs_dir / 'files' / 'ssh.txt').write_text('bench\n')
+    (work_dir / 'rr').mkdir()
+    return base_disk, bs_dir
+
+def launch(argv, env):
+    """ Runs a single launch of the wrapper.
+        Returns the exit code, the wall time and the peak RSS of the wrapper.
+    """
+    t_start = time.monotonic()
+    proc = subprocess.Popen(argv, env=env, stdin=subprocess.DEVNULL,
+            stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    _, status, rusage = os.wait4(proc.pid, 0)
+    # same as os.waitstatus_to_exitcode, which needs Python 3.9
+    proc.returncode = -os.WTERMSIG(status) if os.WIFSIGNALED(status) else os.WEXITSTATUS(status)
+    return proc.returncode, time.monotonic() - t_start, rusage.ru_maxrss << 10
+
+def percentile(values, p):
+    """ Returns the p-th percentile of values, using the nearest rank.
+    """
+    values = sorted(values)
+    return values[max(0, min(len(values) - 1, round(p / 100 * len(values) + 0.5) - 1))]
+
+def bench_level(args, scenario, concurrency, work_dir, base_disk, bs_dir, env):
+    """ Runs args.launches launches of scenario with the given concurrency.
+        Returns a dict with the results.
+    """
+    if scenario == 'pool':
+        subprocess.run([sys.executable, str(PANDACAP), '-d', str(base_disk), 'pool', '--once',
+                '--pool-size=%d' % args.launches], env=env, check=True)
+    runs = []
+    lock = threading.Lock()
+    seq = iter(range(args.launches))
+    def worker():
+        while True:
+            with lock:
+                n = next(seq, None)
+            if n is None:
+                return
+            run_id = 'bench.%s.%d.%04d' % (scenario, concurrency, n)
+            timing_file = work_dir / 'rr' / ('%s.json' % run_id)
+            argv = [sys.executable, str(PANDACAP), '-d', str(base_disk), '--run-id=%s' % run_id,
+                    '--timing-file=%s' % timing_file, *SCENARIOS[scenario], *args.wrapper_arg,
+                    'rec', '--usbdisk-dir=%s' % bs_dir, '--delete-overlay']
+            rc, wall, rss = launch(argv, env)
+            try:
+                phases = json.loads(timing_file.read_text())['phases']
+            except (OSError, ValueError, KeyError):
+                phases = {}
+            phases['wall'] = wall
+            with lock:
+                runs.append({'rc': rc, 'phases': phases, 'rss': rss})
+
+    t_start = time.monotonic()
+    with concurrent.futures.ThreadPoolExecutor(max_workers=concurrency) as executor:
+        for f in [executor.submit(worker) for _ in range(concurrency)]:
+            f.result()
+    elapsed = time.monotonic() - t_start
+
+    phase_names = sorted({p for r in runs for p in r['phases']})
+    phases = {}
+    for p in phase_names:
+        values = [r['phases'][p] for r in runs if r['phases'].get(p) is not None]
+        phases[p] = {'p50': percentile(values, 50), 'p99': percentile(values, 99)}
+    return {
+        'scenario': scenario,
+        'concurrency': concurrency,
+        'launches': len(runs),
+        'failed': sum(r['rc'] != 0 for r in runs),
+        'launches_per_s': len(runs) / elapsed,
+        'phases': phases,
+        'peak_rss': max(r['rss'] for r in runs),
+    }
+
+def print_result(result):
+    """ Prints the results of a benchmark level as a table.
+    """
+    print('%s, concurrency %d: %.1f launches/s, %d/%d failed, peak RSS %.1f MiB' % (
+        result['scenario'], result['concurrency'], result['launches_per_s'],
+        result['failed'], result['launches'], result['peak_rss'] / (1 << 20)))
+    for p, v in result['phases'].items():
+        print('  %-16s p50 %9.1fms  p99 %9.1fms' % (p, v['p50'] * 1e3, v['p99'] * 1e3))
+
+def check_regression(results, baseline, max_regression):
+    """ Compares the launch throughput of results with baseline.
+        Returns a list of the levels that are slower than allowed.
+    """
+    base = {(r['scenario'], r['concurrency']): r['launches_per_s'] for r in baseline}
+    slower = []
+    for r in results:
+        b = base.get((r['scenario'], r['concurrency']))
+        if b is not None and r['launches_per_s'] < b * (1 - max_regression / 100):
+            slower.append('%s/%d: %.1f < %.1f launches/s' % (
+                r['scenario'], r['concurrency'], r['launches_per_s'], b))
+    return slower
+
+def bench_parse_args(argv):
+    """ Parses a list of command line arguments.
+    """
+    parser = argparse.ArgumentParser(description='Launch throughput benchmark for the PANDA wrapper',
+        formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+    parser.add_argument('-v', '--verbose', action='count', default=0,
+        help='increase verbosity')
+    parser.add_argument('--scenario', action='append', choices=list(SCENARIOS),
+        help='scenario to benchmark – can be repeated, defaults to all')
+    parser.add_argument('--concurrency', action='store', default='1,2,4,8',
+        help='comma-separated list of concurrent launch levels')
+    parser.add_argument('--launches', action='store', type=int, default=32,
+        help='number of launches per concurrency level')
+    parser.add_argument('--panda-latency', action='store', type=float, default=0.05,
+        help='seconds each PANDA stub runs for')
+    parser.add_argument('--docker-latency', action='store', type=float, default=0.2,
+        help='seconds the docker stub takes to start a container')
+    parser.add_argument('--qemu-img-latency', action='store', type=float, default=0.05,
+        help='seconds the qemu-img stub takes')
+    parser.add_argument('--mke2fs-latency', action='store', type=float, default=0.05,
+        help='seconds the mke2fs stub takes')
+    parser.add_argument('--wrapper-arg', action='append', default=[],
+        help='extra global argument for the wrapper – can be repeated')
+    parser.add_argument('--json', action='store', type=Path, default=None,
+        help='write the results to this file')
+    parser.add_argument('--baseline', action='store', type=Path, default=None,
+        help='results of a previous run to compare launch throughput with')
+    parser.add_argument('--max-regression', action='store', type=float, default=10.0,
+        help='percentage of launch throughput that may be lost against the baseline')
+    parser.add_argument('--keep', action='store_true',
+        help='keep the work directory')
+    args = parser.parse_args(argv)
+    logging.getLogger().setLevel(LOGLEVELS[min(args.verbose, len(LOGLEVELS)-1)])
+    if args.scenario is None:
+        args.scenario = list(SCENARIOS)
+    args.concurrency = [int(c) for c in args.concurrency.split(',')]
+    return args
+
+def bench_run(args):
+    """ Runs the benchmark for all scenarios and concurrency levels.
+    """
+    work_dir = Path(tempfile.mkdtemp(prefix='pandacap-bench.'))
+    logging.info('Using work directory "%s".', work_dir)
+    env = dict(os.environ, PATH='%s:%s' % (work_dir / 'bin', os.environ.get('PATH', '')), DISPLAY=':0')
+    os.environ['PATH'] = env['PATH']
+    results = []
+    try:
+        make_stubs(work_dir / 'bin', args)
+        base_disk, bs_dir = make_workdir(work_dir)
+        for scenario in args.scenario:
+            for concurrency in args.concurrency:
+                logging.info('Running %d launches of %s with concurrency %d.', args.launches, scenario, concurrency)
+                results.append(bench_level(args, scenario, concurrency, work_dir, base_disk, bs_dir, env))
+                print_result(results[-1])
+    finally:
+        if not args.keep:
+            shutil.rmtree(work_dir, ignore_errors=True)
+
+    if args.json is not None:
+        args.json.write_text(json.dumps(results, indent=2) + '\n')
+    if any(r['failed'] for r in results):
+        logging.error('Some launches failed. Rerun with --keep and check the timing files.')
+        return 1
+    if args.baseline is not None:
+        slower = check_regression(results, json.loads(args.baseline.read_text()), args.max_regression)
+        for s in slower:
+            logging.error('Launch throughput regressed: %s', s)
+        if slower:
+            return 1
+    return 0
+
+if __name__ == '__main__':
+    args = bench_parse_args(sys.argv[1:])
+    sys.exit(bench_run(args))
+
+# vim: set et ts=4 sts=4 sw=4 ai ft=python :#
@@ -1,15 +1,33 @@
 #!/usr/bin/env python3
 
 import argparse
-import collections
+import asyncio
+import base64
+import bisect
+import collections.abc
+import concurrent.futures
+import contextlib
+import copy
+import fcntl
+import functools
+import hashlib
 import itertools
+import json
+import mmap
 import logging
 import os
+import re
 import socket
+import sqlite3
 import subprocess
 import sys
 import shlex
 import shutil
+import signal
+import struct
+import threading
+import time
+import zlib
 from datetime import datetime
 from pathlib import Path
 
@@ -24,8 +42,13 @@ PANDA_TARGETS = ('i386', 'x86_64', 'arm', 'ppc')
 CMD_FORMATS = {
     'panda-bin':        'panda-system-{target}',
     'panda':            '-panda {panda}',
+    'replay':           '-replay {replay}',
+    'qmp':              '-qmp unix:{qmp_socket},server,nowait',
+    'pandalog':         '-pandalog {pandalog}',
+    'loadvm':           '-loadvm {loadvm}',
     'mem':              '-m {mem:d}',
     'disk':             '-hda {disk}',
+    'drive':            '-drive file={disk},if=ide,index=0,media=disk,{drive_opts}',
     'usbdisk':          '-usbdevice disk:format=raw:{usbdisk}',
     'nic':              '{nic}',
     'net-cfg':          '-netdev user,id=unet0,{net_fwd_list}',
@@ -37,17 +60,248 @@ CMD_FORMATS = {
     'docker-mnt':       '--mount type={type},src={src},dst={dst}',
     'docker-net':       '--net={docker_net}',
     'docker-fwd':       '-p {haddr}:{from:d}:{to:d}/{proto}',
+    'docker-cpuset':    '--cpuset-cpus={cpus} --cpuset-mems={mems}',
+    'taskset':          'taskset -c {cpus}',
     'ts-fmt':           '%Y%m%d-%H%M%S',
+    'rr-compress':      'zstd -q -c -T{threads:d} -{level:d}',
+    'rr-decompress':    'zstd -q -d -c {archive}',
+}
+
+#: Formats for the names of pre-derived disk images in the warm pool.
+POOL_FORMATS = {
+    'ready':            '{stem}.pool-{token}{suffix}',
+    'tmp':              '.{stem}.pool-{token}.tmp',
+}
+
+#: Age (in seconds) after which an incomplete pool image is considered orphaned.
+POOL_TMP_MAXAGE = 600
+
+#: ioctl request for cloning a file on filesystems that support reflinks.
+FICLONE = 0x40049409
+
+#: Names of USB disk files that differ between runs, i.e. the ssh keys of
+#: bootstrap directories. They are left out of cached images and written
+#: into the clones of the cached images instead.
+USBDISK_RUN_FILES = ('id_ed25519', 'id_ed25519.pub')
+
+#: Suffixes of the files comprising a PANDA recording.
+RR_SUFFIXES = ('-rr-snp', '-rr-nondet.log')
+
+#: Suffix of compressed recording files.
+RR_ARCHIVE_SUFFIX = '.zst'
+
+#: Seconds a recording must be left untouched before rec --compress compresses it.
+RR_COMPRESS_MIN_AGE = 30
+
+#: Suffix of the manifests of snapshots moved to the dedup store.
+RR_DEDUP_SUFFIX = '.dedup'
+
+#: Layout of the dedup store.
+DEDUP_FORMATS = {
+    'chunk':            'chunks/{digest:.2}/{digest}',
+    'db':               'store.sqlite',
+}
+
+#: Content-defined chunking parameters of the dedup store: rolling window
+#: size, boundary mask (average chunk size), and minimum/maximum chunk size.
+#: Changing them makes new chunks incompatible with the stored ones.
+DEDUP_CHUNKING = {'window': 48, 'mask': (1 << 16) - 1, 'min': 1 << 14, 'max': 1 << 18}
+
+#: Byte values for the rolling window sum of the dedup chunking.
+DEDUP_GEAR = tuple(int.from_bytes(hashlib.sha256(bytes([b])).digest()[:4], 'little') for b in range(256))
+
+#: Schema of the dedup store chunk index.
+DEDUP_SCHEMA = '''
+CREATE TABLE IF NOT EXISTS chunks (
+    digest          TEXT PRIMARY KEY,
+    size            INTEGER NOT NULL,
+    stored          INTEGER NOT NULL,
+    refs            INTEGER NOT NULL
+);
+'''
+
+#: Layout of the replay result cache. Each entry holds the outputs of a replay.
+REPLCACHE_FORMATS = {
+    'entry':            'entries/{key:.2}/{key}',
+    'db':               'cache.sqlite',
+}
+
+#: Schema of the replay result cache index. The content hashes of recording
+#: files are memoized, keyed on their path and stat information.
+REPLCACHE_SCHEMA = '''
+CREATE TABLE IF NOT EXISTS results (
+    key             TEXT PRIMARY KEY,
+    rr              TEXT NOT NULL,
+    rr_hash         TEXT NOT NULL,
+    panda           TEXT,
+    os              TEXT,
+    binary          TEXT NOT NULL,
+    size            INTEGER NOT NULL,
+    created         REAL NOT NULL,
+    used            REAL NOT NULL
+);
+CREATE TABLE IF NOT EXISTS hashes (
+    path            TEXT PRIMARY KEY,
+    stat            TEXT NOT NULL,
+    sha256          TEXT NOT NULL
+);
+'''
+
+#: Formats for the names of the segments of a split recording.
+SPLIT_FORMATS = {
+    'segment':          '{name}.seg{index:03d}',
+    'cut-log':          '{name}.seg{index:03d}.cut.log',
+    'plog':             '{name}.seg{index:03d}.plog',
+    'log':              '{name}.seg{index:03d}.log',
+    'scissors':         'scissors:start={start:d},end={end:d},name={segment}',
+}
+
+#: Pandalog header: version, directory offset, chunk size (C struct layout).
+PLOG_HEADER = struct.Struct('<I4xQI4x')
+
+#: Pandalog directory entry: first instruction, file offset, number of entries.
+PLOG_DIR_ENTRY = struct.Struct('<QQQ')
+
+#: Protobuf field numbers of the program counter and instruction count in pandalog entries.
+PLOG_PC_FIELD = 1
+PLOG_INSTR_FIELD = 2
+
+#: QMP commands for the ctl mode actions.
+#: Commands without a QMP equivalent are passed through the human monitor.
+QMP_ACTIONS = {
+    'status':           {'execute': 'query-status'},
+    'begin-record':     {'hmp': 'begin_record {name}'},
+    'end-record':       {'hmp': 'end_record'},
+    'snapshot':         {'hmp': 'savevm {name}'},
+    'quit':             {'execute': 'quit'},
+    'stop':             {'execute': 'stop'},
+    'cont':             {'execute': 'cont'},
+}
+
+#: Name of the internal snapshot of pre-booted resume images.
+RESUME_SNAPSHOT = 'pandacap-booted'
+
+#: Formats for the names of the resume image of a base image and its companion files.
+RESUME_FORMATS = {
+    'image':            '{stem}.resume{suffix}',
+    'tmp':              '.{stem}.resume.tmp{suffix}',
+    'meta':             '{stem}.resume.json',
+    'qmp':              '.{stem}.resume.qmp',
+}
+
+#: VM options that must match between creating and using a resume image.
+RESUME_VM_OPTS = ('mem', 'target', 'nic')
+
+#: Schema of the run catalog.
+CATALOG_SCHEMA = '''
+CREATE TABLE IF NOT EXISTS runs (
+    run_id          TEXT PRIMARY KEY,
+    path            TEXT NOT NULL,
+    mtime_ns        INTEGER NOT NULL,
+    complete        INTEGER NOT NULL,
+    process         TEXT,
+    port            INTEGER,
+    cmd             TEXT,
+    nrec            INTEGER,
+    snp_size        INTEGER,
+    nondet_size     INTEGER,
+    compressed      INTEGER,
+    start_time      REAL,
+    end_time        REAL,
+    replay_status   TEXT,
+    replay_time     REAL
+);
+CREATE INDEX IF NOT EXISTS runs_process ON runs (process);
+CREATE INDEX IF NOT EXISTS runs_start_time ON runs (start_time);
+CREATE INDEX IF NOT EXISTS runs_replay_status ON runs (replay_status);
+'''
+
+#: Modes that can be dispatched to workers through the job queue.
+QUEUE_JOB_MODES = ('repl', 'compress')
+
+#: Schema of the job queue. Jobs are leased by workers, which extend their
+#: lease while the job runs. Jobs with expired leases are picked up again.
+QUEUE_SCHEMA = '''
+CREATE TABLE IF NOT EXISTS jobs (
+    id              INTEGER PRIMARY KEY,
+    mode            TEXT NOT NULL,
+    rr              TEXT NOT NULL,
+    argv            TEXT NOT NULL,
+    cwd             TEXT NOT NULL,
+    state           TEXT NOT NULL DEFAULT 'pending',
+    attempts        INTEGER NOT NULL DEFAULT 0,
+    worker          TEXT,
+    lease_until     REAL,
+    not_before      REAL NOT NULL DEFAULT 0,
+    created         REAL NOT NULL,
+    finished        REAL,
+    exit_code       INTEGER,
+    error           TEXT,
+    UNIQUE (mode, rr)
+);
+CREATE INDEX IF NOT EXISTS jobs_state ON jobs (state, not_before);
+'''
+
+#: Seconds after which runs without a timing file are considered complete.
+CATALOG_STALE_AGE = 3600
+
+#: Location of the NUMA node information in sysfs.
+SYSFS_NUMA_NODES = Path('/sys/devices/system/node')
+
+#: Mapping of fleet instance slots to forwarded ssh ports.
+FLEET_PROCESS2PORT = {0: 22, 1: 2200, 2: 2222}
+
+#: Port offset for fleet instance slots not in FLEET_PROCESS2PORT.
+FLEET_UNMAPPED_OFFSET = 47000
+
+#: Formats for fleet run-ids and instance names.
+FLEET_FORMATS = {
+    'run-id':           '{group}.{runsn:04d}',
+    'instance':         '{group}_{slot:02d}',
+    'counter':          '{group}.count',
+}
+
+#: Upper bounds of the buckets of the launch latency histograms, in seconds.
+METRICS_LATENCY_BUCKETS = (0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300)
+
+#: States of fleet instances reported by the metrics endpoint.
+METRICS_STATES = ('booting', 'idle', 'recording')
+
+#: Runtime bootstrap targets and the prefixes of their scripts in the bootstrap makedir.
+BOOTSTRAP_TARGETS = {'docker': 'docker_', 'vm': 'vm_'}
+
+#: Formats for the files of the bootstrap directories and the ssh key pool.
+BOOTSTRAP_FORMATS = {
+    'key':              'id_ed25519',
+    'vars':             '../../Makefile.vars',
+    'local-vars':       '../../Makefile.local.vars',
+    'keypool':          '.keypool',
+    'pool-key':         'key-{token}',
+    'tmp':              '.{run_id}.tmp',
 }
 
 #: Shorthands for docker mountpoints.
 DOCKER_MNT_ALIAS = {
     'bootstrap':    {'type':'bind', 'dst': '{docker_panda_root}/share/bootstrap'},
     'qcow':         {'type':'bind', 'dst': '{docker_panda_root}/share/qcow'},
+    'overlay':      {'type':'bind', 'dst': '{docker_panda_root}/share/overlay'},
     'rr':           {'type':'bind', 'dst': '{docker_panda_root}/share/rr'},
     'x11':          {'type':'bind', 'dst': '/tmp/.X11-unix', 'src': '/tmp/.X11-unix'},
 }
 
+#: Formats for the names and labels of pooled docker containers.
+DOCKER_POOL_FORMATS = {
+    'name':             '{docker_image}-pool-{token}',
+    'label':            'pandacap.pool',
+    'mounts-label':     'pandacap.pool.mounts',
+}
+
+#: Per-run docker mount targets and the arguments holding the roots of their sources.
+DOCKER_POOL_ROOTS = {
+    'bootstrap':    'bs_root',
+    'rr':           'rr_root',
+}
+
 #: Shorthands for port forwards.
 PORT_FWD_ALIAS = {
     'ssh':    { 'proto': 'tcp', 'scope': '*', 'from': 22 },
@@ -73,13 +327,159 @@ def split_and_pad(s, sep, nsplit, pad=None):
     l = s.split(sep, nsplit)
     return itertools.chain(l, itertools.repeat(None, nsplit+1-len(l)))
 
+@contextlib.contextmanager
+def timed(args, phase):
+    """ Context manager for recording the duration of a launch phase in args.
+    """
+    t_start = time.monotonic()
+    try:
+        yield
+    finally:
+        args.phase_times[phase] = time.monotonic() - t_start
+
+def timing_write(args, **extra):
+    """ Writes the recorded phase durations of args as a JSON record.
+        Nothing is written if no timing file has been specified.
+    """
+    if args.timing_file is None:
+        return
+    record = {
+        'run_id': args.run_id,
+        'mode': args.mode,
+        'start': args.start_time,
+        'phases': args.phase_times,
+        **extra,
+    }
+    tmp = args.timing_file.with_name('.%s.tmp' % args.timing_file.name)
+    tmp.write_text(json.dumps(record, indent=2) + '\n')
+    os.replace(tmp, args.timing_file)
+    logging.debug('Wrote launch timings to "%s".', args.timing_file)
+
+def probe_port(haddr, port, timeout, stop=None, interval=0.5):
+    """ Waits until something is serving on the specified host port.
+        User-mode networking in QEMU and the docker proxy accept connections
+        before the guest service is up, so the service is only considered
+        ready after it sends some data (e.g. the ssh banner).
+        Returns the time it took, or None on timeout or when stop is set.
+    """
+    t_start = time.monotonic()
+    while time.monotonic() - t_start < timeout:
+        if stop is not None and stop.is_set():
+            return None
+        try:
+            with socket.create_connection((haddr or '127.0.0.1', port), timeout=interval * 4) as sock:
+                if sock.recv(1):
+                    return time.monotonic() - t_start
+        except OSError:
+            pass
+        time.sleep(interval)
+    return None
+
+def probe_target(args):
+    """ Returns the host address and port to probe for the readiness of a run.
+    """
+    if args.docker_image is not None and args.docker_port_fwd:
+        fwd = args.docker_port_fwd[0]
+        return fwd['haddr'], fwd['from']
+    elif args.docker_image is None and args.port_fwd:
+        fwd = args.port_fwd[0]
+        return fwd['haddr'], fwd['to']
+    return None
+
+def parse_cpulist(cpulist):
+    """ Parses a cpu list string (e.g. 0-3,8,10-11) to a list of cpu ids.
+    """
+    cpus = []
+    for r in filter(None, cpulist.strip().split(',')):
+        first, _, last = r.partition('-')
+        cpus.extend(range(int(first), int(last or first) + 1))
+    return cpus
+
+def format_cpulist(cpus):
+    """ Formats a list of cpu ids as a cpu list string.
+    """
+    ranges = []
+    for cpu in sorted(cpus):
+        if ranges and ranges[-1][1] == cpu - 1:
+            ranges[-1][1] = cpu
+        else:
+            ranges.append([cpu, cpu])
+    return ','.join(str(a) if a == b else '%d-%d' % (a, b) for a, b in ranges)
+
+def cpuset_for_slot(slot, ncpus):
+    """ Returns the dedicated cpu set and NUMA node for an instance slot.
+        Sets of ncpus cpus are carved out of each NUMA node, so that no set
+        spans nodes. Slots wrap around when they outnumber the sets.
+    """
+    available = os.sched_getaffinity(0)
+    nodes = {}
+    for node_dir in SYSFS_NUMA_NODES.glob('node[0-9]*'):
+        with contextlib.suppress(OSError):
+            node_cpus = [c for c in parse_cpulist((node_dir / 'cpulist').read_text()) if c in available]
+            nodes[int(node_dir.name[4:])] = node_cpus
+    if not nodes:
+        nodes = {0: sorted(available)}
+    sets = [(node_cpus[i:i + ncpus], node)
+            for node, node_cpus in sorted(nodes.items())
+            for i in range(0, len(node_cpus) - ncpus + 1, ncpus)]
+    if not sets:
+        raise ValueError('No NUMA node has %d available cpus.' % ncpus)
+    cpus, node = sets[slot % len(sets)]
+    return format_cpulist(cpus), str(node)
+
+def args_rr_dir(args):
+    """ Returns the host directory where the recordings of a run are written.
+        For docker runs, this is the source of the rr mount.
+    """
+    for tgt, _, src in (m.partition(':') for m in args.docker_mount):
+        if tgt == 'rr':
+            return Path(src)
+    return Path('.')
+
+def admission_check(args, rr_dir):
+    """ Checks whether the host has enough headroom to launch a new instance.
+        Returns a list of reasons for refusing the launch, which is empty if
+        the launch is admitted.
+    """
+    reasons = []
+    if args.min_free_mem is not None:
+        meminfo = dict(l.split(':', 1) for l in Path('/proc/meminfo').read_text().splitlines())
+        avail = int(meminfo['MemAvailable'].split()[0]) >> 10
+        need = args.mem + args.min_free_mem
+        if avail < need:
+            reasons.append('available memory %dMiB < %dMiB' % (avail, need))
+    if args.min_free_disk is not None:
+        free = shutil.disk_usage(rr_dir).free >> 20
+        if free < args.min_free_disk:
+            reasons.append('free disk on "%s" %dMiB < %dMiB' % (rr_dir, free, args.min_free_disk))
+    if args.max_load is not None:
+        load = os.getloadavg()[0] / len(os.sched_getaffinity(0))
+        if load > args.max_load:
+            reasons.append('load per cpu %.2f > %.2f' % (load, args.max_load))
+    return reasons
+
+def admission_wait(args, rr_dir, interval=5.0):
+    """ Delays the launch until it is admitted or args.admission_wait expires.
+        Returns True if the launch was admitted.
+    """
+    t_start = time.monotonic()
+    reasons = admission_check(args, rr_dir)
+    while reasons:
+        if time.monotonic() - t_start >= args.admission_wait:
+            logging.error('Launch refused: %s.', ', '.join(reasons))
+            return False
+        logging.warning('Launch delayed: %s.', ', '.join(reasons))
+        time.sleep(interval)
+        reasons = admission_check(args, rr_dir)
+    return True
+
 def arg_format(n, args={}, formats=CMD_FORMATS, split=True, **kwargs):
     """ Use args to apply formating one of the pre-defined formats.
     """
     if n not in formats:
         return ''
 
-    if isinstance(args, collections.Mapping):
+    if isinstance(args, collections.abc.Mapping):
         arg_s = formats[n].format(**args, **kwargs)
     else:
         arg_s = formats[n].format(**vars(args), **kwargs)
@@ -129,10 +529,16 @@ def process_common_args(args):
     # add hostname to args
     if 'hostname' not in args:
         args.addattr('hostname', socket.gethostname())
-    # add qemu arguments
-    for arg_name in ['mem', 'disk', 'usbdisk', 'nic', 'panda']:
+    # add qemu arguments - use -drive if the disk needs tuning
+    drive_opts = qemu_drive_opts(args)
+    for arg_name in ['mem', 'disk', 'usbdisk', 'nic', 'panda', 'replay', 'pandalog', 'loadvm']:
         if getattr(args, arg_name, None) is None:
             continue
+        elif arg_name == 'disk' and drive_opts:
+            cmd.extend(arg_format('drive', args, drive_opts=drive_opts))
+        elif arg_name == 'usbdisk' and getattr(args, 'loadvm', None) is not None:
+            # attached through qmp after the snapshot is resumed
+            continue
         else:
             cmd.extend(arg_format(arg_name, args))
     # add qemu port forwards
@@ -143,8 +549,12 @@ def process_common_args(args):
         port_fwd.append(arg_format('net-fwd', fwd, split=False))
     if port_fwd:
         cmd.extend(arg_format('net-cfg', net_fwd_list=','.join(port_fwd)))
-    # add qemu monitor
-    cmd.extend(['-monitor', 'stdio'])
+    # add qemu monitor - with qmp, the human monitor is not needed
+    if args.qmp is not None:
+        if 'qmp_socket' not in args:
+            args.addattr('qmp_socket', args.qmp)
+        cmd.extend(arg_format('qmp', args))
+    cmd.extend(['-monitor', getattr(args, 'monitor', 'stdio' if args.qmp is None else 'none')])
     return cmd
 
 def process_rec_args(args):
@@ -153,9 +563,24 @@ def process_rec_args(args):
     cmd = []
     os.environ['DISPLAY'] = args.display
 
-    # create derived disk
-    if not args.no_derive:
-        derived_disk = qemu_derive_disk(args.disk, args.run_id)
+    # create derived disk - resumed runs use a copy of the resume image
+    if args.resume:
+        with timed(args, 'derive-disk'):
+            vm_opts = {k: getattr(args, k) for k in RESUME_VM_OPTS}
+            derived_disk = qemu_resume_disk(args.disk, args.run_id, vm_opts, args.overlay_dir)
+        if derived_disk is None:
+            logging.error("Failed to create resumable image from %s.", args.disk)
+            sys.exit(1)
+        args.addattr('base_disk', args.disk)
+        args.addattr('derived_disk', derived_disk)
+        args.addattr('loadvm', RESUME_SNAPSHOT)
+        args.disk = args.derived_disk
+        cmd.append('-usb')
+    elif not args.no_derive:
+        with timed(args, 'derive-disk'):
+            derived_disk = qemu_pool_claim(args.disk, args.run_id, args.overlay_dir)
+            if derived_disk is None:
+                derived_disk = qemu_derive_disk(args.disk, args.run_id, qemu_qcow_opts(args), args.overlay_dir)
         if derived_disk is None:
             logging.error("Failed to create derived image from %s.", args.disk)
             sys.exit(1)
@@ -164,24 +589,67 @@ def process_rec_args(args):
         args.disk = args.derived_disk
 
     # create usb disk
-    usbdisk = qemu_make_usbdisk(args.usbdisk_dir, args.disk.parent, args.run_id, fslabel='bootstrap')
+    with timed(args, 'usbdisk'):
+        usbdisk = qemu_make_usbdisk(args.usbdisk_dir, args.disk.parent, args.run_id, fslabel='bootstrap',
+                cache_dir=args.usbdisk_cache, cache_size=args.usbdisk_cache_size << 20)
     if args.usbdisk_dir is not None and usbdisk is None:
         logging.error('Failed to create USB disk image from "%s".', args.usbdisk_dir)
         sys.exit(1)
     args.addattr('usbdisk', usbdisk)
+    args.addattr('usbdisk_image', usbdisk)
+    if args.resume and usbdisk is not None and args.qmp is None:
+        logging.error('Resuming with a USB disk requires --qmp to attach it.')
+        sys.exit(1)
+
+    return cmd
+
+def process_snapshot_args(args):
+    """ Process resume snapshot-related arguments.
+        The VM is booted from a temporary overlay of the base image, which
+        becomes the resume image once the snapshot has been saved.
+    """
+    cmd = ['-usb', '-display', 'none']
+    os.environ['DISPLAY'] = args.display
 
+    base_disk = Path(args.disk)
+    if not base_disk.is_file():
+        logging.error('Base image "%s" does not exist.', base_disk)
+        sys.exit(1)
+    tmp = qemu_resume_name(base_disk, 'tmp')
+    with contextlib.suppress(FileNotFoundError):
+        tmp.unlink()
+    if qemu_create_overlay(base_disk, tmp, qemu_qcow_opts(args)) != 0:
+        logging.error('Failed to create image "%s".', tmp)
+        sys.exit(1)
+    args.addattr('base_disk', base_disk)
+    args.disk = tmp
+    if args.qmp is None:
+        args.qmp = qemu_resume_name(base_disk, 'qmp')
     return cmd
 
 def process_repl_args(args):
     """ Process PANDA replay-related arguments.
+        args.rr is expected to hold the path prefix of a single recording.
+        Batches of recordings are handled by prov2r_run_repl().
     """
-    assert False, 'Not implemented yet.'
     cmd = []
+    os.environ['DISPLAY'] = args.display
+
+    # sanity checks
+    rr = Path(args.rr)
+    for rr_file, rr_archive in rr_files(rr):
+        manifest = rr_file.with_name(rr_file.name + RR_DEDUP_SUFFIX)
+        if not any(f.is_file() for f in (rr_file, rr_archive, manifest)):
+            logging.error('Recording file "%s" does not exist.', rr_file)
+            sys.exit(1)
+
+    # replay is not interactive - don't tie the monitor to stdio
+    args.addattr('replay', rr)
+    if args.plog is not None:
+        args.addattr('pandalog', Path(args.plog.format(rr=rr)))
+    args.addattr('monitor', 'none')
     cmd.extend(['-display', 'none'])
     return cmd
-    # p_test "${panda_rr}-rr-snp" f "trace memory snapshot"
-    # p_test "${panda_rr}-rr-nondet.log" f "trace nondet log"
-    # -pandalog ${opts[-plog]} -replay $panda_rr
 
 def process_maint_args(args):
     """ Process maintenance-related arguments.
@@ -218,7 +686,7 @@ def process_docker_args(args):
     args.addattr('hostname', hostname)
 
     # initialize docker mount info
-    mounts = dict(DOCKER_MNT_ALIAS)
+    mounts = {tgt: dict(mnt_args) for tgt, mnt_args in DOCKER_MNT_ALIAS.items()}
     for tgt, mnt_args in mounts.items():
         if 'src' in mnt_args:
             # resolve default mount source path
@@ -238,12 +706,74 @@ def process_docker_args(args):
     # set automatically derived mount source paths
     if 'src' not in mounts['qcow']:
         logging.debug('Deriving source path for mount target "qcow".')
-        mounts['qcow']['src'] = Path(args.disk).parent.resolve()
+        mounts['qcow']['src'] = Path(getattr(args, 'base_disk', args.disk)).parent.resolve()
+
+    derived_disk = getattr(args, 'derived_disk', None)
+    rebase_derived = derived_disk is not None and derived_disk.parent.resolve() != mounts['qcow']['src']
+    if rebase_derived:
+        if 'src' not in mounts['overlay']:
+            logging.debug('Deriving source path for mount target "overlay".')
+            mounts['overlay']['src'] = derived_disk.parent.resolve()
+    elif 'src' not in mounts['overlay']:
+        del mounts['overlay']
+
+    if getattr(args, 'replay', None) is not None and 'src' not in mounts['rr']:
+        logging.debug('Deriving source path for mount target "rr".')
+        mounts['rr']['src'] = Path(args.replay).parent.resolve()
+
+    # claim a pre-created container - paths are rewritten using its mounts
+    container = None
+    if args.docker_pool:
+        with timed(args, 'docker-claim'):
+            container, path_mounts = docker_pool_claim(args, mounts)
+        if container is None:
+            logging.info('No pooled container available for "%s".', args.docker_image)
+        else:
+            args.addattr('docker_container', container)
+    if container is None:
+        path_mounts = mounts
+
+    if rebase_derived:
+        # the derived disk references the base image by its host path
+        base_dst = docker_mount_path(path_mounts, args.base_disk)
+        if base_dst is None:
+            base_dst = Path(path_mounts['qcow']['dst']) / args.base_disk.name
+        if qemu_rebase_overlay(derived_disk, base_dst) != 0:
+            logging.error('Failed to rebase derived image "%s" to "%s".', derived_disk, base_dst)
+            docker_pool_release(args)
+            sys.exit(1)
 
     # rewrite any arguments depending on mount paths
-    args.disk = Path(mounts['qcow']['dst']) / args.disk.name
-    if args.usbdisk is not None:
-        args.usbdisk = Path(mounts['qcow']['dst']) / args.usbdisk.name
+    for arg_name in ['disk', 'usbdisk']:
+        if getattr(args, arg_name, None) is None:
+            continue
+        mnt_path = docker_mount_path(path_mounts, getattr(args, arg_name))
+        if mnt_path is None:
+            logging.warning('Image "%s" is outside the "qcow" mount.', getattr(args, arg_name))
+            mnt_path = Path(path_mounts['qcow']['dst']) / getattr(args, arg_name).name
+        setattr(args, arg_name, mnt_path)
+    if getattr(args, 'replay', None) is not None:
+        replay = docker_mount_path({'rr': path_mounts['rr']}, args.replay)
+        if replay is None:
+            logging.warning('Recording "%s" is outside the "rr" mount.', args.replay)
+            replay = Path(path_mounts['rr']['dst']) / args.replay.name
+        if getattr(args, 'pandalog', None) is not None:
+            if args.pandalog.parent.resolve() != args.replay.parent.resolve():
+                logging.warning('Pandalog "%s" will be written next to the recording.', args.pandalog)
+            args.pandalog = replay.parent / args.pandalog.name
+        args.replay = replay
+
+    if args.qmp is not None:
+        qmp_socket = docker_mount_path(path_mounts, args.qmp)
+        if qmp_socket is None:
+            logging.error('QMP socket "%s" is not in a docker mount.', args.qmp)
+            docker_pool_release(args)
+            sys.exit(1)
+        args.addattr('qmp_socket', qmp_socket)
+
+    args.addattr('docker_mounts', path_mounts)
+    if container is not None:
+        return docker_pool_exec_command(args, container, mounts)
 
     # add mounts to command
     for tgt, mnt_args in mounts.items():
@@ -270,6 +800,10 @@ def process_docker_args(args):
         cmd_ext = arg_format('docker-fwd', fwd)
         cmd.extend(cmd_ext)
 
+    # pin the container to its cpu set
+    if args.cpuset is not None:
+        cmd.extend(arg_format('docker-cpuset', cpus=args.cpuset, mems=args.cpuset_mems))
+
     # add environment to command
     cmd.extend(['-e', 'DISPLAY={DISPLAY}'.format(**os.environ)])
 
@@ -286,8 +820,224 @@ def process_docker_args(args):
 
     return cmd
 
-def qemu_derive_disk(base_disk, uid, qcow_compat='0.10'):
-    """ Use a base qcow image to create a derived image in the same directory.
+def docker_mount_path(mounts, path):
+    """ Returns the path of host path inside the docker container, using
+        the first of mounts that contains it. Returns None if path is not
+        in any of the mounts.
+    """
+    path = Path(path)
+    for mnt_args in mounts.values():
+        try:
+            rel = path.parent.resolve().relative_to(mnt_args.get('src'))
+        except (TypeError, ValueError):
+            continue
+        return Path(mnt_args['dst']) / rel / path.name
+    return None
+
+def docker_pool_mounts(args):
+    """ Returns the mounts of the pooled containers of args.docker_image.
+        Mounts are fixed when a container is created, so the per-run mount
+        targets are mounted from the roots of their sources instead.
+    """
+    srcs = {
+        'qcow': Path(args.disk).parent,
+        'overlay': args.overlay_dir,
+        **{tgt: getattr(args, arg_name) for tgt, arg_name in DOCKER_POOL_ROOTS.items()},
+    }
+    for tgt, src in map(lambda s: s.split(':', 1), args.docker_mount):
+        srcs[tgt] = src
+    mounts = {}
+    for tgt, mnt_args in DOCKER_MNT_ALIAS.items():
+        src = srcs.get(tgt, mnt_args.get('src'))
+        if src is None:
+            continue
+        if not Path(src).exists():
+            logging.warning('Source "%s" for docker mount target "%s" does not exist.', src, tgt)
+            continue
+        mounts[tgt] = dict(mnt_args, src=Path(src).resolve(), dst=mnt_args['dst'].format(**vars(args)))
+    return mounts
+
+def docker_pool_list(docker_image, status='running'):
+    """ Returns the names and mounts of the pooled containers of docker_image
+        with the specified status. This includes claimed containers.
+    """
+    label = DOCKER_POOL_FORMATS['label']
+    cmd = ['docker', 'ps', '-a', '--no-trunc',
+           '--filter', 'label=%s=%s' % (label, docker_image),
+           '--filter', 'status=%s' % status,
+           '--format', '{{.Names}}\t{{.Label "%s"}}' % DOCKER_POOL_FORMATS['mounts-label']]
+    proc = subprocess.run(cmd, stdout=subprocess.PIPE, stderr=subprocess.DEVNULL, text=True)
+    if proc.returncode != 0:
+        logging.warning('Failed to list the pooled containers of "%s".', docker_image)
+        return []
+    containers = []
+    for line in proc.stdout.splitlines():
+        name, _, mounts_label = line.partition('\t')
+        try:
+            mounts = {tgt: dict(mnt_args, src=Path(mnt_args['src']))
+                      for tgt, mnt_args in json.loads(mounts_label).items()}
+        except (ValueError, KeyError, AttributeError):
+            logging.debug('Ignoring container "%s" with invalid mounts label.', name)
+            continue
+        containers.append((name, mounts))
+    return containers
+
+def docker_pool_start(args, mounts):
+    """ Starts a pooled container of args.docker_image with the specified
+        mounts. Pooled containers use the host network, since their published
+        ports would be fixed at creation as well. Returns the container name,
+        or None if starting it failed.
+    """
+    name = DOCKER_POOL_FORMATS['name'].format(docker_image=args.docker_image, token=os.urandom(4).hex())
+    mounts_label = {tgt: dict(mnt_args, src=str(mnt_args['src'])) for tgt, mnt_args in mounts.items()}
+    cmd = ['docker', 'run', '-d', '--name', name, '--net=host',
+           '--label', '%s=%s' % (DOCKER_POOL_FORMATS['label'], args.docker_image),
+           '--label', '%s=%s' % (DOCKER_POOL_FORMATS['mounts-label'], json.dumps(mounts_label))]
+    for mnt_args in mounts.values():
+        cmd.extend(arg_format('docker-mnt', mnt_args))
+    cmd.append(args.docker_image)
+    # keep the container running until it is claimed
+    cmd.extend(['sleep', 'infinity'] if args.docker_no_init else ['/sbin/my_init'])
+    if subprocess.run(cmd, stdout=subprocess.DEVNULL).returncode != 0:
+        logging.error('Failed to start pooled container "%s".', name)
+        return None
+    return name
+
+def docker_pool_claim(args, mounts):
+    """ Claims a running pooled container of args.docker_image, by renaming it
+        to args.hostname. The container must mount the existing sources of all
+        the specified mounts. Returns the container name and its mounts, or a
+        pair of None if no container could be claimed.
+    """
+    prefix = DOCKER_POOL_FORMATS['name'].format(docker_image=args.docker_image, token='')
+    srcs = [mnt_args['src'] for mnt_args in mounts.values()
+            if 'src' in mnt_args and mnt_args['src'].exists()]
+    for name, pool_mounts in docker_pool_list(args.docker_image):
+        if not name.startswith(prefix):
+            continue
+        pool_srcs = [mnt_args['src'] for mnt_args in pool_mounts.values()]
+        if not all(any(src == p or p in src.parents for p in pool_srcs) for src in srcs):
+            logging.debug('Pooled container "%s" does not mount all sources.', name)
+            continue
+        # renaming fails if another launch claimed the container first
+        rename = ['docker', 'rename', name, args.hostname]
+        if subprocess.run(rename, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL).returncode == 0:
+            logging.info('Claimed pooled container "%s" as "%s".', name, args.hostname)
+            return args.hostname, pool_mounts
+    return None, None
+
+def docker_pool_exec_command(args, container, mounts):
+    """ Returns the docker command for running PANDA in a claimed container.
+        The bootstrap of the run is executed in the container first, as it
+        has already been initialized without it.
+    """
+    bs_src = mounts['bootstrap'].get('src')
+    if bs_src is not None and (bs_src / 'bootstrap.sh').exists():
+        bs_dst = docker_mount_path(args.docker_mounts, bs_src / 'bootstrap.sh')
+        with timed(args, 'docker-bootstrap'):
+            rc = subprocess.run(['docker', 'exec', container, str(bs_dst)], stdin=subprocess.DEVNULL).returncode
+        if rc != 0:
+            logging.error('Failed to bootstrap container "%s".', container)
+            docker_pool_release(args)
+            sys.exit(1)
+
+    # forward the qemu ports directly to the host ports
+    if args.docker_net is not None:
+        logging.warning('Pooled containers use the host network. Ignoring --docker-net.')
+    for fwd in args.port_fwd:
+        for dfwd in args.docker_port_fwd:
+            if (dfwd['to'], dfwd['proto']) == (fwd['to'], fwd['proto']):
+                fwd['to'], fwd['scope'] = dfwd['from'], dfwd['scope']
+                break
+
+    cmd = ['docker', 'exec', '-i', '-e', 'DISPLAY={DISPLAY}'.format(**os.environ), container]
+    if args.cpuset is not None:
+        cmd.extend(arg_format('taskset', cpus=args.cpuset))
+    cmd.extend(arg_format('docker-no-init', args))
+    return cmd
+
+def docker_pool_release(args):
+    """ Removes the pooled container claimed for args in the background.
+        Containers are not reused, so that every run starts from a clean one.
+    """
+    container = getattr(args, 'docker_container', None)
+    if container is None:
+        return
+    logging.debug('Removing claimed container "%s".', container)
+    subprocess.Popen(['docker', 'rm', '-f', container], stdin=subprocess.DEVNULL,
+            stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL, start_new_session=True)
+
+def qemu_derived_name(base_disk, uid, overlay_dir=None):
+    """ Returns the path of the image derived from base_disk for uid.
+        The image is placed in overlay_dir, or next to base_disk if not set.
+    """
+    base_disk = Path(base_disk)
+    name = '%s.%s%s' % (base_disk.stem, uid, base_disk.suffix)
+    return base_disk.with_name(name) if overlay_dir is None else Path(overlay_dir) / name
+
+def qemu_backing_ref(base_disk, overlay_dir=None):
+    """ Returns the reference to base_disk stored in overlays placed in
+        overlay_dir. Overlays next to the base image reference it by name,
+        others by its absolute path.
+    """
+    base_disk = Path(base_disk)
+    if overlay_dir is None or Path(overlay_dir).resolve() == base_disk.parent.resolve():
+        return base_disk.name
+    return str(base_disk.resolve())
+
+def qemu_qcow_opts(args):
+    """ Returns the qcow2 creation options for overlays as a dict.
+    """
+    qcow_opts = {'compat': args.qcow_compat}
+    if args.qcow_cluster_size is not None:
+        qcow_opts['cluster_size'] = args.qcow_cluster_size
+    if args.qcow_lazy_refcounts:
+        if args.qcow_compat == '0.10':
+            logging.warning('Lazy refcounts require qcow2 version 1.1. Assuming "1.1".')
+            qcow_opts['compat'] = '1.1'
+        qcow_opts['lazy_refcounts'] = 'on'
+    return qcow_opts
+
+def qemu_drive_opts(args):
+    """ Returns the runtime options for the VM disk as a string.
+        An empty string means that the disk can be attached with -hda.
+    """
+    drive_opts = []
+    if args.qcow_l2_cache is not None:
+        drive_opts.append('l2-cache-size=%s' % args.qcow_l2_cache)
+    if args.overlay_cache is not None:
+        drive_opts.append('cache=%s' % args.overlay_cache)
+    return ','.join(drive_opts)
+
+def qemu_create_overlay(base_disk, overlay, qcow_opts=None, backing=None):
+    """ Runs qemu-img to create overlay, using base_disk as backing file.
+        The backing file is referenced as backing, which defaults to the
+        name of base_disk, i.e. both images are expected to be in the same
+        directory. Additional qcow2 creation options can be passed in the
+        qcow_opts dict. Returns the exit code of qemu-img.
+    """
+    qcow_opts = dict(qcow_opts or {'compat': '0.10'})
+    qcow_opts['backing_file'] = Path(base_disk).name if backing is None else backing
+    cmd_fmt = 'qemu-img create -f qcow2 -o {qcow_opts} {derived_disk}'
+    cmd_args = {
+        'qcow_opts': shlex.quote(','.join('%s=%s' % kv for kv in qcow_opts.items())),
+        'derived_disk': shlex.quote(str(overlay)),
+    }
+    cmd = shlex.split(cmd_fmt.format(**cmd_args))
+    logging.debug('Preparing derived image with command: %s', cmd)
+    return subprocess.call(cmd)
+
+def qemu_rebase_overlay(overlay, backing):
+    """ Rewrites the backing file reference of overlay to backing, without
+        checking that backing exists or touching the image data.
+        Returns the exit code of qemu-img.
+    """
+    cmd = ['qemu-img', 'rebase', '-u', '-b', str(backing), str(overlay)]
+    logging.debug('Rebasing derived image with command: %s', cmd)
+    return subprocess.call(cmd)
+
+def qemu_derive_disk(base_disk, uid, qcow_opts=None, overlay_dir=None):
+    """ Use a base qcow image to create a derived image.
         The derived image filename is computed using uid.
 
         This script is meant to be used to launch PANDA either directly or
@@ -299,14 +1049,16 @@ def qemu_derive_disk(base_disk, uid, qcow_compat='0.10'):
         includes an absolute or relative path to the base image. This path
         may become invalid when running inside Docker, and extra steps are
         required to avoid this.
+        Derived images placed in a different overlay_dir (e.g. a tmpfs)
+        reference the base image by its absolute path. When running inside
+        Docker, process_docker_args() rebases them to the path of the base
+        image in the container.
     """
-    cmd_fmt = 'qemu-img create -f qcow2 -o compat={qcow_compat} {derived_disk} -o backing_file={base_disk}'
     error = False
 
     base_disk = Path(base_disk)
-    derived_disk_name = '%s.%s%s' % (base_disk.stem, uid, base_disk.suffix)
-    derived_disk = base_disk.with_name(derived_disk_name)
-    logging.info('Preparing derived image "%s" using base image "%s".', derived_disk.name, base_disk)
+    derived_disk = qemu_derived_name(base_disk, uid, overlay_dir)
+    logging.info('Preparing derived image "%s" using base image "%s".', derived_disk, base_disk)
 
     # sanity checks
     if not base_disk.exists():
@@ -322,19 +1074,296 @@ def qemu_derive_disk(base_disk, uid, qcow_compat='0.10'):
         return None
 
     # create and run command
-    shq = lambda p: shlex.quote(str(p))
-    cmd_args = {
-        'qcow_compat': qcow_compat,
-        'base_disk': shlex.quote(base_disk.name),
-        'derived_disk': shlex.quote(str(derived_disk)),
-    }
-    cmd = shlex.split(cmd_fmt.format(**cmd_args))
-    logging.debug('Preparing derived image with command: %s', cmd)
-    subprocess.call(cmd)
+    derived_disk.parent.mkdir(parents=True, exist_ok=True)
+    qemu_create_overlay(base_disk, derived_disk, qcow_opts, qemu_backing_ref(base_disk, overlay_dir))
+    return derived_disk
+
+def qcow_backing_file(image):
+    """ Reads the name of the backing file from the header of a qcow2 image.
+        Returns an empty string if the image has no backing file, or None if
+        the image could not be read or is not a qcow2 image.
+    """
+    try:
+        with open(image, 'rb') as f:
+            hdr = f.read(20)
+            if len(hdr) < 20 or hdr[:4] != b'QFI\xfb':
+                return None
+            bf_offset, bf_size = struct.unpack('>QI', hdr[8:20])
+            if bf_offset == 0:
+                return ''
+            f.seek(bf_offset)
+            return f.read(bf_size).decode(errors='replace')
+    except OSError:
+        return None
+
+def qemu_pool_scan(base_disk, overlay_dir=None):
+    """ Scans the warm pool of base_disk and recycles any stale entries.
+        The pool is kept in overlay_dir, or next to base_disk if not set.
+        Entries are stale if they are not valid overlays of base_disk, or if
+        base_disk has been modified after their creation. Incomplete entries
+        left behind by an interrupted filler are removed after POOL_TMP_MAXAGE
+        seconds. Returns the ready entries, oldest first.
+    """
+    base_disk = Path(base_disk)
+    pool_dir = base_disk.parent if overlay_dir is None else Path(overlay_dir)
+    backing = qemu_backing_ref(base_disk, overlay_dir)
+    fmt_args = {'stem': base_disk.stem, 'suffix': base_disk.suffix, 'token': '*'}
+    base_mtime = base_disk.stat().st_mtime
+    now = time.time()
+
+    for tmp in pool_dir.glob(POOL_FORMATS['tmp'].format(**fmt_args)):
+        try:
+            if now - tmp.stat().st_mtime > POOL_TMP_MAXAGE:
+                logging.info('Removing orphaned pool image "%s".', tmp.name)
+                tmp.unlink()
+        except FileNotFoundError:
+            pass
+
+    ready = []
+    for entry in pool_dir.glob(POOL_FORMATS['ready'].format(**fmt_args)):
+        try:
+            stale = (entry.stat().st_mtime < base_mtime or
+                     qcow_backing_file(entry) != backing)
+            if stale:
+                logging.info('Recycling stale pool image "%s".', entry.name)
+                entry.unlink()
+            else:
+                ready.append((entry.stat().st_mtime, entry))
+        except FileNotFoundError:
+            # claimed concurrently
+            pass
+    return [entry for _, entry in sorted(ready)]
+
+def qemu_pool_fill(base_disk, size, qcow_opts=None, overlay_dir=None):
+    """ Fills the warm pool of base_disk with up to size derived images.
+        Images are created under a temporary name and flushed to disk before
+        they are renamed to become available, so that claiming them never
+        blocks on I/O. Returns the number of images created.
+    """
+    base_disk = Path(base_disk)
+    pool_dir = base_disk.parent if overlay_dir is None else Path(overlay_dir)
+    pool_dir.mkdir(parents=True, exist_ok=True)
+    backing = qemu_backing_ref(base_disk, overlay_dir)
+    fmt_args = {'stem': base_disk.stem, 'suffix': base_disk.suffix}
+    created = 0
+    for _ in range(size - len(qemu_pool_scan(base_disk, overlay_dir))):
+        token = os.urandom(4).hex()
+        tmp = pool_dir / POOL_FORMATS['tmp'].format(token=token, **fmt_args)
+        entry = pool_dir / POOL_FORMATS['ready'].format(token=token, **fmt_args)
+        rc = qemu_create_overlay(base_disk, tmp, qcow_opts, backing)
+        if rc != 0 or not tmp.is_file():
+            logging.error('Failed to create pool image "%s" (exit code %d).', tmp.name, rc)
+            if tmp.exists():
+                tmp.unlink()
+            break
+        fd = os.open(tmp, os.O_RDONLY)
+        try:
+            os.fsync(fd)
+        finally:
+            os.close(fd)
+        os.rename(tmp, entry)
+        created += 1
+    if created:
+        dir_fd = os.open(pool_dir, os.O_RDONLY)
+        try:
+            os.fsync(dir_fd)
+        finally:
+            os.close(dir_fd)
+        logging.info('Added %d images to the pool of "%s".', created, base_disk.name)
+    return created
+
+def qemu_pool_claim(base_disk, uid, overlay_dir=None):
+    """ Claims a derived image for uid from the warm pool of base_disk.
+        Claiming renames a ready pool entry to the name that qemu_derive_disk
+        would have used, which is atomic and safe against concurrent claims.
+        Returns None if the pool is empty.
+    """
+    base_disk = Path(base_disk)
+    derived_disk = qemu_derived_name(base_disk, uid, overlay_dir)
+    if not base_disk.exists() or derived_disk.exists() or not derived_disk.parent.is_dir():
+        return None
+    for entry in qemu_pool_scan(base_disk, overlay_dir):
+        try:
+            os.rename(entry, derived_disk)
+        except FileNotFoundError:
+            # claimed concurrently - try the next one
+            continue
+        logging.info('Claimed derived image "%s" from pool entry "%s".', derived_disk.name, entry.name)
+        return derived_disk
+    logging.info('No derived images available in the pool of "%s".', base_disk.name)
+    return None
+
+def qemu_resume_name(base_disk, kind='image'):
+    """ Returns the path of the resume image of base_disk, or of one of its
+        companion files specified by kind.
+    """
+    base_disk = Path(base_disk)
+    return base_disk.with_name(RESUME_FORMATS[kind].format(stem=base_disk.stem, suffix=base_disk.suffix))
+
+def qemu_resume_disk(base_disk, uid, vm_opts, overlay_dir=None):
+    """ Creates the derived image for uid from the resume image of base_disk.
+        Internal snapshots are not visible through an overlay, so the resume
+        image is copied instead, using a reflink if possible. The vm_opts
+        dict must match the VM options the snapshot was created with.
+        Returns None if the resume image is missing or stale.
+    """
+    base_disk = Path(base_disk)
+    image = qemu_resume_name(base_disk)
+    derived_disk = qemu_derived_name(base_disk, uid, overlay_dir)
+    logging.info('Preparing derived image "%s" using resume image "%s".', derived_disk, image)
+
+    # sanity checks
+    try:
+        meta = json.loads(qemu_resume_name(base_disk, 'meta').read_text())
+    except (OSError, ValueError):
+        logging.error('No resume image for "%s". Create it using the snapshot mode.', base_disk)
+        return None
+    if not image.is_file() or meta['base_mtime'] != base_disk.stat().st_mtime:
+        logging.error('Resume image "%s" is missing or stale. Re-create it using the snapshot mode.', image)
+        return None
+    for k, v in vm_opts.items():
+        if meta.get(k) != v:
+            logging.error('Resume image "%s" was created with %s "%s".', image, k, meta.get(k))
+            return None
+    if derived_disk.exists():
+        logging.error('Derived image "%s" already exists.', derived_disk)
+        return None
+
+    derived_disk.parent.mkdir(parents=True, exist_ok=True)
+    fs_clone_file(image, derived_disk)
+    backing = qemu_backing_ref(base_disk, overlay_dir)
+    if backing != base_disk.name and qemu_rebase_overlay(derived_disk, backing) != 0:
+        derived_disk.unlink()
+        return None
     return derived_disk
 
-def qemu_make_usbdisk(contents_dir, out_dir, uid, fstype='ext3', fssize='32M', fslabel=''):
+def fs_clone_file(src, dst, chunk_size=1 << 16):
+    """ Copies src to dst, using a reflink if the filesystem supports it.
+        Falls back to a sparse copy otherwise, i.e. zero-filled chunks of
+        src become holes in dst.
+    """
+    with open(src, 'rb') as src_f, open(dst, 'wb') as dst_f:
+        try:
+            fcntl.ioctl(dst_f.fileno(), FICLONE, src_f.fileno())
+            return
+        except OSError:
+            logging.debug('Reflinks not supported for "%s". Copying.', dst)
+        zeros = bytes(chunk_size)
+        for chunk in iter(lambda: src_f.read(chunk_size), b''):
+            if chunk == zeros[:len(chunk)]:
+                dst_f.seek(len(chunk), os.SEEK_CUR)
+            else:
+                dst_f.write(chunk)
+        dst_f.truncate()
+
+def usbdisk_cache_key(contents_dir, *fs_params):
+    """ Computes a content hash for contents_dir and the fs parameters.
+        File names, types, permissions, ownership and contents are hashed.
+        Timestamps are not, as they are changed by every copy of the files.
+        Neither are the per-run files in USBDISK_RUN_FILES.
+    """
+    h = hashlib.sha256(repr(fs_params).encode())
+    contents_p = Path(contents_dir)
+    for root, dirs, files in os.walk(contents_p):
+        dirs.sort()
+        files = [f for f in files if f not in USBDISK_RUN_FILES]
+        for name in sorted(dirs + files):
+            p = Path(root, name)
+            st = p.lstat()
+            h.update(repr((str(p.relative_to(contents_p)), st.st_mode, st.st_uid, st.st_gid)).encode())
+            if p.is_symlink():
+                h.update(os.readlink(p).encode())
+            elif p.is_file():
+                with open(p, 'rb') as f:
+                    for chunk in iter(lambda: f.read(1 << 16), b''):
+                        h.update(chunk)
+    return h.hexdigest()
+
+def usbdisk_run_files(contents_dir):
+    """ Returns the paths of the per-run files in contents_dir.
+    """
+    return sorted(p for p in Path(contents_dir).rglob('*')
+            if p.name in USBDISK_RUN_FILES and p.is_file() and not p.is_symlink())
+
+def usbdisk_stage_contents(contents_dir, stage_dir):
+    """ Copies contents_dir to stage_dir, leaving out the per-run files.
+        Files are hard-linked where possible. Ownership is kept, so that
+        the filesystem built from stage_dir matches the one of contents_dir.
+    """
+    def link_or_copy(src, dst):
+        try:
+            os.link(src, dst)
+        except OSError:
+            shutil.copy2(src, dst)
+    contents_p = Path(contents_dir)
+    shutil.copytree(contents_p, stage_dir, symlinks=True, copy_function=link_or_copy,
+            ignore=shutil.ignore_patterns(*USBDISK_RUN_FILES))
+    if os.geteuid() == 0:
+        for root, dirs, files in os.walk(stage_dir):
+            for p in [Path(root), *(Path(root, name) for name in dirs + files)]:
+                st = (contents_p / p.relative_to(stage_dir)).lstat()
+                os.lchown(p, st.st_uid, st.st_gid)
+
+def usbdisk_write_files(image, contents_dir, files):
+    """ Writes files from contents_dir into the filesystem image, using debugfs.
+        Permissions and ownership of the files are kept.
+        Returns True on success.
+    """
+    contents_p = Path(contents_dir)
+    cmds = []
+    for p in files:
+        dst = '/' + p.relative_to(contents_p).as_posix()
+        st = p.stat()
+        cmds.extend([
+            'write "%s" "%s"' % (p.resolve(), dst),
+            'sif "%s" uid %d' % (dst, st.st_uid),
+            'sif "%s" gid %d' % (dst, st.st_gid),
+        ])
+    cmd = ['debugfs', '-w', '-f', '-', str(image)]
+    logging.debug('Writing per-run files into filesystem image with command: %s', cmd)
+    try:
+        proc = subprocess.run(cmd, input='\n'.join(cmds) + '\n', stdout=subprocess.DEVNULL,
+                stderr=subprocess.PIPE, universal_newlines=True)
+    except FileNotFoundError:
+        logging.error('debugfs not found. It is needed for writing per-run files into cached USB disk images.')
+        return False
+    # debugfs exits with 0 even if commands fail - look for failed writes instead
+    errors = [l for l in proc.stderr.splitlines() if l.startswith(('write:', 'sif:'))]
+    if proc.returncode != 0 or errors:
+        logging.error('Failed to write per-run files into "%s": %s', image, '; '.join(errors) or proc.returncode)
+        return False
+    return True
+
+def usbdisk_cache_evict(cache_dir, cache_size):
+    """ Evicts least recently used images until the cache is within cache_size bytes.
+    """
+    entries = []
+    for entry in Path(cache_dir).glob('*.img'):
+        try:
+            st = entry.stat()
+        except FileNotFoundError:
+            continue
+        entries.append((st.st_mtime, st.st_blocks * 512, entry))
+    total = sum(size for _, size, _ in entries)
+    for _, size, entry in sorted(entries):
+        if total <= cache_size:
+            break
+        logging.info('Evicting cached USB disk image "%s".', entry.name)
+        try:
+            entry.unlink()
+        except FileNotFoundError:
+            pass
+        total -= size
+
+def qemu_make_usbdisk(contents_dir, out_dir, uid, fstype='ext3', fssize='32M', fslabel='',
+        cache_dir=None, cache_size=1 << 30):
     """ Creates a new filesystem image from the contents of contents_dir.
+        If cache_dir is specified, images are cached there, keyed on the
+        contents of contents_dir and the filesystem parameters. Cache hits
+        are cloned rather than rebuilt. Least recently used images are
+        evicted when the cache grows over cache_size bytes.
+        Per-run files (USBDISK_RUN_FILES) are left out of the cached images
+        and written into each clone.
     """
     if contents_dir is None:
         return None
@@ -347,56 +1376,2815 @@ def qemu_make_usbdisk(contents_dir, out_dir, uid, fstype='ext3', fssize='32M', f
         logging.error('Output directory "%s" is not a directory.', out_p)
         return None
     image = out_p.joinpath("usbdisk.%s.img" % (uid))
+    if fstype not in ['ext2', 'ext3', 'ext4']:
+        logging.error("%s filesystems are not supported.", fstype)
+        return None
 
-    if fstype in ['ext2', 'ext3', 'ext4']:
-        # Explanation of hardcoded options for mke2fs:
-        #   -O ^64bit -> turn off 64bit support – not needed for a small fs
-        #   -m 2 -> reserve only 2% of blocks for superuser – no services write on this fs
-        cmd_fmt = 'mke2fs -L {fslabel} -O ^64bit -m 2 -t {fstype} -d {dir} {image} {fssize}'
-        cmd_args = {
-            'dir': shlex.quote(str(contents_dir)),
-            'image': shlex.quote(str(image)),
-            'fslabel': shlex.quote(fslabel),
-            'fstype': fstype,
-            'fssize': fssize,
-            'uid': shlex.quote(uid),
-        }
-        cmd = shlex.split(cmd_fmt.format(**cmd_args))
-        logging.debug('Preparing filesystem image with command: %s', cmd)
-        subprocess.call(cmd)
-        return image
+    # check the cache
+    if cache_dir is not None:
+        cache_p = Path(cache_dir)
+        cache_p.mkdir(parents=True, exist_ok=True)
+        cached = cache_p / ('%s.img' % usbdisk_cache_key(contents_p, fstype, fssize, fslabel))
+        run_files = usbdisk_run_files(contents_p)
+        try:
+            # bump the entry for LRU eviction, then clone it
+            os.utime(cached)
+            fs_clone_file(cached, image)
+            logging.info('Using cached USB disk image "%s".', cached)
+            if run_files and not usbdisk_write_files(image, contents_p, run_files):
+                image.unlink()
+                return None
+            return image
+        except FileNotFoundError:
+            logging.info('USB disk image not found in cache "%s".', cache_p)
+        mkfs_image = cache_p / ('.%s.%s.tmp' % (cached.stem, uid))
+        if run_files:
+            # build the cached image from the invariant contents only
+            mkfs_dir = cache_p / ('.%s.%s.d.tmp' % (cached.stem, uid))
+            usbdisk_stage_contents(contents_p, mkfs_dir)
+            contents_dir = mkfs_dir
     else:
-        logging.error("%s filesystems are not supported.", fstype)
+        mkfs_image = image
+        run_files = []
+
+    # Explanation of hardcoded options for mke2fs:
+    #   -O ^64bit -> turn off 64bit support – not needed for a small fs
+    #   -m 2 -> reserve only 2% of blocks for superuser – no services write on this fs
+    cmd_fmt = 'mke2fs -L {fslabel} -O ^64bit -m 2 -t {fstype} -d {dir} {image} {fssize}'
+    cmd_args = {
+        'dir': shlex.quote(str(contents_dir)),
+        'image': shlex.quote(str(mkfs_image)),
+        'fslabel': shlex.quote(fslabel),
+        'fstype': fstype,
+        'fssize': fssize,
+        'uid': shlex.quote(uid),
+    }
+    cmd = shlex.split(cmd_fmt.format(**cmd_args))
+    logging.debug('Preparing filesystem image with command: %s', cmd)
+    rc = subprocess.call(cmd)
+    if run_files:
+        shutil.rmtree(contents_dir, ignore_errors=True)
+
+    # add the image to the cache
+    if cache_dir is not None:
+        if rc != 0 or not mkfs_image.is_file():
+            logging.error('Failed to create filesystem image (exit code %d).', rc)
+            if mkfs_image.exists():
+                mkfs_image.unlink()
+            return None
+        os.rename(mkfs_image, cached)
+        fs_clone_file(cached, image)
+        usbdisk_cache_evict(cache_p, cache_size)
+        if run_files and not usbdisk_write_files(image, contents_p, run_files):
+            image.unlink()
+            return None
+    return image
+
+def bootstrap_vars(makedir):
+    """ Reads the variables used for rendering bootstrap templates from the
+        Makefile.vars files of the project, like j2 -f env does.
+    """
+    variables = {}
+    for fmt in ('vars', 'local-vars'):
+        with contextlib.suppress(FileNotFoundError):
+            for line in (Path(makedir) / BOOTSTRAP_FORMATS[fmt]).read_text().splitlines():
+                if line.startswith('#') or '=' not in line:
+                    continue
+                k, v = line.split('=', 1)
+                variables[k.strip()] = v.strip()
+    return variables
+
+@functools.lru_cache(maxsize=None)
+def import_jinja2():
+    """ Imports jinja2 on first use, as loading it slows down the startup of
+        every mode. Returns None if jinja2 is not installed.
+    """
+    try:
+        import jinja2
+    except ImportError:
         return None
+    return jinja2
 
-def prov2r_parse_args(argv=[]):
-    """ Parses a list of command line arguments.
+_bootstrap_cache = {}
+_bootstrap_cache_lock = threading.Lock()
+
+def bootstrap_render(makedir):
+    """ Renders the templates of the bootstrap makedir, e.g. bootstrap.env.j2.
+        The jinja2 environment and the rendered files are cached, until any
+        of the templates or variable files is modified.
+        Returns a dict mapping file names to their contents.
     """
-    # helper lambdas
-    _k2s = lambda d: ', '.join(d.keys())
+    jinja2 = import_jinja2()
+    makedir = Path(makedir).resolve()
+    deps = [*sorted(makedir.glob('*.j2')), *(makedir / BOOTSTRAP_FORMATS[fmt] for fmt in ('vars', 'local-vars'))]
+    stamp = tuple(p.stat().st_mtime_ns if p.exists() else None for p in deps)
+    with _bootstrap_cache_lock:
+        env, cached_stamp, rendered = _bootstrap_cache.get(makedir, (None, None, None))
+        if cached_stamp != stamp:
+            if env is None:
+                env = jinja2.Environment(loader=jinja2.FileSystemLoader(str(makedir)), keep_trailing_newline=True)
+            variables = bootstrap_vars(makedir)
+            try:
+                rendered = {t.stem: env.get_template(t.name).render(**variables) for t in deps if t.suffix == '.j2'}
+            except jinja2.TemplateError as e:
+                raise RuntimeError('Rendering bootstrap templates failed: %s' % e) from None
+            _bootstrap_cache[makedir] = (env, stamp, rendered)
+    return rendered
 
-    # argument parser, subparsers and groups
-    parser = argparse.ArgumentParser(
-        description='PANDA wrapper for PROV2R.',
-        epilog='See operation mode help for additional arguments.',
-        formatter_class=argparse.ArgumentDefaultsHelpFormatter
-    )
-    # add common options
-    parser.add_argument('-v', '--verbose', action='count',
-        default=0,
-        help='increase verbosity')
-    parser.add_argument('--run-id', action='store',
-        default=None,
-        help='unique(ish) identifier for this run')
-    parser.add_argument('-o', '--output-dir', action='store',
-        default='.',
-        help='all created files should be stored here')
-    # qemu options
-    qemu_args = parser.add_argument_group('QEMU options')
-    qemu_args.add_argument('-m', '--mem', action='store', type=int,
-        default=512,
-        help='VM memory')
-    qemu_args.add_argument('-t', '--target', action='store',
+def ssh_keygen(key, comment=''):
+    """ Generates an ed25519 ssh key pair without passphrase.
+    """
+    cmd = ['ssh-keygen', '-q', '-t', 'ed25519', '-P', '', '-C', comment, '-f', str(key)]
+    if subprocess.run(cmd, stdin=subprocess.DEVNULL).returncode != 0:
+        raise RuntimeError('Generating ssh key "%s" failed.' % key)
+
+def ssh_key_set_comment(key, comment):
+    """ Replaces the comment of an unencrypted OpenSSH private key and its
+        public key, without spawning ssh-keygen.
+    """
+    key = Path(key)
+    pub = key.with_name(key.name + '.pub')
+    keytype, pubkey = pub.read_text().split()[:2]
+    pub.write_text('%s %s %s\n' % (keytype, pubkey, comment))
+
+    lines = key.read_text().splitlines()
+    blob = base64.b64decode(''.join(lines[1:-1]))
+    def skip_string(buf, pos):
+        n, = struct.unpack_from('>I', buf, pos)
+        return pos + 4 + n
+    pos = len(b'openssh-key-v1\0')
+    if blob[pos + 4:skip_string(blob, pos)] != b'none':
+        raise RuntimeError('Key "%s" is encrypted.' % key)
+    for _ in range(3):  # cipher, kdf name and kdf options
+        pos = skip_string(blob, pos)
+    pos = skip_string(blob, pos + 4)  # number of keys, public key
+    n, = struct.unpack_from('>I', blob, pos)
+    private = blob[pos + 4:pos + 4 + n]
+
+    # checkints, key type, public key and private key - followed by the comment and padding
+    ppos = 8
+    for _ in range(3):
+        ppos = skip_string(private, ppos)
+    section = private[:ppos] + struct.pack('>I', len(comment.encode())) + comment.encode()
+    section += bytes(range(1, 1 + (-len(section) % 8)))
+    blob = blob[:pos] + struct.pack('>I', len(section)) + section
+    b64 = base64.b64encode(blob).decode()
+    lines = [lines[0], *(b64[i:i + 70] for i in range(0, len(b64), 70)), lines[-1]]
+    key.write_text('\n'.join(lines) + '\n')
+
+def keypool_fill(pool_dir, size):
+    """ Generates ssh keys until pool_dir holds size of them.
+        Only one process fills each pool at a time.
+    """
+    pool_dir = Path(pool_dir)
+    pool_dir.mkdir(parents=True, exist_ok=True)
+    with open(pool_dir / '.lck', 'w') as lck:
+        try:
+            fcntl.flock(lck, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            return 0
+        ready = [p for p in pool_dir.glob(BOOTSTRAP_FORMATS['pool-key'].format(token='*')) if p.suffix != '.pub']
+        missing = size - len(ready)
+        def generate(_):
+            key = pool_dir / BOOTSTRAP_FORMATS['pool-key'].format(token=os.urandom(8).hex())
+            tmp = key.with_name('.%s' % key.name)
+            ssh_keygen(tmp)
+            # the private key marks the pair as ready, so it is moved last
+            os.rename(tmp.with_name(tmp.name + '.pub'), key.with_name(key.name + '.pub'))
+            os.rename(tmp, key)
+        if missing > 0:
+            logging.debug('Generating %d ssh keys in "%s".', missing, pool_dir)
+            with concurrent.futures.ThreadPoolExecutor(max_workers=os.cpu_count()) as executor:
+                list(executor.map(generate, range(missing)))
+        return max(missing, 0)
+
+def keypool_claim(pool_dir, key, comment=''):
+    """ Moves a pre-generated ssh key pair from pool_dir to key, setting its
+        comment. Returns False if the pool is empty.
+    """
+    key = Path(key)
+    for p in Path(pool_dir).glob(BOOTSTRAP_FORMATS['pool-key'].format(token='*')):
+        if p.suffix == '.pub':
+            continue
+        try:
+            os.rename(p, key)
+        except FileNotFoundError:
+            # claimed by another process
+            continue
+        os.rename(p.with_name(p.name + '.pub'), key.with_name(key.name + '.pub'))
+        ssh_key_set_comment(key, comment)
+        return True
+    return False
+
+def bootstrap_make(makedir, bs_root, run_id, key_pool=None):
+    """ Creates the docker and vm bootstrap directories for run_id in bs_root.
+        This is equivalent to `make -C makedir bs_root/run_id.rund`. The
+        directories are assembled under a temporary name and renamed into
+        place, so independent run-ids need no locking. The ssh key is taken
+        from key_pool if it is not empty. make is used instead if jinja2 is
+        not available.
+        Returns the path of the bootstrap directories.
+    """
+    if import_jinja2() is None:
+        return bootstrap_make_legacy(makedir, bs_root, run_id)
+    makedir = Path(makedir).resolve()
+    run_dir = Path(bs_root).resolve() / run_id
+    if all((run_dir / target).is_dir() for target in BOOTSTRAP_TARGETS):
+        return run_dir
+    rendered = bootstrap_render(makedir)
+    tmp = run_dir.with_name(BOOTSTRAP_FORMATS['tmp'].format(run_id=run_id))
+    shutil.rmtree(tmp, ignore_errors=True)
+    tmp.mkdir(parents=True)
+    try:
+        # same comment as the one used by the Makefile
+        key = tmp / BOOTSTRAP_FORMATS['key']
+        comment = re.sub(r'[^0-9]', '', str(run_dir))
+        if key_pool is None or not keypool_claim(key_pool, key, comment):
+            ssh_keygen(key, comment)
+        keys = [key, key.with_name(key.name + '.pub')]
+
+        for target, prefix in BOOTSTRAP_TARGETS.items():
+            target_dir = tmp / target
+            (target_dir / 'files').mkdir(parents=True)
+            (target_dir / 'scripts').mkdir()
+            shutil.copy(makedir / 'bootstrap.sh', target_dir)
+            for name, content in rendered.items():
+                (target_dir / name).write_text(content)
+                if name.endswith('.sh'):
+                    (target_dir / name).chmod(0o755)
+            for script in sorted((makedir / 'scripts').glob(prefix + '*')):
+                shutil.copy(script, target_dir / 'scripts' / script.name[len(prefix):])
+            for f in [*sorted((makedir / 'files').glob('*')), *keys]:
+                if f.is_file():
+                    shutil.copy(f, target_dir / 'files')
+        for f in keys:
+            f.unlink()
+        os.rename(tmp, run_dir)
+    except BaseException:
+        shutil.rmtree(tmp, ignore_errors=True)
+        raise
+    return run_dir
+
+def bootstrap_make_legacy(makedir, bs_root, run_id):
+    """ Creates the bootstrap directories for run_id using make.
+        make runs are serialized with the lock previously used by honeypot.sh.
+    """
+    target = Path(bs_root).resolve() / ('%s.rund' % run_id)
+    with open(Path(bs_root) / 'make.lck', 'w') as lck:
+        fcntl.flock(lck, fcntl.LOCK_EX)
+        rc = subprocess.call(['make', '-C', str(makedir), str(target)],
+                stdin=subprocess.DEVNULL, stdout=subprocess.DEVNULL)
+    if rc != 0:
+        raise RuntimeError('Bootstrap make for %s failed with exit code %d.' % (run_id, rc))
+    return target.with_suffix('')
+
+def rr_files(rr):
+    """ Returns the paths of the files of recording rr, along with the
+        paths of their compressed versions.
+    """
+    rr = Path(rr)
+    return [(rr.with_name(rr.name + sfx), rr.with_name(rr.name + sfx + RR_ARCHIVE_SUFFIX))
+            for sfx in RR_SUFFIXES]
+
+def rr_dir_recordings(rr_dir):
+    """ Returns the path prefixes of the recordings directly in rr_dir.
+        Unlike rr_find_recordings, subdirectories are not searched.
+    """
+    sfx = RR_SUFFIXES[-1]
+    return sorted({p.with_name(p.name[:-len(sfx)]) for p in Path(rr_dir).glob('*' + sfx)} |
+                  {p.with_name(p.name[:-len(sfx + RR_ARCHIVE_SUFFIX)])
+                   for p in Path(rr_dir).glob('*' + sfx + RR_ARCHIVE_SUFFIX)})
+
+def rr_trace_sizes(rr_dir):
+    """ Returns the total size of the snapshots and of the nondet logs of the
+        recordings in rr_dir. Compressed recordings are not included.
+    """
+    sizes = dict.fromkeys(('snp', 'nondet'), 0)
+    with contextlib.suppress(FileNotFoundError):
+        for entry in os.scandir(rr_dir):
+            for kind, sfx in zip(sizes, RR_SUFFIXES):
+                if entry.name.endswith(sfx):
+                    with contextlib.suppress(FileNotFoundError):
+                        sizes[kind] += entry.stat().st_size
+    return sizes
+
+def rr_find_recordings(rr_specs):
+    """ Expands a list of rr specifications to recording path prefixes.
+        Each specification is either the path prefix of a recording, or a
+        directory which is recursively searched for recordings. Recordings
+        may be compressed.
+        Returns a sorted list of unique prefixes and a list of the
+        specifications that did not resolve to any recordings.
+    """
+    nondet_sfxs = (RR_SUFFIXES[-1], RR_SUFFIXES[-1] + RR_ARCHIVE_SUFFIX)
+    recordings = set()
+    unresolved = []
+    for spec in rr_specs:
+        spec_p = Path(spec)
+        if spec_p.name and any(spec_p.with_name(spec_p.name + sfx).is_file() for sfx in nondet_sfxs):
+            recordings.add(spec_p)
+        elif spec_p.is_dir():
+            found = [p.with_name(p.name[:-len(sfx)])
+                     for sfx in nondet_sfxs
+                     for p in spec_p.rglob('*' + sfx) if p.is_file()]
+            if not found:
+                unresolved.append(spec)
+            recordings.update(found)
+        else:
+            unresolved.append(spec)
+    return sorted(recordings), unresolved
+
+def fs_sync_rename(src, dst):
+    """ Flushes src to disk and atomically renames it to dst.
+    """
+    fd = os.open(src, os.O_RDONLY)
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+    os.rename(src, dst)
+    dir_fd = os.open(Path(dst).parent, os.O_RDONLY)
+    try:
+        os.fsync(dir_fd)
+    finally:
+        os.close(dir_fd)
+
+def rr_instr_count(rr):
+    """ Returns the number of guest instructions in recording rr, read from
+        the header of its nondet log. Compressed logs are streamed through zstd.
+    """
+    nondet, archive = rr_files(rr)[1]
+    if nondet.is_file():
+        with open(nondet, 'rb') as f:
+            hdr = f.read(8)
+    else:
+        cmd = shlex.split(arg_format('rr-decompress', split=False, archive=shlex.quote(str(archive))))
+        with subprocess.Popen(cmd, stdout=subprocess.PIPE) as proc:
+            hdr = proc.stdout.read(8)
+            proc.kill()
+    if len(hdr) < 8:
+        raise RuntimeError('Could not read the header of "%s".' % nondet)
+    return struct.unpack('<Q', hdr)[0]
+
+def rr_compress_file(rr_file, level=3, threads=0, chunk_size=1 << 20):
+    """ Compresses rr_file, replacing it with its compressed version.
+        The file is streamed through a multi-threaded zstd process. The
+        archive is verified by streaming it back through zstd and comparing
+        content hashes, before it atomically replaces the original.
+        Returns the sizes of the original and the compressed file.
+    """
+    rr_file = Path(rr_file)
+    archive = rr_file.with_name(rr_file.name + RR_ARCHIVE_SUFFIX)
+    tmp = archive.with_name('.%s.tmp' % archive.name)
+
+    # compress
+    h_orig = hashlib.sha256()
+    cmd = shlex.split(arg_format('rr-compress', split=False, threads=threads, level=level))
+    with open(rr_file, 'rb') as in_f, open(tmp, 'wb') as out_f:
+        proc = subprocess.Popen(cmd, stdin=subprocess.PIPE, stdout=out_f)
+        try:
+            for chunk in iter(lambda: in_f.read(chunk_size), b''):
+                h_orig.update(chunk)
+                proc.stdin.write(chunk)
+        finally:
+            proc.stdin.close()
+            rc = proc.wait()
+    if rc != 0:
+        tmp.unlink()
+        raise RuntimeError('Compressing "%s" failed with exit code %d.' % (rr_file, rc))
+
+    # verify
+    h_arch = hashlib.sha256()
+    cmd = shlex.split(arg_format('rr-decompress', split=False, archive=shlex.quote(str(tmp))))
+    with subprocess.Popen(cmd, stdout=subprocess.PIPE) as proc:
+        for chunk in iter(lambda: proc.stdout.read(chunk_size), b''):
+            h_arch.update(chunk)
+    if proc.returncode != 0 or h_orig.digest() != h_arch.digest():
+        tmp.unlink()
+        raise RuntimeError('Verification of compressed "%s" failed.' % rr_file)
+
+    # replace
+    fs_sync_rename(tmp, archive)
+    size = rr_file.stat().st_size
+    rr_file.unlink()
+    return size, archive.stat().st_size
+
+def rr_decompress_file(archive, rr_file):
+    """ Streams archive through zstd to recreate rr_file.
+    """
+    tmp = Path(rr_file).with_name('.%s.tmp' % Path(rr_file).name)
+    cmd = shlex.split(arg_format('rr-decompress', split=False, archive=shlex.quote(str(archive))))
+    with open(tmp, 'wb') as out_f:
+        rc = subprocess.call(cmd, stdout=out_f)
+    if rc != 0:
+        tmp.unlink()
+        raise RuntimeError('Decompressing "%s" failed with exit code %d.' % (archive, rc))
+    os.rename(tmp, rr_file)
+
+def rr_compress(rr, level=3, threads=0):
+    """ Compresses all files of recording rr that are not compressed yet.
+    """
+    for rr_file, rr_archive in rr_files(rr):
+        if not rr_file.is_file():
+            continue
+        if rr_archive.exists():
+            logging.warning('Replacing stale archive "%s".', rr_archive)
+        t_start = time.monotonic()
+        size, csize = rr_compress_file(rr_file, level, threads)
+        logging.info('Compressed "%s" to %.1f%% in %.1fs.', rr_file,
+                100.0 * csize / max(size, 1), time.monotonic() - t_start)
+
+@functools.lru_cache(maxsize=None)
+def import_numpy():
+    """ Imports NumPy on first use, as loading it slows down the startup of
+        every mode. Returns None if NumPy is not installed.
+    """
+    try:
+        import numpy
+    except ImportError:
+        return None
+    return numpy
+
+def dedup_boundaries(buf, start):
+    """ Returns the positions in buf after start where the rolling window
+        sum of the dedup chunking hits the boundary mask.
+    """
+    window, mask = DEDUP_CHUNKING['window'], DEDUP_CHUNKING['mask']
+    start = max(start, window - 1)
+    numpy = import_numpy()
+    if numpy is not None:
+        gear = numpy.array(DEDUP_GEAR, dtype=numpy.uint64)
+        sums = numpy.zeros(len(buf) + 1, dtype=numpy.uint64)
+        numpy.cumsum(gear[numpy.frombuffer(buf, dtype=numpy.uint8)], out=sums[1:])
+        hits = numpy.flatnonzero((sums[window:] - sums[:-window]) & mask == mask) + window
+        return hits[hits > start].tolist()
+    sums = [0, *itertools.accumulate(map(DEDUP_GEAR.__getitem__, buf))]
+    return [p for p in range(start + 1, len(buf) + 1) if (sums[p] - sums[p - window]) & mask == mask]
+
+def dedup_chunks(f, block_size=1 << 22):
+    """ Splits the contents of file object f into content-defined chunks.
+        Chunk boundaries only depend on the surrounding bytes, so data
+        shifted by insertions elsewhere in the file still produces the same
+        chunks. Yields the chunks as bytes.
+    """
+    cmin, cmax = DEDUP_CHUNKING['min'], DEDUP_CHUNKING['max']
+    tail = b''
+    pending = b''
+    for block in iter(lambda: f.read(block_size), b''):
+        data = pending + block
+        last = 0
+        for p in dedup_boundaries(tail + block, len(tail)):
+            pos = len(pending) + p - len(tail)
+            while pos - last > cmax:
+                yield data[last:last + cmax]
+                last += cmax
+            if pos - last >= cmin:
+                yield data[last:pos]
+                last = pos
+        while len(data) - last > cmax:
+            yield data[last:last + cmax]
+            last += cmax
+        pending = data[last:]
+        tail = (tail + block)[-DEDUP_CHUNKING['window']:]
+    if pending:
+        yield pending
+
+def dedup_open(store):
+    """ Opens the chunk index of the dedup store, creating the store if needed.
+        Transactions are managed explicitly, so that they can lock the store.
+    """
+    store = Path(store)
+    store.mkdir(parents=True, exist_ok=True)
+    db = sqlite3.connect(str(store / DEDUP_FORMATS['db']), timeout=60, isolation_level=None)
+    db.executescript(DEDUP_SCHEMA)
+    return db
+
+def dedup_add_chunks(db, store, batch):
+    """ Adds references to a batch of (digest, chunk) pairs to the store.
+        Chunks are written compressed, unless they are already stored.
+    """
+    db.execute('BEGIN IMMEDIATE')
+    try:
+        for digest, chunk in batch:
+            db.execute('INSERT INTO chunks (digest, size, stored, refs) VALUES (?, ?, 0, 1) '
+                       'ON CONFLICT (digest) DO UPDATE SET refs = refs + 1', (digest, len(chunk)))
+            path = Path(store) / DEDUP_FORMATS['chunk'].format(digest=digest)
+            if path.exists():
+                continue
+            data = zlib.compress(chunk, 1)
+            path.parent.mkdir(parents=True, exist_ok=True)
+            tmp = path.with_name('.%s.tmp' % path.name)
+            tmp.write_bytes(data)
+            os.rename(tmp, path)
+            db.execute('UPDATE chunks SET stored = ? WHERE digest = ?', (len(data), digest))
+        db.execute('COMMIT')
+    except BaseException:
+        db.execute('ROLLBACK')
+        raise
+
+def dedup_release(db, store, chunks):
+    """ Removes one reference for each of the (digest, size) chunks, and
+        deletes the chunks that are no longer referenced.
+        Chunk files are only deleted once the index update is committed, so a
+        failed update cannot leave index entries without their chunks.
+        Returns the number of bytes freed.
+    """
+    refs = collections.Counter(digest for digest, _ in chunks)
+    db.execute('BEGIN IMMEDIATE')
+    try:
+        db.executemany('UPDATE chunks SET refs = refs - ? WHERE digest = ?',
+                       [(n, digest) for digest, n in refs.items()])
+        unused = db.execute('SELECT digest, stored FROM chunks WHERE refs <= 0').fetchall()
+        db.execute('DELETE FROM chunks WHERE refs <= 0')
+        db.execute('COMMIT')
+    except BaseException:
+        db.execute('ROLLBACK')
+        raise
+
+    # chunks added again in the meantime are kept - holding the lock keeps
+    # dedup_add_chunks from relying on a chunk file that is about to go
+    freed = 0
+    db.execute('BEGIN IMMEDIATE')
+    try:
+        for digest, stored in unused:
+            if db.execute('SELECT 1 FROM chunks WHERE digest = ?', (digest,)).fetchone():
+                continue
+            with contextlib.suppress(FileNotFoundError):
+                (Path(store) / DEDUP_FORMATS['chunk'].format(digest=digest)).unlink()
+            freed += stored
+    finally:
+        db.execute('COMMIT')
+    return freed
+
+def dedup_stream(manifest, store=None):
+    """ Yields the contents of the file described by manifest, one chunk at
+        a time. The store recorded in the manifest is used by default.
+    """
+    store = Path(store or manifest['store'])
+    for digest, size in manifest['chunks']:
+        chunk = zlib.decompress((store / DEDUP_FORMATS['chunk'].format(digest=digest)).read_bytes())
+        if len(chunk) != size:
+            raise RuntimeError('Chunk %s in "%s" is corrupted.' % (digest, store))
+        yield chunk
+
+def dedup_import_file(db, store, src_f, batch_size=64):
+    """ Adds the contents of file object src_f to the dedup store.
+        Returns the manifest needed to recreate them.
+    """
+    manifest = {'store': str(Path(store).resolve()), 'size': 0, 'sha256': None, 'chunks': []}
+    h = hashlib.sha256()
+    batch = []
+    try:
+        for chunk in dedup_chunks(src_f):
+            h.update(chunk)
+            digest = hashlib.sha256(chunk).hexdigest()
+            batch.append((digest, chunk))
+            if len(batch) >= batch_size:
+                dedup_add_chunks(db, store, batch)
+                manifest['chunks'].extend((d, len(c)) for d, c in batch)
+                batch = []
+        dedup_add_chunks(db, store, batch)
+        manifest['chunks'].extend((d, len(c)) for d, c in batch)
+    except BaseException:
+        dedup_release(db, store, manifest['chunks'])
+        raise
+    manifest['size'] = sum(size for _, size in manifest['chunks'])
+    manifest['sha256'] = h.hexdigest()
+    return manifest
+
+def dedup_import(db, store, rr):
+    """ Moves the snapshot of recording rr to the dedup store, replacing it
+        with its manifest. Compressed snapshots are streamed through zstd.
+        The stored snapshot is verified before the original is removed.
+        Returns the size of the snapshot, or None if there is nothing to import.
+    """
+    rr_file, rr_archive = rr_files(rr)[0]
+    manifest_path = rr_file.with_name(rr_file.name + RR_DEDUP_SUFFIX)
+    if manifest_path.exists():
+        return None
+    if rr_file.is_file():
+        with open(rr_file, 'rb') as src_f:
+            manifest = dedup_import_file(db, store, src_f)
+    elif rr_archive.is_file():
+        cmd = shlex.split(arg_format('rr-decompress', split=False, archive=shlex.quote(str(rr_archive))))
+        with subprocess.Popen(cmd, stdout=subprocess.PIPE) as proc:
+            manifest = dedup_import_file(db, store, proc.stdout)
+        if proc.returncode != 0:
+            dedup_release(db, store, manifest['chunks'])
+            raise RuntimeError('Decompressing "%s" failed with exit code %d.' % (rr_archive, proc.returncode))
+    else:
+        return None
+
+    # verify
+    h = hashlib.sha256()
+    for chunk in dedup_stream(manifest, store):
+        h.update(chunk)
+    if h.hexdigest() != manifest['sha256']:
+        dedup_release(db, store, manifest['chunks'])
+        raise RuntimeError('Verification of deduplicated "%s" failed.' % rr_file)
+
+    # replace
+    tmp = manifest_path.with_name('.%s.tmp' % manifest_path.name)
+    tmp.write_text(json.dumps(manifest) + '\n')
+    fs_sync_rename(tmp, manifest_path)
+    for f in (rr_file, rr_archive):
+        with contextlib.suppress(FileNotFoundError):
+            f.unlink()
+    return manifest['size']
+
+def dedup_materialize(manifest_path, rr_file, store=None):
+    """ Recreates rr_file from the dedup store, streaming it chunk by chunk.
+    """
+    manifest = json.loads(Path(manifest_path).read_text())
+    tmp = Path(rr_file).with_name('.%s.tmp' % Path(rr_file).name)
+    h = hashlib.sha256()
+    try:
+        with open(tmp, 'wb') as out_f:
+            for chunk in dedup_stream(manifest, store):
+                h.update(chunk)
+                out_f.write(chunk)
+        if h.hexdigest() != manifest['sha256']:
+            raise RuntimeError('Materialized "%s" does not match its manifest.' % rr_file)
+    except BaseException:
+        with contextlib.suppress(FileNotFoundError):
+            tmp.unlink()
+        raise
+    os.rename(tmp, rr_file)
+
+def rr_restore(rr, dedup_store=None):
+    """ Recreates the missing files of recording rr from their compressed
+        or deduplicated versions. Returns the list of recreated files.
+    """
+    restored = []
+    try:
+        for rr_file, rr_archive in rr_files(rr):
+            manifest = rr_file.with_name(rr_file.name + RR_DEDUP_SUFFIX)
+            if rr_file.is_file():
+                continue
+            elif rr_archive.is_file():
+                rr_decompress_file(rr_archive, rr_file)
+            elif manifest.is_file():
+                dedup_materialize(manifest, rr_file, dedup_store)
+            else:
+                continue
+            restored.append(rr_file)
+    except BaseException:
+        for rr_file in restored:
+            rr_file.unlink()
+        raise
+    return restored
+
+def replcache_open(cache):
+    """ Opens the index of the replay result cache, creating the cache if needed.
+    """
+    cache = Path(cache)
+    cache.mkdir(parents=True, exist_ok=True)
+    db = sqlite3.connect(str(cache / REPLCACHE_FORMATS['db']), timeout=60)
+    db.row_factory = sqlite3.Row
+    db.executescript(REPLCACHE_SCHEMA)
+    return db
+
+def replcache_file_hash(db, path, cmd=None):
+    """ Returns the sha256 of the file at path, or of the output of cmd
+        for path if specified. Hashes are memoized until the file changes.
+    """
+    st = os.stat(path)
+    stat = '%d:%d:%d:%d' % (st.st_dev, st.st_ino, st.st_size, st.st_mtime_ns)
+    row = db.execute('SELECT stat, sha256 FROM hashes WHERE path = ?', (str(path),)).fetchone()
+    if row is not None and row['stat'] == stat:
+        return row['sha256']
+    h = hashlib.sha256()
+    if cmd is None:
+        with open(path, 'rb') as f:
+            for chunk in iter(lambda: f.read(1 << 20), b''):
+                h.update(chunk)
+    else:
+        with subprocess.Popen(cmd, stdout=subprocess.PIPE) as proc:
+            for chunk in iter(lambda: proc.stdout.read(1 << 20), b''):
+                h.update(chunk)
+        if proc.returncode != 0:
+            raise RuntimeError('Hashing "%s" failed with exit code %d.' % (path, proc.returncode))
+    with db:
+        db.execute('INSERT OR REPLACE INTO hashes (path, stat, sha256) VALUES (?, ?, ?)',
+                (str(path), stat, h.hexdigest()))
+    return h.hexdigest()
+
+def replcache_rr_hash(db, rr):
+    """ Computes the content hash of recording rr. The hash is the same
+        whether the recording files are plain, compressed or deduplicated.
+    """
+    h = hashlib.sha256()
+    for (rr_file, rr_archive), sfx in zip(rr_files(rr), RR_SUFFIXES):
+        manifest = rr_file.with_name(rr_file.name + RR_DEDUP_SUFFIX)
+        if rr_file.is_file():
+            digest = replcache_file_hash(db, rr_file)
+        elif rr_archive.is_file():
+            cmd = shlex.split(arg_format('rr-decompress', split=False, archive=shlex.quote(str(rr_archive))))
+            digest = replcache_file_hash(db, rr_archive, cmd)
+        elif manifest.is_file():
+            digest = json.loads(manifest.read_text())['sha256']
+        else:
+            raise RuntimeError('Recording file "%s" does not exist.' % rr_file)
+        h.update(('%s:%s\n' % (sfx, digest)).encode())
+    return h.hexdigest()
+
+def replcache_plugins(spec):
+    """ Normalizes a PANDA plugin specifier, so that equivalent specifiers
+        map to the same cache entries. The order of plugins is preserved, as
+        it determines the order they are loaded in. Plugin arguments are sorted.
+    """
+    if spec is None:
+        return None
+    plugins = []
+    for plugin in filter(None, (p.strip() for p in spec.split(';'))):
+        name, _, plugin_args = plugin.partition(':')
+        plugin_args = sorted(filter(None, (a.strip() for a in plugin_args.split(','))))
+        plugins.append(':'.join([name.strip(), ','.join(plugin_args)]) if plugin_args else name.strip())
+    return ';'.join(plugins)
+
+def replcache_binary(args):
+    """ Returns the identity of the PANDA build used by args: the id of the
+        docker image, or the content hash of the PANDA binary.
+    """
+    if args.docker_image is not None:
+        proc = subprocess.run(['docker', 'image', 'inspect', '--format', '{{.Id}}', args.docker_image],
+                stdin=subprocess.DEVNULL, stdout=subprocess.PIPE, stderr=subprocess.DEVNULL, text=True)
+        if proc.returncode != 0:
+            raise RuntimeError('Could not inspect docker image "%s".' % args.docker_image)
+        return 'docker:%s' % proc.stdout.strip()
+    panda_bin = panda_find_binary(args)
+    if panda_bin is None:
+        raise RuntimeError('Could not find PANDA binary.')
+    h = hashlib.sha256()
+    with open(panda_bin, 'rb') as f:
+        for chunk in iter(lambda: f.read(1 << 20), b''):
+            h.update(chunk)
+    return 'sha256:%s' % h.hexdigest()
+
+def replcache_key(db, args, rr, binary):
+    """ Computes the cache key for replaying rr with args on binary.
+        Returns the key and the values it was computed from.
+    """
+    meta = {'rr_hash': replcache_rr_hash(db, rr), 'panda': replcache_plugins(args.panda),
+            'os': args.os, 'binary': binary}
+    return hashlib.sha256(json.dumps(meta, sort_keys=True).encode()).hexdigest(), meta
+
+def replcache_get(db, cache, key, outputs):
+    """ Copies the cached outputs for key to the paths in outputs, a dict
+        mapping output names to paths. Returns False on a cache miss.
+    """
+    entry = Path(cache) / REPLCACHE_FORMATS['entry'].format(key=key)
+    if db.execute('SELECT 1 FROM results WHERE key = ?', (key,)).fetchone() is None or not entry.is_dir():
+        return False
+    for name, path in outputs.items():
+        if (entry / name).is_file():
+            fs_clone_file(entry / name, path)
+    with db:
+        db.execute('UPDATE results SET used = ? WHERE key = ?', (time.time(), key))
+    return True
+
+def replcache_put(db, cache, key, meta, rr, outputs, cache_size):
+    """ Stores the outputs of a successful replay under key, and evicts
+        the least recently used entries over cache_size bytes.
+    """
+    entry = Path(cache) / REPLCACHE_FORMATS['entry'].format(key=key)
+    tmp = entry.with_name('.%s.tmp' % entry.name)
+    shutil.rmtree(tmp, ignore_errors=True)
+    tmp.mkdir(parents=True)
+    size = 0
+    for name, path in outputs.items():
+        if Path(path).is_file():
+            fs_clone_file(path, tmp / name)
+            size += (tmp / name).stat().st_size
+    shutil.rmtree(entry, ignore_errors=True)
+    os.rename(tmp, entry)
+    now = time.time()
+    with db:
+        db.execute('INSERT OR REPLACE INTO results (key, rr, rr_hash, panda, os, binary, size, created, used) '
+                   'VALUES (:key, :rr, :rr_hash, :panda, :os, :binary, :size, :now, :now)',
+                   dict(meta, key=key, rr=str(Path(rr).resolve()), size=size, now=now))
+    replcache_evict(db, cache, cache_size)
+
+def replcache_remove(db, cache, keys):
+    """ Removes the cache entries for keys. Returns the freed bytes.
+    """
+    freed = 0
+    for key in keys:
+        shutil.rmtree(Path(cache) / REPLCACHE_FORMATS['entry'].format(key=key), ignore_errors=True)
+        with db:
+            row = db.execute('SELECT size FROM results WHERE key = ?', (key,)).fetchone()
+            db.execute('DELETE FROM results WHERE key = ?', (key,))
+        freed += row['size'] if row is not None else 0
+    return freed
+
+def replcache_evict(db, cache, cache_size):
+    """ Evicts least recently used entries until the cache is within cache_size bytes.
+    """
+    total = db.execute('SELECT COALESCE(SUM(size), 0) FROM results').fetchone()[0]
+    expired = []
+    for row in db.execute('SELECT key, rr, size FROM results ORDER BY used'):
+        if total <= cache_size:
+            break
+        logging.info('Evicting cached replay of %s.', row['rr'])
+        expired.append(row['key'])
+        total -= row['size']
+    return replcache_remove(db, cache, expired)
+
+def pb_read_varint(buf, pos):
+    """ Decodes the protobuf varint at pos of buf.
+        Returns its value and the position after it.
+    """
+    value = shift = 0
+    while True:
+        b = buf[pos]
+        pos += 1
+        value |= (b & 0x7f) << shift
+        if b < 0x80:
+            return value, pos
+        shift += 7
+
+def pb_varint(value):
+    """ Encodes value as a protobuf varint.
+    """
+    out = bytearray()
+    while value > 0x7f:
+        out.append(value & 0x7f | 0x80)
+        value >>= 7
+    out.append(value)
+    return bytes(out)
+
+def pb_shift_field(msg, field, offset):
+    """ Adds offset to a varint field of the serialized protobuf message msg.
+        Only top-level fields are considered, so no schema is needed.
+        Returns the rewritten message.
+    """
+    pos = 0
+    while pos < len(msg):
+        key, pos = pb_read_varint(msg, pos)
+        wire_type = key & 7
+        if wire_type == 0:
+            value, end = pb_read_varint(msg, pos)
+            if key >> 3 == field:
+                return msg[:pos] + pb_varint(value + offset) + msg[end:]
+            pos = end
+        elif wire_type == 1:
+            pos += 8
+        elif wire_type == 2:
+            size, pos = pb_read_varint(msg, pos)
+            pos += size
+        elif wire_type == 5:
+            pos += 4
+        else:
+            raise ValueError('Unsupported protobuf wire type %d.' % wire_type)
+    return msg
+
+def pb_decode(msg):
+    """ Decodes the top-level fields of the serialized protobuf message msg.
+        Returns a dict mapping field numbers to values: integers for varint
+        and fixed-size fields, bytes for length-delimited fields (strings
+        and nested messages). Repeated fields keep their last value.
+    """
+    fields = {}
+    pos = 0
+    while pos < len(msg):
+        key, pos = pb_read_varint(msg, pos)
+        wire_type = key & 7
+        if wire_type == 0:
+            value, pos = pb_read_varint(msg, pos)
+        elif wire_type == 1:
+            value, = struct.unpack_from('<Q', msg, pos)
+            pos += 8
+        elif wire_type == 2:
+            size, pos = pb_read_varint(msg, pos)
+            value = bytes(msg[pos:pos + size])
+            pos += size
+        elif wire_type == 5:
+            value, = struct.unpack_from('<I', msg, pos)
+            pos += 4
+        else:
+            raise ValueError('Unsupported protobuf wire type %d.' % wire_type)
+        fields[key >> 3] = value
+    return fields
+
+def plog_read_dir(buf):
+    """ Parses the header and the chunk directory of the pandalog in buf.
+        Returns the version, the chunk size, and a list with a tuple of
+        (first instruction, offset, compressed size, number of entries)
+        for each chunk.
+    """
+    version, dir_pos, chunk_size = PLOG_HEADER.unpack_from(buf, 0)
+    nchunks, = struct.unpack_from('<I', buf, dir_pos)
+    chunks = [PLOG_DIR_ENTRY.unpack_from(buf, dir_pos + 4 + i * PLOG_DIR_ENTRY.size)
+              for i in range(nchunks)]
+    ends = [pos for _, pos, _ in chunks[1:]] + [dir_pos]
+    return version, chunk_size, [(instr, pos, end - pos, n) for (instr, pos, n), end in zip(chunks, ends)]
+
+def plog_chunk_entries(chunk):
+    """ Yields the serialized entries of a decompressed pandalog chunk.
+    """
+    pos = 0
+    while pos < len(chunk):
+        size, = struct.unpack_from('<I', chunk, pos)
+        yield chunk[pos + 4:pos + 4 + size]
+        pos += 4 + size
+
+def plog_merge(plogs, offsets, out):
+    """ Merges the pandalogs of consecutive replay segments into out.
+        The instruction counts of the entries of each pandalog are shifted
+        by the respective offset, so that they are relative to the start of
+        the original recording. Chunks of pandalogs with a zero offset are
+        copied as they are. Corrupt pandalogs raise a RuntimeError.
+    """
+    if not plogs:
+        raise RuntimeError('No pandalogs to merge.')
+    out = Path(out)
+    tmp = out.with_name('.%s.tmp' % out.name)
+    version = chunk_size = None
+    directory = []
+    try:
+        with open(tmp, 'wb') as out_f:
+            out_f.write(bytes(PLOG_HEADER.size))
+            for plog, offset in zip(plogs, offsets):
+                try:
+                    with open(plog, 'rb') as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as buf:
+                        v, cs, chunks = plog_read_dir(buf)
+                        if version is not None and v != version:
+                            raise RuntimeError('Pandalog "%s" has version %d instead of %d.' % (plog, v, version))
+                        version, chunk_size = v, max(cs, chunk_size or 0)
+                        for instr, pos, size, n in chunks:
+                            data = buf[pos:pos + size]
+                            if offset:
+                                entries = plog_chunk_entries(zlib.decompress(data))
+                                chunk = b''.join(struct.pack('<I', len(e)) + e for e in
+                                        (pb_shift_field(e, PLOG_INSTR_FIELD, offset) for e in entries))
+                                # shifted varints may grow - readers size their buffers by the chunk size
+                                chunk_size = max(chunk_size, len(chunk))
+                                data = zlib.compress(chunk)
+                            directory.append((instr + offset, out_f.tell(), n))
+                            out_f.write(data)
+                except (zlib.error, struct.error, ValueError, IndexError) as e:
+                    raise RuntimeError('Pandalog "%s" is corrupt: %s' % (plog, e)) from None
+            dir_pos = out_f.tell()
+            out_f.write(struct.pack('<I', len(directory)))
+            for entry in directory:
+                out_f.write(PLOG_DIR_ENTRY.pack(*entry))
+            out_f.seek(0)
+            out_f.write(PLOG_HEADER.pack(version, dir_pos, chunk_size))
+    except BaseException:
+        with contextlib.suppress(FileNotFoundError):
+            tmp.unlink()
+        raise
+    os.rename(tmp, out)
+
+class PlogReader:
+    """ Streaming reader for chunked pandalogs, using a memory-mapped file.
+        Chunks are decompressed one at a time, so memory use does not depend
+        on the size of the pandalog. The chunk directory of the pandalog is
+        used as an index for seeking by instruction count.
+        Entries are decoded without a schema (see pb_decode()).
+    """
+    def __init__(self, path):
+        self.path = Path(path)
+        self.file = open(self.path, 'rb')
+        try:
+            self.buf = mmap.mmap(self.file.fileno(), 0, access=mmap.ACCESS_READ)
+            self.version, self.chunk_size, self.chunks = plog_read_dir(self.buf)
+        except (ValueError, struct.error):
+            self.file.close()
+            raise ValueError('"%s" is not a chunked pandalog.' % path) from None
+        self.chunk_instrs = [instr for instr, _, _, _ in self.chunks]
+
+    def __len__(self):
+        return sum(n for _, _, _, n in self.chunks)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def close(self):
+        """ Unmaps and closes the pandalog.
+        """
+        self.buf.close()
+        self.file.close()
+
+    def entries(self, start=None, end=None):
+        """ Yields the decoded entries with instruction counts in [start, end).
+            Decoding starts from the last chunk beginning before start.
+        """
+        first = 0 if start is None else max(bisect.bisect_left(self.chunk_instrs, start) - 1, 0)
+        for instr, pos, size, _ in self.chunks[first:]:
+            if end is not None and instr >= end:
+                return
+            for msg in plog_chunk_entries(zlib.decompress(self.buf[pos:pos + size])):
+                entry = pb_decode(msg)
+                entry_instr = entry.get(PLOG_INSTR_FIELD, 0)
+                if start is not None and entry_instr < start:
+                    continue
+                if end is not None and entry_instr >= end:
+                    return
+                yield entry
+
+def plog_export(reader, out_dir, batch_size=1 << 16):
+    """ Exports the entries of reader to out_dir as a NumPy array per field.
+        Integer fields are stored as pc.npy, instr.npy and f<N>.npy, with
+        zeros for entries lacking the field. Length-delimited fields are
+        concatenated in f<N>.bin, with the offsets of each entry in
+        f<N>.off.npy. The field numbers present in each entry are stored as
+        a bitmask in fields.npy. Arrays are written through memory maps, in
+        batches of batch_size entries. Returns the number of entries.
+    """
+    numpy = import_numpy()
+    out_dir = Path(out_dir)
+    out_dir.mkdir(parents=True, exist_ok=True)
+    nrows = len(reader)
+    names = {PLOG_PC_FIELD: 'pc', PLOG_INSTR_FIELD: 'instr'}
+    arrays = {}
+    blobs = {}
+
+    def array(name, size=nrows):
+        if name not in arrays:
+            arrays[name] = numpy.lib.format.open_memmap(out_dir / ('%s.npy' % name),
+                    mode='w+', dtype=numpy.uint64, shape=(size,))
+        return arrays[name]
+
+    def flush(batch, row):
+        mask = [0] * len(batch)
+        ints = collections.defaultdict(lambda: ([], []))
+        lens = collections.defaultdict(lambda: numpy.zeros(len(batch), dtype=numpy.uint64))
+        data = collections.defaultdict(list)
+        for i, entry in enumerate(batch):
+            for f, v in entry.items():
+                if f < 64:
+                    mask[i] |= 1 << f
+                if isinstance(v, bytes):
+                    lens[f][i] = len(v)
+                    data[f].append(v)
+                else:
+                    ints[f][0].append(i)
+                    ints[f][1].append(v)
+        array('fields')[row:row + len(batch)] = mask
+        for f, (idx, vals) in ints.items():
+            array(names.get(f, 'f%d' % f))[row + numpy.array(idx, dtype=numpy.int64)] = vals
+        for f in data.keys() - blobs.keys():
+            blobs[f] = [open(out_dir / ('f%d.bin' % f), 'wb'), 0]
+            array('f%d.off' % f, nrows + 1)
+        # offsets of fields missing from this batch still need to be filled in
+        for f, blob in blobs.items():
+            blob[0].write(b''.join(data.get(f, [])))
+            offsets = numpy.cumsum(lens[f]) + blob[1]
+            arrays['f%d.off' % f][row + 1:row + len(batch) + 1] = offsets
+            blob[1] = int(offsets[-1])
+
+    row = 0
+    batch = []
+    try:
+        for entry in reader.entries():
+            batch.append(entry)
+            if len(batch) == batch_size:
+                flush(batch, row)
+                row += len(batch)
+                batch = []
+        if batch:
+            flush(batch, row)
+            row += len(batch)
+    finally:
+        for arr in arrays.values():
+            arr.flush()
+        for f, blob in blobs.items():
+            blob[0].close()
+    meta = {'plog': str(reader.path), 'version': reader.version, 'entries': row,
+            'arrays': sorted(arrays)}
+    (out_dir / 'meta.json').write_text(json.dumps(meta, indent=2) + '\n')
+    return row
+
+def catalog_open(path):
+    """ Opens the run catalog at path, creating it if needed.
+    """
+    db = sqlite3.connect(str(path))
+    db.row_factory = sqlite3.Row
+    db.executescript(CATALOG_SCHEMA)
+    return db
+
+def catalog_scan_run(run_dir):
+    """ Collects the catalog information for the run in run_dir.
+        Launch information comes from the files written by honeypot.sh or
+        the fleet mode: sshfwd.txt, cmd.txt and timings.json.
+    """
+    run_dir = Path(run_dir)
+    info = {'run_id': run_dir.name, 'path': str(run_dir.resolve()),
+            'mtime_ns': run_dir.stat().st_mtime_ns}
+    mtimes = []
+
+    # launch info
+    with contextlib.suppress(OSError, ValueError):
+        _, info['process'], port = (run_dir / 'sshfwd.txt').read_text().strip().split(':')
+        info['port'] = int(port)
+    with contextlib.suppress(OSError):
+        info['cmd'] = (run_dir / 'cmd.txt').read_text().strip()
+        info['start_time'] = (run_dir / 'cmd.txt').stat().st_mtime
+
+    # recording sizes - compressed sizes are used for compressed files
+    recordings = rr_find_recordings([run_dir])[0]
+    info.update(nrec=len(recordings), snp_size=0, nondet_size=0, compressed=0)
+    for rr in recordings:
+        for (rr_file, rr_archive), key in zip(rr_files(rr), ('snp_size', 'nondet_size')):
+            for f in (rr_file, rr_archive):
+                with contextlib.suppress(FileNotFoundError):
+                    st = f.stat()
+                    info[key] += st.st_size
+                    info['compressed'] |= f is rr_archive
+                    mtimes.append(st.st_mtime)
+
+    # completion
+    try:
+        info['end_time'] = (run_dir / 'timings.json').stat().st_mtime
+        info['complete'] = 1
+    except FileNotFoundError:
+        latest = max(mtimes, default=info.get('start_time'))
+        info['complete'] = int(latest is not None and time.time() - latest > CATALOG_STALE_AGE)
+        info['end_time'] = latest if info['complete'] else None
+    return info
+
+def catalog_refresh(db, rr_root):
+    """ Brings the catalog up to date with the run directories in rr_root.
+        Only directories that have been modified since they were last
+        scanned, or that belong to runs that have not completed, are
+        rescanned. Returns the number of rescanned directories.
+    """
+    known = {row['run_id']: row for row in db.execute('SELECT run_id, mtime_ns, complete FROM runs')}
+    seen = set()
+    scanned = 0
+    with db:
+        for entry in os.scandir(rr_root):
+            if not entry.is_dir():
+                continue
+            seen.add(entry.name)
+            row = known.get(entry.name)
+            if row is not None and row['complete'] and row['mtime_ns'] == entry.stat().st_mtime_ns:
+                continue
+            info = catalog_scan_run(entry.path)
+            cols = ', '.join(info)
+            updates = ', '.join('%s = excluded.%s' % (k, k) for k in info if k != 'run_id')
+            db.execute('INSERT INTO runs (%s) VALUES (%s) ON CONFLICT (run_id) DO UPDATE SET %s' % (
+                    cols, ', '.join('?' * len(info)), updates), tuple(info.values()))
+            scanned += 1
+        gone = [(run_id,) for run_id in known if run_id not in seen]
+        db.executemany('DELETE FROM runs WHERE run_id = ?', gone)
+    logging.info('Rescanned %d of %d runs, removed %d.', scanned, len(seen), len(gone))
+    return scanned
+
+def catalog_set_replay(db, rr, status):
+    """ Records the replay status for the run containing recording rr.
+    """
+    with db:
+        db.execute('UPDATE runs SET replay_status = ?, replay_time = ? WHERE path = ?',
+                (status, time.time(), str(Path(rr).parent.resolve())))
+
+def queue_open(path):
+    """ Opens the job queue at path, creating it if needed.
+        Transactions are managed explicitly, so that leases are taken atomically.
+    """
+    db = sqlite3.connect(str(path), timeout=60, isolation_level=None)
+    db.row_factory = sqlite3.Row
+    db.executescript(QUEUE_SCHEMA)
+    return db
+
+def queue_enqueue(db, mode, recordings, argv, cwd):
+    """ Adds a job running mode on each of the recordings. Recordings that
+        already have a job for mode are skipped. argv holds the global
+        arguments and the mode arguments of the jobs, which run in cwd.
+        Recording paths are stored as absolute paths, so that jobs and
+        duplicates are found independently of the working directory.
+        Returns the number of new jobs.
+    """
+    global_argv, mode_argv = argv
+    now = time.time()
+    db.execute('BEGIN IMMEDIATE')
+    try:
+        n = 0
+        for rr in recordings:
+            rr = Path(rr).resolve()
+            job_argv = [*global_argv, mode, '--rr', str(rr), *mode_argv]
+            n += db.execute('INSERT OR IGNORE INTO jobs (mode, rr, argv, cwd, created) VALUES (?, ?, ?, ?, ?)',
+                    (mode, str(rr), json.dumps(job_argv), str(cwd), now)).rowcount
+        db.execute('COMMIT')
+    except BaseException:
+        db.execute('ROLLBACK')
+        raise
+    return n
+
+def queue_lease(db, worker, lease, max_attempts):
+    """ Leases the next runnable job to worker for lease seconds. Jobs whose
+        lease expired are runnable again, unless they ran out of attempts.
+        Returns the job row, or None if there is nothing to run.
+    """
+    now = time.time()
+    db.execute('BEGIN IMMEDIATE')
+    try:
+        db.execute("UPDATE jobs SET state = 'failed', finished = ?, error = 'lease expired' "
+                   "WHERE state = 'leased' AND lease_until < ? AND attempts >= ?", (now, now, max_attempts))
+        job = db.execute("SELECT * FROM jobs WHERE (state = 'pending' AND not_before <= ?) "
+                         "OR (state = 'leased' AND lease_until < ?) ORDER BY id LIMIT 1", (now, now)).fetchone()
+        if job is not None:
+            if job['state'] == 'leased':
+                logging.warning('Lease of job %d by %s expired. Retrying.', job['id'], job['worker'])
+            db.execute("UPDATE jobs SET state = 'leased', worker = ?, lease_until = ?, attempts = attempts + 1 "
+                       "WHERE id = ?", (worker, now + lease, job['id']))
+            job = dict(job, state='leased', worker=worker, attempts=job['attempts'] + 1)
+        db.execute('COMMIT')
+    except BaseException:
+        db.execute('ROLLBACK')
+        raise
+    return job
+
+def queue_heartbeat(db, job_id, worker, lease):
+    """ Extends the lease of worker on a job. Returns False if the lease was lost.
+    """
+    cur = db.execute("UPDATE jobs SET lease_until = ? WHERE id = ? AND worker = ? AND state = 'leased'",
+            (time.time() + lease, job_id, worker))
+    return cur.rowcount == 1
+
+def queue_finish(db, job, worker, rc, error, max_attempts, retry_delay):
+    """ Records the result of a job leased by worker. Failed jobs are retried
+        with exponential backoff until they run out of attempts.
+        Returns the new state of the job, or None if the lease was lost.
+    """
+    now = time.time()
+    if rc == 0:
+        state, not_before = 'done', 0
+    elif job['attempts'] < max_attempts:
+        state, not_before = 'pending', now + retry_delay * 2 ** (job['attempts'] - 1)
+    else:
+        state, not_before = 'failed', 0
+    cur = db.execute("UPDATE jobs SET state = ?, not_before = ?, finished = ?, exit_code = ?, error = ?, "
+                     "lease_until = NULL WHERE id = ? AND worker = ? AND state = 'leased'",
+                     (state, not_before, now, rc, error, job['id'], worker))
+    return state if cur.rowcount == 1 else None
+
+def queue_release(db, job, worker):
+    """ Returns a job leased by worker to the queue, without counting the attempt.
+    """
+    db.execute("UPDATE jobs SET state = 'pending', attempts = attempts - 1, worker = NULL, lease_until = NULL "
+               "WHERE id = ? AND worker = ? AND state = 'leased'", (job['id'], worker))
+
+def fs_open_files():
+    """ Returns the (device, inode) pairs of all files open by any process.
+        Only the processes whose /proc/<pid>/fd the current user can read are
+        considered, i.e. unless running as root, files held open by the
+        processes of other users are missed.
+    """
+    open_files = set()
+    for fd_dir in Path('/proc').glob('[0-9]*/fd'):
+        try:
+            fds = list(fd_dir.iterdir())
+        except OSError:
+            continue
+        for fd in fds:
+            with contextlib.suppress(OSError):
+                st = fd.stat()
+                open_files.add((st.st_dev, st.st_ino))
+    return open_files
+
+def run_is_active(rr_root, run_id):
+    """ Checks whether the run with run_id may still be launched or running.
+        This is the case if its run directory has no timing file yet and has
+        been modified recently.
+    """
+    run_dir = Path(rr_root) / run_id
+    try:
+        mtime = run_dir.stat().st_mtime
+    except FileNotFoundError:
+        return False
+    return not (run_dir / 'timings.json').exists() and time.time() - mtime < CATALOG_STALE_AGE
+
+def gc_candidates(args):
+    """ Collects the per-run artifacts that can be garbage collected.
+        Returns a dict mapping each kind of artifact to a list of
+        (path, run_id, mtime, size) tuples.
+    """
+    base_disk = Path(args.disk)
+    pool_glob = POOL_FORMATS['ready'].format(stem=base_disk.stem, suffix=base_disk.suffix, token='*')
+    candidates = {'overlay': [], 'usbdisk': [], 'bootstrap': []}
+
+    # derived disks and usb disks live next to the base image or in the overlay dir
+    qcow_dirs = [base_disk.parent]
+    if args.overlay_dir is not None and qemu_backing_ref(base_disk, args.overlay_dir) != base_disk.name:
+        qcow_dirs.append(args.overlay_dir)
+    for qcow_dir in qcow_dirs:
+        pool = set(qcow_dir.glob(pool_glob))
+        for p in qcow_dir.glob('%s.*%s' % (base_disk.stem, base_disk.suffix)):
+            # overlays used in docker reference the base image by its path in the container
+            if p in pool or p.name in (base_disk.name, qemu_resume_name(base_disk).name) or Path(qcow_backing_file(p) or '').name != base_disk.name:
+                continue
+            st = p.stat()
+            run_id = p.name[len(base_disk.stem) + 1:-len(base_disk.suffix) or None]
+            candidates['overlay'].append((p, run_id, st.st_mtime, st.st_blocks * 512))
+        for p in qcow_dir.glob('usbdisk.*.img'):
+            st = p.stat()
+            candidates['usbdisk'].append((p, p.name[len('usbdisk.'):-len('.img')], st.st_mtime, st.st_blocks * 512))
+
+    # bootstrap directories
+    if Path(args.bs_root).is_dir():
+        for p in Path(args.bs_root).iterdir():
+            # skip the key pool and directories still being assembled
+            if not p.is_dir() or p.name.startswith('.'):
+                continue
+            size = sum(f.stat().st_blocks * 512 for f in p.rglob('*') if f.is_file())
+            candidates['bootstrap'].append((p, p.name, p.stat().st_mtime, size))
+    return candidates
+
+def gc_select(items, max_age=None, keep_count=None, max_size=None):
+    """ Applies the retention policies to a list of (path, run_id, mtime, size)
+        tuples. Items are expired if they are older than max_age seconds, if
+        they are not among the newest keep_count items, or if they are the
+        oldest items that make the total size exceed max_size bytes.
+        Returns the expired items.
+    """
+    items = sorted(items, key=lambda i: i[2], reverse=True)
+    now = time.time()
+    expired = set()
+    total = 0
+    for n, (path, run_id, mtime, size) in enumerate(items):
+        total += size
+        if max_age is not None and now - mtime > max_age:
+            expired.add(path)
+        elif keep_count is not None and n >= keep_count:
+            expired.add(path)
+        elif max_size is not None and total > max_size:
+            expired.add(path)
+    return [i for i in items if i[0] in expired]
+
+def gc_delete_overlay(args):
+    """ Deletes the derived disk and usb disk image created for a run.
+    """
+    for p in (getattr(args, 'derived_disk', None), getattr(args, 'usbdisk_image', None)):
+        if p is None:
+            continue
+        logging.info('Deleting "%s".', p)
+        with contextlib.suppress(FileNotFoundError):
+            Path(p).unlink()
+
+def repl_run_one(cmd, logfile, rr=None, dedup_store=None):
+    """ Runs a single replay command, logging its output to logfile.
+        Compressed or deduplicated files of recording rr are restored before
+        the replay, and removed after it. PANDA needs to seek in the recording
+        files, so they cannot be streamed to it directly.
+        Returns the exit code of the command and the elapsed time.
+    """
+    t_start = time.monotonic()
+    restored = []
+    try:
+        if rr is not None:
+            restored = rr_restore(rr, dedup_store)
+        with open(logfile, 'wb') as log_f:
+            rc = subprocess.call(cmd, stdin=subprocess.DEVNULL,
+                    stdout=log_f, stderr=subprocess.STDOUT)
+    finally:
+        for rr_file in restored:
+            rr_file.unlink()
+    return rc, time.monotonic() - t_start
+
+def repl_run_split(args, logfile):
+    """ Replays recording args.rr as args.segments segments, using up to
+        args.jobs workers. Segments are cut with the scissors plugin, and
+        each one is replayed as soon as it has been cut. The pandalogs of
+        the segments are named after the segments, independent of args.plog,
+        and are merged in order into args.plog. Their output is collected
+        in logfile. Returns the exit code of the first failed PANDA
+        process, if any, and the elapsed time.
+    """
+    t_start = time.monotonic()
+    rr = Path(args.rr)
+    nseg = args.segments
+    fmt_args = [{'name': rr.name, 'index': i} for i in range(nseg)]
+    segments = [rr.with_name(SPLIT_FORMATS['segment'].format(**fa)) for fa in fmt_args]
+    cut_logs = [rr.with_name(SPLIT_FORMATS['cut-log'].format(**fa)) for fa in fmt_args]
+    plogs = [rr.with_name(SPLIT_FORMATS['plog'].format(**fa)) for fa in fmt_args]
+    logs = [rr.with_name(SPLIT_FORMATS['log'].format(**fa)) for fa in fmt_args]
+    plog = Path(args.plog.format(rr=rr))
+    restored = []
+    rc = 0
+    cuts, replays = {}, {}
+    executor = concurrent.futures.ThreadPoolExecutor(max_workers=args.jobs)
+    try:
+        # all cuts read the recording - restore it once
+        restored = rr_restore(rr, args.dedup_store)
+        ninstr = rr_instr_count(rr)
+        bounds = [ninstr * i // nseg for i in range(nseg + 1)]
+        logging.info('Splitting %s (%d instructions) into %d segments.', rr, ninstr, nseg)
+
+        for i, seg in enumerate(segments):
+            sargs = copy.deepcopy(args)
+            sargs.run_id = '%s-%03d' % (args.run_id, i)
+            sargs.panda = sargs.plog = None
+            cmd = prov2r_make_command(sargs)
+            cmd.extend(['-panda', SPLIT_FORMATS['scissors'].format(start=bounds[i], end=bounds[i + 1],
+                    segment=sargs.replay.with_name(seg.name))])
+            cuts[executor.submit(repl_run_one, cmd, cut_logs[i])] = i
+
+        # replay segments as they become available
+        offsets = [0] * nseg
+        for f in concurrent.futures.as_completed(cuts):
+            i = cuts[f]
+            cut_rc, elapsed = f.result()
+            if cut_rc != 0:
+                raise RuntimeError('Cutting segment %d failed with exit code %d. See "%s".' % (i, cut_rc, cut_logs[i]))
+            # scissors may start a segment slightly after the requested instruction
+            offsets[i] = bounds[i + 1] - rr_instr_count(segments[i])
+            logging.debug('Cut segment %d of %s in %.1fs.', i, rr, elapsed)
+            sargs = copy.deepcopy(args)
+            sargs.rr = segments[i]
+            sargs.plog = str(plogs[i]).replace('{', '{{').replace('}', '}}')
+            sargs.run_id = '%s-%03d' % (args.run_id, i)
+            replays[executor.submit(repl_run_one, prov2r_make_command(sargs), logs[i])] = i
+        for f in concurrent.futures.as_completed(replays):
+            i = replays[f]
+            seg_rc, elapsed = f.result()
+            logging.debug('Replayed segment %d of %s in %.1fs.', i, rr, elapsed)
+            if seg_rc != 0 and rc == 0:
+                rc = seg_rc
+
+        if rc == 0:
+            plog_merge(plogs, offsets, plog)
+    finally:
+        for f in [*cuts, *replays]:
+            f.cancel()
+        executor.shutdown(wait=True)
+        with open(logfile, 'wb') as log_f:
+            for log in [*cut_logs, *logs]:
+                if log.is_file() and log != Path(logfile):
+                    log_f.write(b'### %s\n' % str(log).encode())
+                    log_f.write(log.read_bytes())
+        to_delete = restored if args.keep_segments else [*restored, *cut_logs, *logs, *plogs,
+                *(rr_file for seg in segments for rr_file, _ in rr_files(seg))]
+        for p in to_delete:
+            if p in (plog, Path(logfile)):
+                continue
+            with contextlib.suppress(FileNotFoundError):
+                p.unlink()
+    return rc, time.monotonic() - t_start
+
+def prov2r_run(args):
+    """ Runs the PANDA command for a single recording or maintenance session.
+        The duration of each launch phase is written to the timing file.
+    """
+    with timed(args, 'admission'):
+        if not admission_wait(args, args_rr_dir(args)):
+            return 1
+    with timed(args, 'make-command'):
+        cmd = prov2r_make_command(args)
+
+    # recordings that exist before the launch are not compressed afterwards
+    if getattr(args, 'compress', False):
+        rr_before = set(rr_dir_recordings(args_rr_dir(args)))
+
+    t_start = time.monotonic()
+    proc = subprocess.Popen(cmd)
+    args.phase_times['spawn'] = time.monotonic() - t_start
+
+    # probe the forwarded port in the background
+    ready = {}
+    stop = threading.Event()
+    target = probe_target(args) if args.probe_ready else None
+    if target is not None:
+        probe = lambda: ready.update(time=probe_port(*target, args.probe_timeout, stop))
+        prober = threading.Thread(target=probe, daemon=True)
+        prober.start()
+    elif args.probe_ready:
+        logging.warning('No forwarded port to probe.')
+
+    # attach the bootstrap disk once the snapshot has been resumed
+    if getattr(args, 'loadvm', None) is not None and args.usbdisk is not None:
+        def attach():
+            async def attach_qmp():
+                qmp = QMPClient()
+                await qmp.connect(args.qmp, timeout=args.qmp_timeout)
+                try:
+                    await qmp_attach_usbdisk(qmp, args.usbdisk)
+                finally:
+                    await qmp.close()
+            try:
+                asyncio.run(attach_qmp())
+                args.phase_times['attach'] = time.monotonic() - t_start
+            except (OSError, QMPError) as e:
+                logging.error('Failed to attach USB disk "%s": %s', args.usbdisk, e)
+                proc.terminate()
+        threading.Thread(target=attach, daemon=True).start()
+
+    rc = proc.wait()
+    args.phase_times['run'] = time.monotonic() - t_start
+    if target is not None:
+        stop.set()
+        prober.join()
+        args.phase_times['ready'] = ready.get('time')
+    timing_write(args, exit_code=rc)
+    docker_pool_release(args)
+    if getattr(args, 'delete_overlay', False):
+        gc_delete_overlay(args)
+
+    # compress the recordings of this run without delaying the next launch
+    if getattr(args, 'compress', False):
+        recordings = [rr for rr in rr_dir_recordings(args_rr_dir(args)) if rr not in rr_before]
+    else:
+        recordings = []
+    if recordings:
+        cmd = [sys.executable, str(Path(__file__).resolve()), *['-v'] * args.verbose,
+               'compress', '--wait', '--min-age=%d' % RR_COMPRESS_MIN_AGE,
+               '--compress-level=%d' % args.compress_level,
+               '--compress-threads=%d' % args.compress_threads,
+               '--rr', *[str(rr) for rr in recordings]]
+        logging.info('Compressing %d recordings in the background.', len(recordings))
+        subprocess.Popen(cmd, stdin=subprocess.DEVNULL, start_new_session=True)
+
+def prov2r_run_repl(args):
+    """ Replays a batch of recordings on a bounded pool of workers.
+        Each worker runs a single PANDA process at a time. Progress and
+        failures are reported per recording. With a replay cache, the outputs
+        of previous replays are reused instead of replaying again.
+        Returns a non-zero exit code if any of the recordings could not be
+        replayed.
+    """
+    recordings, unresolved = rr_find_recordings(args.rr)
+    for spec in unresolved:
+        logging.error('No recordings found for "%s".', spec)
+    if not recordings:
+        logging.error('Nothing to replay.')
+        return 1
+    if len(recordings) > 1 and args.plog.format(rr='') == args.plog:
+        logging.error('Pandalog "%s" would be shared by %d recordings. Use {rr} in its name.',
+                args.plog, len(recordings))
+        return 1
+    if args.jobs < 1:
+        logging.error('Invalid number of workers: %d.', args.jobs)
+        return 1
+    if args.segments < 1:
+        logging.error('Invalid number of segments: %d.', args.segments)
+        return 1
+    logging.info('Replaying %d recordings using %d workers.', len(recordings), args.jobs)
+
+    # results of replays with the same recording, plugins and PANDA build are reused
+    cache = None
+    if args.replay_cache is not None:
+        try:
+            cache = replcache_open(args.replay_cache)
+            binary = replcache_binary(args)
+        except (OSError, RuntimeError, sqlite3.Error) as e:
+            logging.error('Could not use replay cache "%s": %s', args.replay_cache, e)
+            return 1
+    db = catalog_open(args.catalog) if args.catalog is not None else None
+
+    # prepare commands - the order is important, run-ids are based on it
+    # split recordings are replayed one at a time, with their segments on all workers
+    jobs = {}
+    keys = {}
+    cached = 0
+    for i, rr in enumerate(recordings):
+        rargs = copy.deepcopy(args)
+        rargs.rr = rr
+        rargs.run_id = '%05d-%04d' % (os.getpid(), i)
+        logfile = Path(args.plog.format(rr=rr)).with_suffix('.log')
+        if cache is not None:
+            outputs = {'plog': Path(args.plog.format(rr=rr)), 'log': logfile}
+            try:
+                key, meta = replcache_key(cache, args, rr, binary)
+            except (OSError, RuntimeError, ValueError) as e:
+                logging.warning('Could not compute the replay cache key of %s: %s', rr, e)
+            else:
+                if replcache_get(cache, args.replay_cache, key, outputs):
+                    logging.info('Using cached replay of %s.', rr)
+                    cached += 1
+                    if db is not None:
+                        catalog_set_replay(db, rr, 'ok')
+                    continue
+                keys[rr] = (key, meta, outputs)
+        if args.segments > 1:
+            jobs[rr] = (functools.partial(repl_run_split, rargs, logfile), logfile)
+        else:
+            jobs[rr] = (functools.partial(repl_run_one, prov2r_make_command(rargs), logfile, rr, args.dedup_store),
+                        logfile)
+
+    # run commands and report progress
+    failed = 0
+    ndone = 0
+    with concurrent.futures.ThreadPoolExecutor(max_workers=1 if args.segments > 1 else args.jobs) as executor:
+        futures = {executor.submit(job): rr for rr, (job, logfile) in jobs.items()}
+        try:
+            for f in concurrent.futures.as_completed(futures):
+                rr = futures[f]
+                ndone += 1
+                try:
+                    rc, elapsed = f.result()
+                except (OSError, RuntimeError) as e:
+                    rc, elapsed = None, 0
+                    logging.error('[%d/%d] Failed to replay %s: %s', ndone, len(jobs), rr, e)
+                if db is not None:
+                    catalog_set_replay(db, rr, 'ok' if rc == 0 else 'failed')
+                if rc == 0:
+                    logging.info('[%d/%d] Replayed %s in %.1fs.', ndone, len(jobs), rr, elapsed)
+                    if rr in keys:
+                        key, meta, outputs = keys[rr]
+                        try:
+                            replcache_put(cache, args.replay_cache, key, meta, rr, outputs,
+                                    args.replay_cache_size << 20)
+                        except (OSError, sqlite3.Error) as e:
+                            logging.warning('Could not cache the replay of %s: %s', rr, e)
+                    continue
+                failed += 1
+                if rc is not None:
+                    logging.error('[%d/%d] Replay of %s failed with exit code %d after %.1fs. See "%s".',
+                            ndone, len(jobs), rr, rc, elapsed, jobs[rr][1])
+        except KeyboardInterrupt:
+            logging.warning('Interrupted. Cancelling %d pending replays.', len(jobs) - ndone)
+            for f in futures:
+                f.cancel()
+            executor.shutdown(wait=True)
+            raise
+
+    logging.log(logging.ERROR if failed else logging.INFO,
+            'Replayed %d recordings, %d failed, %d cached.', len(jobs), failed, cached)
+    return 1 if failed or unresolved else 0
+
+def prov2r_run_plog(args):
+    """ Streams the entries of a pandalog as JSON lines, or exports them
+        as NumPy arrays.
+    """
+    if args.export is not None and import_numpy() is None:
+        logging.error('Exporting pandalogs requires NumPy.')
+        return 1
+    try:
+        reader = PlogReader(args.plog_file)
+    except (OSError, ValueError) as e:
+        logging.error('Could not open pandalog: %s', e)
+        return 1
+    with reader:
+        logging.info('Pandalog "%s": version %d, %d entries in %d chunks.',
+                reader.path, reader.version, len(reader), len(reader.chunks))
+        if args.export is not None:
+            t_start = time.monotonic()
+            n = plog_export(reader, args.export, args.batch_size)
+            logging.info('Exported %d entries to "%s" in %.1fs.', n, args.export, time.monotonic() - t_start)
+            return 0
+        for entry in reader.entries(args.start_instr, args.end_instr):
+            print(json.dumps({k: v.hex() if isinstance(v, bytes) else v for k, v in entry.items()}))
+
+def prov2r_run_catalog(args):
+    """ Refreshes the run catalog and prints the paths of the selected runs.
+    """
+    if not Path(args.rr_root).is_dir():
+        logging.error('Directory "%s" does not exist.', args.rr_root)
+        return 1
+    db = catalog_open(args.catalog or Path(args.rr_root) / 'catalog.sqlite')
+    t_start = time.monotonic()
+    catalog_refresh(db, args.rr_root)
+    logging.info('Catalog refreshed in %.3fs.', time.monotonic() - t_start)
+    if args.select is not None:
+        # args.select is a trusted SQL fragment, interpolated as given.
+        # The authorizer keeps it from doing more than reading the catalog.
+        def authorizer(action, *_):
+            if action in (sqlite3.SQLITE_SELECT, sqlite3.SQLITE_READ, sqlite3.SQLITE_FUNCTION):
+                return sqlite3.SQLITE_OK
+            return sqlite3.SQLITE_DENY
+        db.set_authorizer(authorizer)
+        try:
+            for row in db.execute('SELECT path FROM runs WHERE %s ORDER BY run_id' % args.select):
+                print(row['path'])
+        except sqlite3.Error as e:
+            logging.error('Invalid selection "%s": %s', args.select, e)
+            return 1
+        finally:
+            db.set_authorizer(None)
+
+def prov2r_run_compress(args):
+    """ Compresses a batch of recordings on a pool of workers.
+        Recordings modified in the last args.min_age seconds are skipped,
+        as they may still be written to. With args.wait, they are compressed
+        once they have been left untouched for that long instead.
+    """
+    if shutil.which('zstd') is None:
+        logging.error('Could not find zstd in shell path.')
+        return 1
+    recordings, unresolved = rr_find_recordings(args.rr)
+    for spec in unresolved:
+        logging.error('No recordings found for "%s".', spec)
+
+    # select recordings with uncompressed files that are not being written
+    def rr_age(rr):
+        mtimes = [f.stat().st_mtime for f, _ in rr_files(rr) if f.is_file()]
+        return time.time() - max(mtimes) if mtimes else None
+    pending = []
+    for rr in recordings:
+        age = rr_age(rr)
+        while args.wait and age is not None and age < args.min_age:
+            logging.info('Waiting for recently modified recording %s.', rr)
+            time.sleep(args.min_age - age)
+            age = rr_age(rr)
+        if age is None:
+            continue
+        elif age < args.min_age:
+            logging.info('Skipping recently modified recording %s.', rr)
+        else:
+            pending.append(rr)
+    logging.info('Compressing %d recordings using %d workers.', len(pending), args.jobs)
+
+    failed = 0
+    with concurrent.futures.ThreadPoolExecutor(max_workers=args.jobs) as executor:
+        futures = {executor.submit(rr_compress, rr, args.compress_level, args.compress_threads): rr
+                   for rr in pending}
+        for f in concurrent.futures.as_completed(futures):
+            try:
+                f.result()
+            except (OSError, RuntimeError) as e:
+                logging.error('Failed to compress %s: %s', futures[f], e)
+                failed += 1
+    return 1 if failed or unresolved else 0
+
+def prov2r_run_repl_cache(args):
+    """ Lists the entries of the replay cache as JSON lines, or removes them
+        with --invalidate. Entries can be selected by recording path and by
+        plugin specifier. The cache is trimmed to its size limit afterwards,
+        and memoized hashes of deleted recording files are dropped.
+    """
+    if args.replay_cache is None:
+        logging.error('No replay cache specified.')
+        return 1
+    db = replcache_open(args.replay_cache)
+    panda = replcache_plugins(args.panda)
+    prefixes = [Path(p).resolve() for p in args.invalidate or []]
+    selected = []
+    for row in db.execute('SELECT * FROM results ORDER BY used'):
+        if panda is not None and row['panda'] != panda:
+            continue
+        rr = Path(row['rr'])
+        if prefixes and not any(rr == p or p in rr.parents for p in prefixes):
+            continue
+        selected.append(row)
+
+    if args.invalidate is None:
+        for row in selected:
+            print(json.dumps(dict(row)))
+    else:
+        freed = replcache_remove(db, args.replay_cache, [row['key'] for row in selected])
+        logging.info('Invalidated %d cached replays (%.1fMiB).', len(selected), freed / (1 << 20))
+    replcache_evict(db, args.replay_cache, args.replay_cache_size << 20)
+
+    # forget the hashes of recording files that no longer exist
+    stale = [(row['path'],) for row in db.execute('SELECT path FROM hashes') if not Path(row['path']).exists()]
+    with db:
+        db.executemany('DELETE FROM hashes WHERE path = ?', stale)
+
+def prov2r_run_dedup(args):
+    """ Moves the snapshots of a batch of recordings to the dedup store on a
+        pool of workers, or releases them from it with --release. Recordings
+        modified in the last args.min_age seconds are skipped.
+    """
+    if args.dedup_store is None:
+        logging.error('No dedup store specified.')
+        return 1
+    recordings, unresolved = rr_find_recordings(args.rr)
+    for spec in unresolved:
+        logging.error('No recordings found for "%s".', spec)
+    store = Path(args.dedup_store)
+
+    if args.release:
+        db = dedup_open(store)
+        freed = 0
+        for rr in recordings:
+            rr_file = rr_files(rr)[0][0]
+            manifest_path = rr_file.with_name(rr_file.name + RR_DEDUP_SUFFIX)
+            if not manifest_path.is_file():
+                continue
+            manifest = json.loads(manifest_path.read_text())
+            if Path(manifest['store']) != store.resolve():
+                logging.warning('Snapshot "%s" is in a different store.', rr_file)
+                continue
+            manifest_path.unlink()
+            freed += dedup_release(db, store, manifest['chunks'])
+            logging.info('Released snapshot "%s".', rr_file)
+        logging.info('Freed %.1fMiB.', freed / (1 << 20))
+        return 1 if unresolved else 0
+
+    # select recordings with snapshots that are not being written
+    now = time.time()
+    pending = []
+    for rr in recordings:
+        mtimes = [f.stat().st_mtime for f in rr_files(rr)[0] if f.is_file()]
+        if not mtimes:
+            continue
+        elif now - max(mtimes) < args.min_age:
+            logging.info('Skipping recently modified recording %s.', rr)
+        else:
+            pending.append(rr)
+    logging.info('Importing %d snapshots using %d workers.', len(pending), args.jobs)
+
+    def import_one(rr):
+        db = dedup_open(store)
+        try:
+            return dedup_import(db, store, rr)
+        finally:
+            db.close()
+
+    failed = 0
+    with concurrent.futures.ThreadPoolExecutor(max_workers=args.jobs) as executor:
+        futures = {executor.submit(import_one, rr): rr for rr in pending}
+        for f in concurrent.futures.as_completed(futures):
+            try:
+                size = f.result()
+            except (OSError, RuntimeError, sqlite3.Error) as e:
+                logging.error('Failed to import the snapshot of %s: %s', futures[f], e)
+                failed += 1
+                continue
+            if size is not None:
+                logging.info('Imported the snapshot of %s (%.1fMiB).', futures[f], size / (1 << 20))
+
+    # report the savings of the whole store
+    db = dedup_open(store)
+    size, stored, nchunks = db.execute('SELECT SUM(size * refs), SUM(stored), COUNT(*) FROM chunks').fetchone()
+    if nchunks:
+        logging.info('Store holds %.1fMiB of snapshots in %d chunks, using %.1fMiB.',
+                size / (1 << 20), nchunks, stored / (1 << 20))
+    return 1 if failed or unresolved else 0
+
+def prov2r_run_gc(args):
+    """ Garbage collects derived disks, usb disks and bootstrap directories.
+        Recordings are not collected. Artifacts that are still open, that
+        belong to active runs, or, with --keep-referenced, that belong to runs
+        with recordings are kept. Open files can only be detected reliably as
+        root, so deleting requires --force otherwise.
+    """
+    if not Path(args.disk).is_file():
+        logging.error('Base image "%s" does not exist.', args.disk)
+        return 1
+    if os.geteuid() != 0 and not args.dry_run and not args.force:
+        logging.error('Files open in processes of other users cannot be detected without root. '
+                      'Use --force to delete anyway.')
+        return 1
+    max_age = args.max_age * 3600 if args.max_age is not None else None
+    max_size = args.max_size << 20 if args.max_size is not None else None
+    open_files = fs_open_files()
+
+    def protected(path, run_id):
+        if run_is_active(args.rr_root, run_id):
+            return 'active run'
+        if args.keep_referenced and rr_find_recordings([Path(args.rr_root) / run_id])[0]:
+            return 'referenced by a trace'
+        files = path.rglob('*') if path.is_dir() else [path]
+        for f in files:
+            with contextlib.suppress(OSError):
+                st = f.stat()
+                if (st.st_dev, st.st_ino) in open_files:
+                    return 'open'
+        return None
+
+    freed = 0
+    for kind, items in gc_candidates(args).items():
+        unprotected = []
+        for item in items:
+            reason = protected(item[0], item[1])
+            if reason is not None:
+                logging.debug('Keeping %s "%s": %s.', kind, item[0], reason)
+            else:
+                unprotected.append(item)
+        expired = gc_select(unprotected, max_age, args.keep_count, max_size)
+        logging.info('Collecting %d of %d %s items.', len(expired), len(items), kind)
+        for path, _, _, size in expired:
+            logging.info('%s "%s".', 'Would delete' if args.dry_run else 'Deleting', path)
+            if args.dry_run:
+                continue
+            with contextlib.suppress(FileNotFoundError):
+                if path.is_dir():
+                    shutil.rmtree(path)
+                else:
+                    path.unlink()
+            freed += size
+    logging.info('Freed %.1fMiB.', freed / (1 << 20))
+
+def prov2r_run_snapshot(args):
+    """ Boots the base image once and saves a snapshot for resuming runs.
+        The guest should be waiting for the bootstrap volume by the time the
+        snapshot is saved (see usbbootstrap.sh -w).
+    """
+    cmd = prov2r_make_command(args)
+    base_disk = args.base_disk
+    tmp = qemu_resume_name(base_disk, 'tmp')
+    image = qemu_resume_name(base_disk)
+    proc = subprocess.Popen(cmd, stdin=subprocess.DEVNULL)
+
+    async def snapshot():
+        qmp = QMPClient()
+        await qmp.connect(args.qmp, timeout=args.qmp_timeout)
+        try:
+            logging.info('Waiting %.0fs for the guest to boot.', args.boot_wait)
+            await asyncio.sleep(args.boot_wait)
+            out = await qmp.action('snapshot', name=RESUME_SNAPSHOT)
+            if out.strip():
+                raise QMPError(out.strip())
+            await qmp.action('quit')
+        finally:
+            await qmp.close()
+
+    try:
+        asyncio.run(snapshot())
+        rc = proc.wait()
+    except (OSError, QMPError) as e:
+        logging.error('Failed to snapshot "%s": %s', base_disk, e)
+        proc.terminate()
+        rc = proc.wait() or 1
+    if rc != 0:
+        logging.error('PANDA exited with code %d.', rc)
+        with contextlib.suppress(FileNotFoundError):
+            tmp.unlink()
+        return 1
+
+    # the metadata becomes visible last, and marks the image as usable
+    meta = {k: getattr(args, k) for k in RESUME_VM_OPTS}
+    meta.update(snapshot=RESUME_SNAPSHOT, base_mtime=base_disk.stat().st_mtime,
+                created=datetime.now().isoformat())
+    meta_file = qemu_resume_name(base_disk, 'meta')
+    meta_tmp = meta_file.with_name('.%s.tmp' % meta_file.name)
+    with contextlib.suppress(FileNotFoundError):
+        meta_file.unlink()
+    os.rename(tmp, image)
+    meta_tmp.write_text(json.dumps(meta, indent=2) + '\n')
+    os.rename(meta_tmp, meta_file)
+    logging.info('Created resume image "%s".', image)
+
+def prov2r_run_pool(args):
+    """ Keeps the warm pool of derived images for args.disk filled.
+    """
+    if not args.disk.is_file():
+        logging.error('Base image "%s" does not exist.', args.disk)
+        return 1
+    logging.info('Keeping %d derived images ready for "%s".', args.pool_size, args.disk)
+    while True:
+        qemu_pool_fill(args.disk, args.pool_size, qemu_qcow_opts(args), args.overlay_dir)
+        if args.once:
+            return 0
+        time.sleep(args.pool_interval)
+
+def prov2r_run_docker_pool(args):
+    """ Keeps the pool of running containers for args.docker_image filled.
+        Exited containers, and containers with mounts that differ from the
+        current ones, are removed.
+    """
+    if args.docker_image is None:
+        logging.error('The docker-pool mode requires --docker-image.')
+        return 1
+    mounts = docker_pool_mounts(args)
+    prefix = DOCKER_POOL_FORMATS['name'].format(docker_image=args.docker_image, token='')
+    logging.info('Keeping %d containers of "%s" ready.', args.pool_size, args.docker_image)
+    while True:
+        stale = [name for name, _ in docker_pool_list(args.docker_image, 'exited')]
+        ready = []
+        for name, pool_mounts in docker_pool_list(args.docker_image):
+            if not name.startswith(prefix):
+                continue
+            (ready if pool_mounts == mounts else stale).append(name)
+        if stale:
+            logging.info('Removing %d stale containers.', len(stale))
+            subprocess.run(['docker', 'rm', '-f', *stale], stdout=subprocess.DEVNULL)
+
+        missing = args.pool_size - len(ready)
+        if missing > 0:
+            logging.debug('Starting %d pooled containers.', missing)
+            with concurrent.futures.ThreadPoolExecutor(max_workers=missing) as executor:
+                started = executor.map(lambda _: docker_pool_start(args, mounts), range(missing))
+                if None in list(started) and args.once:
+                    return 1
+        if args.once:
+            return 0
+        time.sleep(args.pool_interval)
+
+def prov2r_run_bootstrap(args):
+    """ Creates the bootstrap directories for args.run_id, and refills the
+        ssh key pool in the background. Without a run-id, only the key pool
+        is refilled.
+    """
+    if not Path(args.bs_root).is_dir():
+        logging.error('Directory "%s" does not exist.', args.bs_root)
+        return 1
+    key_pool = Path(args.bs_root) / BOOTSTRAP_FORMATS['keypool'] if args.key_pool_size > 0 else None
+    if args.run_id is None:
+        if key_pool is not None:
+            keypool_fill(key_pool, args.key_pool_size)
+        return 0
+
+    try:
+        run_dir = bootstrap_make(args.bootstrap_makedir, args.bs_root, args.run_id, key_pool)
+    except (OSError, RuntimeError) as e:
+        logging.error('Failed to create bootstrap directories for %s: %s', args.run_id, e)
+        return 1
+    logging.info('Created "%s".', run_dir)
+
+    # replace the claimed key without delaying the launch
+    if key_pool is not None:
+        cmd = [sys.executable, str(Path(__file__).resolve()), *['-v'] * args.verbose,
+               'bootstrap', '--bs-root=%s' % args.bs_root, '--key-pool-size=%d' % args.key_pool_size]
+        subprocess.Popen(cmd, stdin=subprocess.DEVNULL, start_new_session=True)
+
+def prov2r_run_dispatch(args):
+    """ Adds a job for each recording under args.rr_root to the job queue,
+        and prints the number of jobs in each state. Jobs run the wrapper
+        in args.job_mode, with the same global arguments and in the same
+        working directory as the dispatcher.
+    """
+    if not Path(args.rr_root).is_dir():
+        logging.error('Directory "%s" does not exist.', args.rr_root)
+        return 1
+    global_argv = args.argv[:args.argv.index(args.mode)]
+    job_argv = args.job_args
+    # parse the job arguments now, so that invalid ones fail here rather than in every job
+    prov2r_parse_args([*global_argv, args.job_mode, *job_argv])
+    db = queue_open(args.queue or Path(args.rr_root) / 'queue.sqlite')
+
+    # skip recordings that are still being written
+    now = time.time()
+    recordings = []
+    for rr in rr_find_recordings([args.rr_root])[0]:
+        mtimes = [f.stat().st_mtime for pair in rr_files(rr) for f in pair if f.is_file()]
+        if now - max(mtimes) < args.min_age:
+            logging.info('Skipping recently modified recording %s.', rr)
+        else:
+            recordings.append(rr)
+    n = queue_enqueue(db, args.job_mode, recordings, (global_argv, job_argv), Path.cwd())
+    logging.info('Queued %d new %s jobs.', n, args.job_mode)
+    if args.retry_failed:
+        with db:
+            n = db.execute("UPDATE jobs SET state = 'pending', attempts = 0, not_before = 0 "
+                           "WHERE mode = ? AND state = 'failed'", (args.job_mode,)).rowcount
+        logging.info('Requeued %d failed %s jobs.', n, args.job_mode)
+    for row in db.execute('SELECT mode, state, COUNT(*) FROM jobs GROUP BY mode, state ORDER BY mode, state'):
+        print('%s\t%s\t%d' % tuple(row))
+
+def prov2r_run_worker(args):
+    """ Runs jobs from the job queue on args.jobs workers, until stopped by
+        a signal. The lease of each job is renewed every args.heartbeat
+        seconds while it runs, and the job is killed if the lease is lost.
+        With --once, workers exit when no jobs are left. Errors accessing
+        the queue are retried after args.poll_interval seconds. Returns a
+        non-zero exit code if any of the workers died.
+    """
+    queue = args.queue or Path(args.rr_root) / 'queue.sqlite'
+    if not Path(queue).is_file():
+        logging.error('Job queue "%s" does not exist.', queue)
+        return 1
+    if args.heartbeat >= args.lease:
+        logging.error('Heartbeat interval must be shorter than the lease.')
+        return 1
+    stopping = threading.Event()
+    for sig in (signal.SIGINT, signal.SIGTERM):
+        signal.signal(sig, lambda *_: stopping.set())
+
+    def run_job(db, job, worker):
+        # jobs run in their own process group, so that PANDA is stopped along with the wrapper
+        cmd = [sys.executable, str(Path(__file__).resolve()), *json.loads(job['argv'])]
+        logging.info('%s: Running job %d (%s %s), attempt %d.', worker, job['id'], job['mode'], job['rr'], job['attempts'])
+        stderr = collections.deque(maxlen=20)
+        # relative paths in the arguments are relative to the dispatcher's working directory
+        try:
+            proc = subprocess.Popen(cmd, cwd=job['cwd'], stdin=subprocess.DEVNULL, stdout=subprocess.DEVNULL,
+                    stderr=subprocess.PIPE, start_new_session=True)
+        except OSError as e:
+            logging.error('%s: Could not start job %d in "%s": %s', worker, job['id'], job['cwd'], e)
+            queue_finish(db, job, worker, None, str(e), args.max_attempts, args.retry_delay)
+            return
+        reader = threading.Thread(target=lambda: stderr.extend(proc.stderr), daemon=True)
+        reader.start()
+        while True:
+            try:
+                rc = proc.wait(timeout=args.heartbeat)
+                break
+            except subprocess.TimeoutExpired:
+                pass
+            if stopping.is_set():
+                logging.warning('%s: Stopping job %d.', worker, job['id'])
+                os.killpg(proc.pid, signal.SIGTERM)
+                proc.wait()
+                queue_release(db, job, worker)
+                return
+            try:
+                alive = queue_heartbeat(db, job['id'], worker, args.lease)
+            except sqlite3.Error as e:
+                # keep the job running - the next heartbeat may get through before the lease expires
+                logging.warning('%s: Could not renew the lease of job %d: %s', worker, job['id'], e)
+                continue
+            if not alive:
+                logging.error('%s: Lost the lease of job %d. Killing it.', worker, job['id'])
+                os.killpg(proc.pid, signal.SIGKILL)
+                proc.wait()
+                return
+        reader.join()
+        error = b''.join(stderr).decode(errors='replace') if rc != 0 else None
+        state = queue_finish(db, job, worker, rc, error, args.max_attempts, args.retry_delay)
+        if state is None:
+            logging.error('%s: Lost the lease of job %d before it finished.', worker, job['id'])
+        elif rc == 0:
+            logging.info('%s: Job %d finished.', worker, job['id'])
+        else:
+            logging.error('%s: Job %d failed with exit code %d. It is now %s.', worker, job['id'], rc, state)
+
+    def work(n):
+        worker = '%s:%d:%d' % (socket.gethostname(), os.getpid(), n)
+        db = None
+        try:
+            while not stopping.is_set():
+                # errors of the shared queue are usually transient, e.g. lock timeouts
+                try:
+                    if db is None:
+                        db = queue_open(queue)
+                    job = queue_lease(db, worker, args.lease, args.max_attempts)
+                    if job is not None:
+                        run_job(db, job, worker)
+                        continue
+                    if args.once and not db.execute("SELECT COUNT(*) FROM jobs WHERE state IN ('pending', 'leased')").fetchone()[0]:
+                        return
+                except (sqlite3.Error, OSError) as e:
+                    logging.error('%s: Job queue error: %s. Retrying in %gs.', worker, e, args.poll_interval)
+                stopping.wait(args.poll_interval)
+        except Exception:
+            logging.exception('%s: Worker died.', worker)
+            died.append(worker)
+        finally:
+            if db is not None:
+                db.close()
+
+    logging.info('Running %d workers on "%s".', args.jobs, queue)
+    died = []
+    workers = [threading.Thread(target=work, args=(n,)) for n in range(args.jobs)]
+    for w in workers:
+        w.start()
+    for w in workers:
+        while w.is_alive():
+            w.join(1.0)
+    if died:
+        logging.error('%d of %d workers died.', len(died), args.jobs)
+        return 1
+
+class QMPError(Exception):
+    """ Error returned by QEMU in response to a QMP command.
+    """
+    pass
+
+class QMPClient:
+    """ Minimal asyncio client for the QEMU Machine Protocol.
+        Commands can be issued concurrently. Asynchronous events sent by
+        QEMU are queued in self.events, followed by None when the
+        connection is closed.
+    """
+    def __init__(self):
+        self.reader = None
+        self.writer = None
+        self.greeting = None
+        self.events = asyncio.Queue()
+        self.pending = {}
+        self.ids = itertools.count()
+        self.read_task = None
+
+    async def connect(self, path, timeout=10.0, interval=0.2):
+        """ Connects to the QMP socket at path and negotiates capabilities.
+            The socket is polled until it becomes available or timeout expires.
+        """
+        t_start = time.monotonic()
+        while True:
+            try:
+                self.reader, self.writer = await asyncio.open_unix_connection(str(path))
+                break
+            except (FileNotFoundError, ConnectionRefusedError):
+                if time.monotonic() - t_start > timeout:
+                    raise
+                await asyncio.sleep(interval)
+        self.greeting = json.loads(await self.reader.readline())
+        self.read_task = asyncio.ensure_future(self.read_loop())
+        await self.execute('qmp_capabilities')
+
+    async def read_loop(self):
+        """ Dispatches incoming messages to pending commands and the event queue.
+        """
+        while True:
+            try:
+                line = await self.reader.readline()
+            except ConnectionError:
+                # PANDA resets the connection when it is killed
+                break
+            if not line:
+                break
+            msg = json.loads(line)
+            if 'event' in msg:
+                self.events.put_nowait(msg)
+            elif msg.get('id') in self.pending:
+                fut = self.pending.pop(msg['id'])
+                if 'error' in msg:
+                    fut.set_exception(QMPError(msg['error'].get('desc', msg['error'])))
+                else:
+                    fut.set_result(msg.get('return'))
+        for fut in self.pending.values():
+            fut.set_exception(ConnectionResetError('QMP connection closed.'))
+        self.pending.clear()
+        self.events.put_nowait(None)
+
+    async def execute(self, command, **arguments):
+        """ Issues a QMP command and waits for its result.
+        """
+        msg_id = next(self.ids)
+        msg = {'execute': command, 'id': msg_id}
+        if arguments:
+            msg['arguments'] = arguments
+        fut = asyncio.get_running_loop().create_future()
+        self.pending[msg_id] = fut
+        self.writer.write(json.dumps(msg).encode() + b'\n')
+        await self.writer.drain()
+        return await fut
+
+    async def hmp(self, command_line):
+        """ Issues a command through the human monitor and returns its output.
+        """
+        return await self.execute('human-monitor-command', **{'command-line': command_line})
+
+    async def action(self, action, **kwargs):
+        """ Performs one of the actions in QMP_ACTIONS.
+        """
+        spec = QMP_ACTIONS[action]
+        if 'hmp' in spec:
+            return await self.hmp(spec['hmp'].format(**kwargs))
+        return await self.execute(spec['execute'])
+
+    async def close(self):
+        """ Closes the connection.
+        """
+        if self.writer is not None:
+            self.writer.close()
+            with contextlib.suppress(ConnectionError):
+                await self.writer.wait_closed()
+        if self.read_task is not None:
+            await self.read_task
+
+async def qmp_attach_usbdisk(qmp, usbdisk):
+    """ Hotplugs usbdisk as a USB storage device, using the qmp client.
+        This is how the bootstrap volume reaches instances resumed from a
+        snapshot, as the device set cannot change across -loadvm.
+    """
+    out = await qmp.hmp('drive_add 0 if=none,id=bootstrap,format=raw,file=%s' % usbdisk)
+    if out.strip() != 'OK':
+        raise QMPError(out.strip())
+    await qmp.execute('device_add', driver='usb-storage', id='bootstrap-usb', drive='bootstrap')
+
+def fleet_get_port(slot):
+    """ Returns the host port to forward ssh to for the specified fleet slot.
+    """
+    return FLEET_PROCESS2PORT.get(slot, FLEET_UNMAPPED_OFFSET + slot)
+
+async def to_thread(func, *args, **kwargs):
+    """ Runs func in the default executor of the running event loop.
+        Equivalent to asyncio.to_thread, which needs Python 3.9.
+    """
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(None, functools.partial(func, *args, **kwargs))
+
+class FleetMetrics:
+    """ Health metrics of a honeypot fleet, in the Prometheus text format.
+        Instances are recording while their nondet logs grow, and booting
+        until their forwarded port serves data otherwise.
+    """
+    def __init__(self):
+        self.instances = {}
+        self.latency = {}
+        self.restarts = collections.Counter()
+        self.throttles = collections.Counter()
+
+    def observe(self, phase, value):
+        """ Adds a launch phase duration to its latency histogram.
+        """
+        if value is None:
+            return
+        hist = self.latency.setdefault(phase, {'buckets': [0] * len(METRICS_LATENCY_BUCKETS), 'sum': 0.0, 'count': 0})
+        for i, le in enumerate(METRICS_LATENCY_BUCKETS):
+            if value <= le:
+                hist['buckets'][i] += 1
+        hist['sum'] += value
+        hist['count'] += 1
+
+    def launched(self, slot, name, iargs, rr_dir, ready=False):
+        """ Starts tracking the instance launched on slot.
+        """
+        self.instances[slot] = {'name': name, 'run_id': iargs.run_id, 'rr_dir': rr_dir, 'ready': ready,
+                                'trace': rr_trace_sizes(rr_dir), 'sampled': time.monotonic(),
+                                'rate': 0.0, 'throttled': False}
+        for phase, value in iargs.phase_times.items():
+            self.observe(phase, value)
+
+    def ready(self, slot, ready_time):
+        """ Marks the instance on slot as booted.
+        """
+        if slot in self.instances and ready_time is not None:
+            self.instances[slot]['ready'] = True
+            self.observe('ready', ready_time)
+
+    def exited(self, slot, restart):
+        """ Stops tracking the instance on slot.
+        """
+        inst = self.instances.pop(slot)
+        if restart:
+            self.restarts[inst['name']] += 1
+
+    def update_trace(self, slot, trace):
+        """ Updates the trace sizes of the instance on slot and the growth
+            rate of its nondet logs since the previous update.
+        """
+        inst = self.instances.get(slot)
+        if inst is None:
+            return
+        t = time.monotonic()
+        inst['rate'] = max(trace['nondet'] - inst['trace']['nondet'], 0) / max(t - inst['sampled'], 1e-3)
+        inst['trace'], inst['sampled'] = trace, t
+
+    @staticmethod
+    def state(inst):
+        """ Returns the state of an instance.
+        """
+        if inst['rate'] > 0:
+            return 'recording'
+        return 'idle' if inst['ready'] else 'booting'
+
+    def render(self):
+        """ Returns the metrics in the Prometheus text exposition format.
+        """
+        lines = []
+        def metric(name, kind, help_text, samples):
+            lines.append('# HELP pandacap_fleet_%s %s' % (name, help_text))
+            lines.append('# TYPE pandacap_fleet_%s %s' % (name, kind))
+            for suffix, labels, value in samples:
+                label_str = ','.join('%s="%s"' % (k, str(v).replace('\\', '\\\\').replace('"', '\\"'))
+                                     for k, v in labels.items())
+                lines.append('pandacap_fleet_%s%s%s %s' % (name, suffix, label_str and '{%s}' % label_str, value))
+
+        insts = [(inst, {'instance': inst['name'], 'run_id': inst['run_id']}) for inst in self.instances.values()]
+        metric('instances', 'gauge', 'Number of live instances.', [('', {}, len(self.instances))])
+        metric('instance_state', 'gauge', 'State of each live instance.',
+               [('', {**labels, 'state': st}, int(self.state(inst) == st)) for inst, labels in insts for st in METRICS_STATES])
+        metric('instance_throttled', 'gauge', 'Whether the instance is paused for exceeding the trace growth limit.',
+               [('', labels, int(inst['throttled'])) for inst, labels in insts])
+        metric('trace_bytes', 'gauge', 'Size of the recordings of each live instance.',
+               [('', {**labels, 'kind': kind}, size) for inst, labels in insts for kind, size in inst['trace'].items()])
+        metric('nondet_growth_bytes_per_second', 'gauge', 'Growth rate of the nondet logs of each live instance.',
+               [('', labels, '%.1f' % inst['rate']) for inst, labels in insts])
+        metric('restarts_total', 'counter', 'Number of times each instance was restarted.',
+               [('', {'instance': name}, n) for name, n in sorted(self.restarts.items())])
+        metric('throttles_total', 'counter', 'Number of times each instance was paused for exceeding the trace growth limit.',
+               [('', {'instance': name}, n) for name, n in sorted(self.throttles.items())])
+        samples = []
+        for phase, hist in sorted(self.latency.items()):
+            for le, n in zip(METRICS_LATENCY_BUCKETS, hist['buckets']):
+                samples.append(('_bucket', {'phase': phase, 'le': le}, n))
+            samples.append(('_bucket', {'phase': phase, 'le': '+Inf'}, hist['count']))
+            samples.append(('_sum', {'phase': phase}, '%.6f' % hist['sum']))
+            samples.append(('_count', {'phase': phase}, hist['count']))
+        metric('launch_phase_seconds', 'histogram', 'Duration of the launch phases of instances.', samples)
+        return '\n'.join(lines) + '\n'
+
+class HoneypotFleet:
+    """ Supervisor for a fleet of honeypot instances, using asyncio.
+        This replaces launching honeypot.sh from supervisord: run-ids are
+        allocated from an in-memory sequence which is persisted in the same
+        counter file, and the next instance of each slot is prepared while
+        the current one is still running.
+    """
+    def __init__(self, args):
+        self.args = args
+        for d in ('rr_root', 'bs_root', 'bootstrap_makedir'):
+            setattr(args, d, Path(getattr(args, d)).resolve())
+        self.counter = Path(args.rr_root) / FLEET_FORMATS['counter'].format(group=args.group)
+        self.procs = {}
+        self.qmp = {}
+        self.metrics = FleetMetrics()
+        self.compressor = concurrent.futures.ThreadPoolExecutor(max_workers=args.jobs) if args.compress else None
+        self.stopping = None
+        self.key_pool = args.bs_root / BOOTSTRAP_FORMATS['keypool'] if args.key_pool_size > 0 else None
+        self.scripts_dir = Path(__file__).resolve().parent
+
+        # global arguments to be passed down to instances
+        argv = args.argv
+        self.global_argv = argv[:argv.index(args.mode)]
+
+        # lock the counter for as long as the fleet runs - this keeps
+        # honeypot.sh from using it concurrently
+        self.counter_lock = open('%s.lck' % self.counter, 'w')
+        fcntl.flock(self.counter_lock, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        try:
+            self.runsn = int(self.counter.read_text())
+        except FileNotFoundError:
+            self.runsn = -1
+
+    def next_run_id(self):
+        """ Allocates the next run-id and persists the run counter.
+        """
+        self.runsn += 1
+        tmp = self.counter.with_name('.%s.tmp' % self.counter.name)
+        tmp.write_text('%d\n' % self.runsn)
+        os.replace(tmp, self.counter)
+        return FLEET_FORMATS['run-id'].format(group=self.args.group, runsn=self.runsn)
+
+    async def make_bootstrap(self, run_id):
+        """ Creates the bootstrap directories for run_id.
+            Directories of different slots are created concurrently.
+        """
+        await to_thread(bootstrap_make, self.args.bootstrap_makedir,
+                self.args.bs_root, run_id, self.key_pool)
+
+    async def fill_key_pool(self):
+        """ Keeps the ssh key pool filled until the fleet is stopped.
+        """
+        while not self.stopping.is_set():
+            try:
+                await to_thread(keypool_fill, self.key_pool, self.args.key_pool_size)
+            except (OSError, RuntimeError) as e:
+                logging.warning('Failed to refill ssh key pool: %s', e)
+            await self.backoff(self.args.pool_interval)
+
+    def instance_argv(self, slot, run_id):
+        """ Creates the wrapper arguments for an instance.
+            These are equivalent to the ones used by honeypot.sh.
+        """
+        a = self.args
+        port = fleet_get_port(slot)
+        rr_dir = Path(a.rr_root) / run_id
+        bs_dir = Path(a.bs_root) / run_id
+        argv = [*self.global_argv, '--run-id=%s' % run_id, '--cpu-slot=%d' % slot,
+                '--timing-file=%s' % (rr_dir / 'timings.json'),
+                '--qmp=%s' % (rr_dir / 'qmp.sock')]
+        if a.docker_image is not None:
+            argv.extend([
+                '--docker-port-fwd=%d:%d:*:tcp' % (port, a.fwd_port),
+                '-M', 'rr:%s' % rr_dir,
+                '-M', 'qcow:%s' % Path(a.disk).parent,
+                '-M', 'bootstrap:%s' % (bs_dir / 'docker'),
+            ])
+        else:
+            argv.append('--port-fwd=ssh:%d' % port)
+        argv.extend(['rec', '--usbdisk-dir=%s' % (bs_dir / 'vm')])
+        if a.resume:
+            argv.append('--resume')
+        if a.panda is not None:
+            argv.append('--panda=%s' % a.panda)
+        if a.usbdisk_cache is not None:
+            argv.extend(['--usbdisk-cache=%s' % a.usbdisk_cache,
+                         '--usbdisk-cache-size=%d' % a.usbdisk_cache_size])
+        return argv
+
+    async def prepare(self, slot):
+        """ Prepares a new instance for slot, up to the point of launching it.
+            Returns the parsed wrapper arguments of the instance and the
+            command to run.
+        """
+        t_start = time.monotonic()
+        run_id = self.next_run_id()
+        name = FLEET_FORMATS['instance'].format(group=self.args.group, slot=slot)
+        rr_dir = Path(self.args.rr_root) / run_id
+        rr_dir.mkdir(parents=True, exist_ok=True)
+        await self.make_bootstrap(run_id)
+        t_bootstrap = time.monotonic() - t_start
+
+        # dump run-id and ssh port mapping, and the equivalent wrapper command
+        argv = self.instance_argv(slot, run_id)
+        (rr_dir / 'sshfwd.txt').write_text('%s:%s:%d\n' % (run_id, name, fleet_get_port(slot)))
+        (rr_dir / 'cmd.txt').write_text('%s\n' % ' '.join(shlex.quote(a) for a in [str(self.scripts_dir / 'pandacap.py'), *argv]))
+
+        # derived/usb disks are created while preparing the command
+        iargs, cmd = await to_thread(self.make_command, argv)
+        iargs.phase_times['bootstrap'] = t_bootstrap
+        iargs.phase_times['prepare'] = time.monotonic() - t_start
+        return iargs, cmd
+
+    @staticmethod
+    def make_command(argv):
+        """ Creates the PANDA command for an instance from its wrapper arguments.
+            Errors that would terminate the wrapper are raised as exceptions.
+        """
+        try:
+            iargs = prov2r_parse_args(argv)
+            with timed(iargs, 'make-command'):
+                cmd = prov2r_make_command(iargs)
+            return iargs, cmd
+        except SystemExit as e:
+            raise RuntimeError('Wrapper exited with code %s.' % e.code) from None
+
+    async def run_slot(self, slot):
+        """ Keeps an instance running on slot, restarting it with backoff.
+        """
+        a = self.args
+        name = FLEET_FORMATS['instance'].format(group=a.group, slot=slot)
+        delay = a.restart_delay
+        pending = asyncio.ensure_future(self.prepare(slot))
+        while not self.stopping.is_set():
+            try:
+                iargs, cmd = await pending
+            except Exception as e:
+                logging.error('%s: Failed to prepare instance: %s', name, e)
+                await self.backoff(delay)
+                delay = min(delay * 2, a.max_backoff)
+                pending = asyncio.ensure_future(self.prepare(slot))
+                continue
+
+            run_id = iargs.run_id
+            rr_dir = Path(a.rr_root) / run_id
+            if not await self.admit(name, iargs, rr_dir):
+                logging.warning('%s: Prepared instance %s was not launched.', name, run_id)
+                docker_pool_release(iargs)
+                return
+            logging.info('%s: Launching %s on port %d.', name, run_id, fleet_get_port(slot))
+            t_start = time.monotonic()
+            with open(rr_dir / 'stdout.txt', 'wb') as out_f, open(rr_dir / 'stderr.txt', 'wb') as err_f:
+                proc = await asyncio.create_subprocess_exec(*cmd,
+                        stdin=subprocess.DEVNULL, stdout=out_f, stderr=err_f)
+            iargs.phase_times['spawn'] = time.monotonic() - t_start
+            self.procs[slot] = proc
+
+            # probe the instance port and prepare the next instance while this one is running
+            stop = threading.Event()
+            target = probe_target(iargs) if iargs.probe_ready or a.metrics_port is not None else None
+            self.metrics.launched(slot, name, iargs, rr_dir, ready=target is None)
+            if target is not None:
+                prober = asyncio.ensure_future(to_thread(
+                        probe_port, *target, iargs.probe_timeout, stop))
+                prober.add_done_callback(lambda f, slot=slot: f.cancelled() or self.metrics.ready(slot, f.result()))
+            watcher = asyncio.ensure_future(self.watch(slot, iargs))
+            pending = asyncio.ensure_future(self.prepare(slot))
+            rc = await proc.wait()
+            del self.procs[slot]
+            watcher.cancel()
+            uptime = time.monotonic() - t_start
+            iargs.phase_times['run'] = uptime
+            if target is not None:
+                stop.set()
+                iargs.phase_times['ready'] = await prober
+            self.metrics.exited(slot, restart=not self.stopping.is_set())
+            timing_write(iargs, exit_code=rc)
+            docker_pool_release(iargs)
+            if a.delete_overlay:
+                gc_delete_overlay(iargs)
+            logging.info('%s: Instance %s exited with code %d after %.0fs.', name, run_id, rc, uptime)
+            if self.compressor is not None:
+                self.compressor.submit(self.compress, name, rr_dir)
+
+            # back off if the instance died early
+            if uptime < a.min_uptime:
+                delay = min(delay * 2, a.max_backoff)
+            else:
+                delay = a.restart_delay
+            await self.backoff(delay)
+
+        if not pending.done():
+            pending.cancel()
+        elif not pending.cancelled() and pending.exception() is None:
+            logging.warning('%s: Prepared instance %s was not launched.', name, pending.result()[0].run_id)
+            docker_pool_release(pending.result()[0])
+
+    async def admit(self, name, iargs, rr_dir):
+        """ Delays launching an instance until the host has enough headroom.
+            Returns False if the fleet was stopped while waiting.
+        """
+        t_start = time.monotonic()
+        reasons = admission_check(iargs, rr_dir)
+        while reasons:
+            logging.warning('%s: Launch of %s delayed: %s.', name, iargs.run_id, ', '.join(reasons))
+            await self.backoff(self.args.restart_delay)
+            if self.stopping.is_set():
+                return False
+            reasons = admission_check(iargs, rr_dir)
+        iargs.phase_times['admission'] = time.monotonic() - t_start
+        return True
+
+    def compress(self, name, rr_dir):
+        """ Compresses the recordings in rr_dir. Runs on the compressor pool.
+        """
+        for rr in rr_find_recordings([rr_dir])[0]:
+            try:
+                rr_compress(rr, self.args.compress_level, self.args.compress_threads)
+            except (OSError, RuntimeError) as e:
+                logging.error('%s: Failed to compress %s: %s', name, rr, e)
+
+    async def backoff(self, delay):
+        """ Sleeps for delay seconds, or until the fleet is stopped.
+        """
+        try:
+            await asyncio.wait_for(self.stopping.wait(), delay)
+        except asyncio.TimeoutError:
+            pass
+
+    async def watch(self, slot, iargs):
+        """ Connects to the QMP socket of the instance on slot and logs its events.
+            The bootstrap disk of resumed instances is attached first.
+        """
+        name = FLEET_FORMATS['instance'].format(group=self.args.group, slot=slot)
+        qmp = QMPClient()
+        try:
+            await qmp.connect(iargs.qmp, timeout=self.args.qmp_timeout)
+        except OSError as e:
+            logging.warning('%s: Could not connect to QMP socket: %s', name, e)
+            return
+        self.qmp[slot] = qmp
+        if getattr(iargs, 'loadvm', None) is not None and iargs.usbdisk is not None:
+            try:
+                await qmp_attach_usbdisk(qmp, iargs.usbdisk)
+            except (OSError, QMPError) as e:
+                logging.error('%s: Failed to attach USB disk: %s', name, e)
+                self.procs[slot].terminate()
+        try:
+            event = await qmp.events.get()
+            while event is not None:
+                logging.info('%s: Received QMP event %s.', name, event['event'])
+                event = await qmp.events.get()
+        finally:
+            self.qmp.pop(slot, None)
+            await qmp.close()
+
+    async def sample_metrics(self):
+        """ Samples the trace sizes of the instances until the fleet is stopped.
+            Instances with nondet logs growing faster than the limit are paused
+            through QMP for a while.
+        """
+        a = self.args
+        while not self.stopping.is_set():
+            for slot, inst in list(self.metrics.instances.items()):
+                self.metrics.update_trace(slot, await to_thread(rr_trace_sizes, inst['rr_dir']))
+                if (a.max_trace_rate is not None and inst['rate'] > a.max_trace_rate * (1 << 20)
+                        and not inst['throttled']):
+                    asyncio.ensure_future(self.throttle(slot, inst))
+            await self.backoff(a.metrics_interval)
+
+    async def throttle(self, slot, inst):
+        """ Pauses the instance on slot for the throttle period.
+        """
+        qmp = self.qmp.get(slot)
+        if qmp is None:
+            logging.warning('%s: Cannot throttle %s without QMP.', inst['name'], inst['run_id'])
+            return
+        logging.warning('%s: Nondet log of %s grows at %.1f MiB/s. Pausing it for %.0fs.',
+                inst['name'], inst['run_id'], inst['rate'] / (1 << 20), self.args.throttle_pause)
+        inst['throttled'] = True
+        self.metrics.throttles[inst['name']] += 1
+        try:
+            await qmp.action('stop')
+            await self.backoff(self.args.throttle_pause)
+            await qmp.action('cont')
+        except (OSError, QMPError) as e:
+            logging.warning('%s: Failed to throttle %s: %s', inst['name'], inst['run_id'], e)
+        finally:
+            inst['throttled'] = False
+
+    async def serve_metrics(self, reader, writer):
+        """ Serves the fleet metrics over HTTP.
+        """
+        try:
+            request = await asyncio.wait_for(reader.readuntil(b'\r\n\r\n'), self.args.qmp_timeout)
+            path = request.split()[1].split(b'?')[0]
+            if path == b'/metrics':
+                status, body = '200 OK', self.metrics.render().encode()
+            else:
+                status, body = '404 Not Found', b'Not found.\n'
+            writer.write(('HTTP/1.0 %s\r\nContent-Type: text/plain; version=0.0.4; charset=utf-8\r\n'
+                          'Content-Length: %d\r\nConnection: close\r\n\r\n' % (status, len(body))).encode() + body)
+            await writer.drain()
+        except (asyncio.IncompleteReadError, asyncio.LimitOverrunError, asyncio.TimeoutError,
+                ConnectionError, IndexError):
+            pass
+        finally:
+            writer.close()
+
+    async def quit_instance(self, slot, proc):
+        """ Ends the recording of the instance on slot and quits PANDA.
+            The instance is terminated if it cannot be stopped through QMP.
+        """
+        qmp = self.qmp.get(slot)
+        if qmp is not None:
+            try:
+                await qmp.action('end-record')
+                await qmp.action('quit')
+                await asyncio.wait_for(proc.wait(), self.args.qmp_timeout)
+                return
+            except (OSError, QMPError, asyncio.TimeoutError):
+                pass
+        if proc.returncode is None:
+            proc.terminate()
+
+    def stop(self):
+        """ Stops the fleet, gracefully quitting all running instances.
+        """
+        logging.info('Stopping fleet.')
+        self.stopping.set()
+        for slot, proc in self.procs.items():
+            asyncio.ensure_future(self.quit_instance(slot, proc))
+
+    async def run(self):
+        """ Runs the fleet until it is stopped by a signal.
+        """
+        # before Python 3.10, asyncio objects are bound to the loop they are created in
+        self.stopping = asyncio.Event()
+        loop = asyncio.get_running_loop()
+        for sig in (signal.SIGINT, signal.SIGTERM):
+            loop.add_signal_handler(sig, self.stop)
+        if self.args.metrics_port is not None:
+            server = await asyncio.start_server(self.serve_metrics, self.args.metrics_addr, self.args.metrics_port)
+            sampler = asyncio.ensure_future(self.sample_metrics())
+            logging.info('Serving metrics on http://%s:%d/metrics.', self.args.metrics_addr, self.args.metrics_port)
+        if self.key_pool is not None:
+            keys = asyncio.ensure_future(self.fill_key_pool())
+        logging.info('Starting fleet of %d instances.', self.args.instances)
+        await asyncio.gather(*(self.run_slot(slot) for slot in range(self.args.instances)))
+        if self.key_pool is not None:
+            await keys
+        if self.args.metrics_port is not None:
+            server.close()
+            await server.wait_closed()
+            await sampler
+        if self.compressor is not None:
+            logging.info('Waiting for pending compressions.')
+            await to_thread(self.compressor.shutdown)
+
+def prov2r_run_fleet(args):
+    """ Runs a fleet of honeypot instances.
+    """
+    for d in (args.rr_root, args.bs_root):
+        if not Path(d).is_dir():
+            logging.error('Directory "%s" does not exist.', d)
+            return 1
+    try:
+        fleet = HoneypotFleet(args)
+    except BlockingIOError:
+        logging.error('Run counter for "%s" is in use by another process.', args.group)
+        return 1
+    asyncio.run(fleet.run())
+
+def prov2r_run_ctl(args):
+    """ Controls a running PANDA instance through its QMP socket.
+        Results and events are printed as JSON lines.
+    """
+    if args.qmp is None:
+        logging.error('No QMP socket specified.')
+        return 1
+    if args.action in ('begin-record', 'snapshot') and args.name is None:
+        logging.error('Action %s requires a name.', args.action)
+        return 1
+
+    async def ctl():
+        qmp = QMPClient()
+        await qmp.connect(args.qmp, timeout=args.qmp_timeout)
+        try:
+            if args.action == 'events':
+                event = await qmp.events.get()
+                while event is not None:
+                    print(json.dumps(event), flush=True)
+                    event = await qmp.events.get()
+            else:
+                print(json.dumps(await qmp.action(args.action, name=args.name)))
+        finally:
+            await qmp.close()
+
+    try:
+        asyncio.run(ctl())
+    except (OSError, QMPError) as e:
+        logging.error('QMP %s failed: %s', args.action, e)
+        return 1
+
+def prov2r_parse_args(argv=[]):
+    """ Parses a list of command line arguments.
+    """
+    # helper lambdas
+    _k2s = lambda d: ', '.join(d.keys())
+
+    # argument parser, subparsers and groups
+    parser = argparse.ArgumentParser(
+        description='PANDA wrapper for PROV2R.',
+        epilog='See operation mode help for additional arguments.',
+        formatter_class=argparse.ArgumentDefaultsHelpFormatter
+    )
+    # add common options
+    parser.add_argument('-v', '--verbose', action='count',
+        default=0,
+        help='increase verbosity')
+    parser.add_argument('--run-id', action='store',
+        default=None,
+        help='unique(ish) identifier for this run')
+    parser.add_argument('--timing-file', action='store', type=Path,
+        default=None,
+        help='write the duration of each launch phase to this JSON file')
+    parser.add_argument('--probe-ready', action='store_true',
+        help='probe the first forwarded port to time how long it takes to become ready')
+    parser.add_argument('--probe-timeout', action='store', type=float,
+        default=300.0,
+        help='seconds to wait for the forwarded port to become ready')
+    parser.add_argument('--qmp', action='store', type=Path,
+        default=None, metavar='SOCKET',
+        help='control PANDA through a QMP unix socket instead of a monitor on stdio')
+    parser.add_argument('-o', '--output-dir', action='store',
+        default='.',
+        help='all created files should be stored here')
+    # qemu options
+    qemu_args = parser.add_argument_group('QEMU options')
+    qemu_args.add_argument('-m', '--mem', action='store', type=int,
+        default=512,
+        help='VM memory')
+    qemu_args.add_argument('-t', '--target', action='store',
         default='i386', choices=PANDA_TARGETS,
         help='VM target architecture')
     qemu_args.add_argument('-d', '--disk', action='store', type=Path,
@@ -412,6 +4200,51 @@ def prov2r_parse_args(argv=[]):
     qemu_args.add_argument('-D', '--display', action='store',
         default=':78',
         help='VM display output')
+    qemu_args.add_argument('--cpus', action='store', type=int,
+        default=None,
+        help='pin the VM to a dedicated set of this many cpus, selected by --cpu-slot')
+    qemu_args.add_argument('--cpu-slot', action='store', type=int,
+        default=0,
+        help='index of the dedicated cpu set to use')
+    qemu_args.add_argument('--cpuset', action='store',
+        default=None, metavar='CPULIST',
+        help='pin the VM to the specified cpus, overriding --cpus')
+    qemu_args.add_argument('--cpuset-mems', action='store',
+        default='0', metavar='NODES',
+        help='NUMA memory nodes to use with --cpuset')
+    # overlay options
+    ovl_args = parser.add_argument_group('Overlay options')
+    ovl_args.add_argument('--overlay-dir', action='store', type=Path,
+        default=None,
+        help='create derived disks in this directory (e.g. a tmpfs) instead of next to the base image')
+    ovl_args.add_argument('--overlay-cache', action='store',
+        default=None, choices=['writeback', 'unsafe', 'none', 'directsync', 'writethrough'],
+        help='cache mode for the VM disk – none is not supported on tmpfs')
+    ovl_args.add_argument('--qcow-compat', action='store',
+        default='0.10', choices=['0.10', '1.1'],
+        help='qcow2 version of derived disks')
+    ovl_args.add_argument('--qcow-cluster-size', action='store',
+        default=None, metavar='SIZE',
+        help='cluster size of derived disks (e.g. 64K, 2M)')
+    ovl_args.add_argument('--qcow-lazy-refcounts', action='store_true',
+        help='enable lazy refcounts for derived disks – requires qcow2 version 1.1')
+    ovl_args.add_argument('--qcow-l2-cache', action='store',
+        default=None, metavar='SIZE',
+        help='L2 table cache size for the VM disk (e.g. 4M)')
+    # admission control options
+    adm_args = parser.add_argument_group('Admission control options')
+    adm_args.add_argument('--min-free-mem', action='store', type=int,
+        default=None, metavar='MiB',
+        help='delay launching while available memory is less than this plus the VM memory')
+    adm_args.add_argument('--min-free-disk', action='store', type=int,
+        default=None, metavar='MiB',
+        help='delay launching while free disk space for the recordings is less than this')
+    adm_args.add_argument('--max-load', action='store', type=float,
+        default=None,
+        help='delay launching while the 1-minute load average per cpu is above this')
+    adm_args.add_argument('--admission-wait', action='store', type=float,
+        default=300.0,
+        help='seconds to delay a launch before refusing it')
     # docker options
     docker_args = parser.add_argument_group('Docker options')
     docker_args.add_argument('--docker-image', action='store',
@@ -419,6 +4252,8 @@ def prov2r_parse_args(argv=[]):
         help='run PANDA in an instance of the specified docker image')
     docker_args.add_argument('--docker-no-init', action='store_true',
         help="skip the baseimage-docker initialization")
+    docker_args.add_argument('--docker-pool', action='store_true',
+        help='run PANDA in a container from the pool of the docker-pool mode when one is available')
     docker_args.add_argument('--docker-user', action='store',
         default='panda',
         help='run PANDA as the specified user inside the docker container')
@@ -443,28 +4278,182 @@ def prov2r_parse_args(argv=[]):
     MODES = {
         'rec': {
             'help': 'record mode',
-            'args': ['no-derive', 'os', 'panda', 'plog', 'usbdisk-dir'],
+            'args': ['compress', 'compress-level', 'compress-threads', 'delete-overlay', 'no-derive', 'os', 'panda', 'plog',
+                     'qmp-timeout', 'resume', 'usbdisk-cache', 'usbdisk-cache-size', 'usbdisk-dir'],
             'process_mode_args': process_rec_args,
+            'run_mode': prov2r_run,
         },
         'repl': {
             'help': 'replay mode',
-            'args': ['os', 'panda', 'plog', 'rr'],
+            'args': ['catalog', 'dedup-store', 'jobs', 'keep-segments', 'os', 'panda', 'plog', 'replay-cache',
+                     'replay-cache-size', 'rr', 'segments'],
             'process_mode_args': process_repl_args,
+            'run_mode': prov2r_run_repl,
+        },
+        'repl-cache': {
+            'help': 'replay cache mode',
+            'args': ['invalidate', 'panda', 'replay-cache', 'replay-cache-size'],
+            'process_mode_args': None,
+            'run_mode': prov2r_run_repl_cache,
         },
         'maint': {
             'help': 'maintenance mode',
             'args': ['no-kvm'],
             'process_mode_args': process_maint_args,
+            'run_mode': prov2r_run,
+        },
+        'bootstrap': {
+            'help': 'bootstrap directory mode',
+            'args': ['bootstrap-makedir', 'bs-root', 'key-pool-size'],
+            'process_mode_args': None,
+            'run_mode': prov2r_run_bootstrap,
+        },
+        'catalog': {
+            'help': 'run catalog mode',
+            'args': ['catalog', 'rr-root', 'select'],
+            'process_mode_args': None,
+            'run_mode': prov2r_run_catalog,
+        },
+        'compress': {
+            'help': 'recording compression mode',
+            'args': ['compress-level', 'compress-threads', 'jobs', 'min-age', 'rr', 'wait'],
+            'process_mode_args': None,
+            'run_mode': prov2r_run_compress,
+        },
+        'ctl': {
+            'help': 'control mode',
+            'args': ['action', 'name', 'qmp-timeout'],
+            'process_mode_args': None,
+            'run_mode': prov2r_run_ctl,
+        },
+        'fleet': {
+            'help': 'honeypot fleet mode',
+            'args': ['bootstrap-makedir', 'bs-root', 'compress', 'compress-level', 'compress-threads',
+                     'delete-overlay', 'fwd-port', 'group', 'instances', 'jobs', 'key-pool-size', 'max-backoff',
+                     'max-trace-rate', 'metrics-addr', 'metrics-interval', 'metrics-port', 'min-uptime', 'panda',
+                     'pool-interval', 'qmp-timeout', 'restart-delay', 'resume', 'rr-root', 'throttle-pause', 'usbdisk-cache', 'usbdisk-cache-size'],
+            'process_mode_args': None,
+            'run_mode': prov2r_run_fleet,
+        },
+        'dedup': {
+            'help': 'snapshot dedup store mode',
+            'args': ['dedup-store', 'jobs', 'min-age', 'release', 'rr'],
+            'process_mode_args': None,
+            'run_mode': prov2r_run_dedup,
+        },
+        'gc': {
+            'help': 'garbage collection mode',
+            'args': ['bs-root', 'dry-run', 'force', 'keep-count', 'keep-referenced', 'max-age', 'max-size', 'rr-root'],
+            'process_mode_args': None,
+            'run_mode': prov2r_run_gc,
+        },
+        'plog': {
+            'help': 'pandalog reader mode',
+            'args': ['batch-size', 'end-instr', 'export', 'plog-file', 'start-instr'],
+            'process_mode_args': None,
+            'run_mode': prov2r_run_plog,
+        },
+        'snapshot': {
+            'help': 'resume snapshot mode',
+            'args': ['boot-wait', 'qmp-timeout'],
+            'process_mode_args': process_snapshot_args,
+            'run_mode': prov2r_run_snapshot,
+        },
+        'pool': {
+            'help': 'derived image pool mode',
+            'args': ['once', 'pool-interval', 'pool-size'],
+            'process_mode_args': None,
+            'run_mode': prov2r_run_pool,
+        },
+        'dispatch': {
+            'help': 'job dispatcher mode',
+            'args': ['job-args', 'job-mode', 'min-age', 'queue', 'retry-failed', 'rr-root'],
+            'process_mode_args': None,
+            'run_mode': prov2r_run_dispatch,
+        },
+        'worker': {
+            'help': 'job worker mode',
+            'args': ['heartbeat', 'jobs', 'lease', 'max-attempts', 'once', 'poll-interval', 'queue', 'retry-delay',
+                     'rr-root'],
+            'process_mode_args': None,
+            'run_mode': prov2r_run_worker,
+        },
+        'docker-pool': {
+            'help': 'docker container pool mode',
+            'args': ['bs-root', 'once', 'pool-interval', 'pool-size', 'rr-root'],
+            'process_mode_args': None,
+            'run_mode': prov2r_run_docker_pool,
         },
     }
     MODES_ARGS = {
+        'action': {'action': 'store', 'choices': [*QMP_ACTIONS, 'events'], 'help': 'action to perform – events streams QMP events', 'default': 'status'},
+        'batch-size': {'action': 'store', 'type': int, 'help': 'number of entries to export at a time', 'default': 1 << 16},
+        'boot-wait': {'action': 'store', 'type': float, 'help': 'seconds to let the guest boot before saving the snapshot', 'default': 120.0},
+        'bootstrap-makedir': {'action': 'store', 'type': Path, 'help': 'directory of the bootstrap Makefile', 'default': Path(__file__).resolve().parent.parent / 'bootstrap' / 'ssh-honeypot'},
+        'bs-root': {'action': 'store', 'type': Path, 'help': 'root directory for bootstrap directories', 'default': '/mnt/data/pandahoney/bs'},
+        'catalog': {'action': 'store', 'type': Path, 'help': 'SQLite run catalog to use – the catalog mode defaults to catalog.sqlite in the rr root', 'default': None},
+        'compress': {'action': 'store_true', 'help': 'compress recordings in the background after PANDA exits'},
+        'compress-level': {'action': 'store', 'type': int, 'help': 'zstd compression level', 'default': 3},
+        'compress-threads': {'action': 'store', 'type': int, 'help': 'zstd threads per file – 0 uses one per core', 'default': 0},
+        'dedup-store': {'action': 'store', 'type': Path, 'help': 'dedup store for snapshots – repl defaults to the store each snapshot was imported to', 'default': None},
+        'delete-overlay': {'action': 'store_true', 'help': 'delete the derived disk and usb disk images when PANDA exits'},
+        'dry-run': {'action': 'store_true', 'help': 'only report what would be done'},
+        'end-instr': {'action': 'store', 'type': int, 'help': 'stop at this instruction count', 'default': None},
+        'export': {'action': 'store', 'type': Path, 'help': 'export the entries to this directory as NumPy arrays per field', 'default': None},
+        'force': {'action': 'store_true', 'help': 'delete even if files open in processes of other users cannot be seen'},
+        'fwd-port': {'action': 'store', 'type': int, 'help': 'port to forward to from the host port of each instance', 'default': 10000},
+        'group': {'action': 'store', 'help': 'name of the instance group', 'default': 'pandahoney'},
+        'heartbeat': {'action': 'store', 'type': float, 'help': 'seconds between renewals of the lease of a running job', 'default': 10.0},
+        'instances': {'action': 'store', 'type': int, 'help': 'number of instances to run', 'default': 3},
+        'invalidate': {'action': 'store', 'nargs': '*', 'type': Path, 'help': 'remove the cached replays of recordings in these paths – all cached replays if none are given', 'default': None},
+        'job-args': {'nargs': argparse.REMAINDER, 'help': 'mode arguments for the queued jobs – takes all remaining arguments, e.g. --job-args --panda=osi --jobs=1', 'default': []},
+        'job-mode': {'action': 'store', 'choices': QUEUE_JOB_MODES, 'help': 'mode the queued jobs run in', 'default': 'repl'},
+        'jobs': {'action': 'store', 'type': int, 'help': 'number of recordings to process in parallel', 'default': os.cpu_count()},
+        'keep-count': {'action': 'store', 'type': int, 'help': 'keep at most this many items of each kind', 'default': None},
+        'keep-referenced': {'action': 'store_true', 'help': 'keep items of runs that have recordings'},
+        'keep-segments': {'action': 'store_true', 'help': 'keep the segments of split recordings and their pandalogs'},
+        'key-pool-size': {'action': 'store', 'type': int, 'help': 'number of pre-generated ssh keys to keep ready – 0 disables the key pool', 'default': 8},
+        'lease': {'action': 'store', 'type': float, 'help': 'seconds a worker holds a job without renewing its lease', 'default': 60.0},
+        'max-age': {'action': 'store', 'type': float, 'help': 'delete items older than this many hours', 'default': None},
+        'max-attempts': {'action': 'store', 'type': int, 'help': 'number of times a job is tried before it is marked as failed', 'default': 3},
+        'max-backoff': {'action': 'store', 'type': float, 'help': 'maximum seconds to wait before restarting a failing instance', 'default': 300.0},
+        'min-uptime': {'action': 'store', 'type': float, 'help': 'instances exiting faster than this many seconds are considered failing', 'default': 30.0},
+        'max-size': {'action': 'store', 'type': int, 'help': 'keep the total size of each kind of items under this many MiB', 'default': None},
+        'max-trace-rate': {'action': 'store', 'type': float, 'help': 'pause instances with nondet logs growing faster than this many MiB/s', 'default': None},
+        'metrics-addr': {'action': 'store', 'help': 'address to serve the metrics on', 'default': '127.0.0.1'},
+        'metrics-interval': {'action': 'store', 'type': float, 'help': 'seconds between samples of the trace sizes', 'default': 10.0},
+        'metrics-port': {'action': 'store', 'type': int, 'help': 'serve Prometheus metrics over HTTP on this port', 'default': None},
+        'min-age': {'action': 'store', 'type': float, 'help': 'skip recordings modified in the last this many seconds', 'default': 600.0},
+        'name': {'action': 'store', 'help': 'name of the recording or snapshot', 'default': None},
         'no-derive': {'action': 'store_true', 'help': 'disable creation of derived disk image'},
         'no-kvm': {'action': 'store_true', 'help': 'disable KVM acceleration'},
+        'once': {'action': 'store_true', 'help': 'exit after a single pass'},
         'os': {'action': 'store', 'help': 'PANDA operating system specifier', 'default': 'linux-32-ubuntu:4.4.0-130-generic'},
         'panda': {'action': 'store', 'help': 'PANDA plugin specifier', 'default': None},
-        'plog': {'action': 'store', 'help': 'PANDA log file to use', 'default': 'my.plog'},
-        'rr': {'action': 'store', 'help': 'PANDA replay to use', 'default': 'ubuntu16-test'},
+        'plog': {'action': 'store', 'help': 'PANDA log file to use – {rr} expands to the recording path prefix', 'default': '{rr}.plog'},
+        'plog-file': {'action': 'store', 'type': Path, 'help': 'pandalog to read', 'required': True},
+        'poll-interval': {'action': 'store', 'type': float, 'help': 'seconds between polls of the job queue when it is empty', 'default': 5.0},
+        'pool-interval': {'action': 'store', 'type': float, 'help': 'seconds between pool refills', 'default': 2.0},
+        'pool-size': {'action': 'store', 'type': int, 'help': 'number of derived images or containers to keep ready', 'default': 4},
+        'qmp-timeout': {'action': 'store', 'type': float, 'help': 'seconds to wait for QMP sockets and commands', 'default': 60.0},
+        'queue': {'action': 'store', 'type': Path, 'help': 'SQLite job queue to use – defaults to queue.sqlite in the rr root', 'default': None},
+        'release': {'action': 'store_true', 'help': 'delete the deduplicated snapshots of the recordings and release their chunks'},
+        'replay-cache': {'action': 'store', 'type': Path, 'help': 'cache for replay outputs, keyed on the recording contents, plugins, os and PANDA build', 'default': None},
+        'replay-cache-size': {'action': 'store', 'type': int, 'help': 'size limit of the replay cache in MiB', 'default': 10240},
+        'restart-delay': {'action': 'store', 'type': float, 'help': 'seconds to wait before restarting an instance', 'default': 5.0},
+        'resume': {'action': 'store_true', 'help': 'resume the VM from the snapshot in the resume image of the disk instead of booting it'},
+        'retry-delay': {'action': 'store', 'type': float, 'help': 'seconds to wait before retrying a failed job – doubled after each attempt', 'default': 30.0},
+        'retry-failed': {'action': 'store_true', 'help': 'requeue the jobs that ran out of attempts'},
+        'rr-root': {'action': 'store', 'type': Path, 'help': 'root directory for recordings', 'default': '/mnt/data/pandahoney/rr'},
+        'rr': {'action': 'store', 'nargs': '+', 'help': 'PANDA recordings to replay – directories are searched recursively', 'default': ['ubuntu16-test']},
+        'segments': {'action': 'store', 'type': int, 'help': 'split each recording into this many segments with scissors and replay them in parallel', 'default': 1},
+        'select': {'action': 'store', 'help': 'print the paths of runs matching this SQL condition – trusted input, it is not escaped', 'default': None},
+        'start-instr': {'action': 'store', 'type': int, 'help': 'start from this instruction count', 'default': None},
+        'throttle-pause': {'action': 'store', 'type': float, 'help': 'seconds to pause instances exceeding the trace growth limit', 'default': 60.0},
+        'usbdisk-cache': {'action': 'store', 'type': Path, 'help': 'cache USB disk images in this directory', 'default': None},
+        'usbdisk-cache-size': {'action': 'store', 'type': int, 'help': 'size limit of the USB disk image cache in MiB', 'default': 1024},
         'usbdisk-dir': {'action': 'store', 'type': Path, 'help': 'create a image from this directory and attach it to the VM as a USB disk', 'default': None},
+        'wait': {'action': 'store_true', 'help': 'wait for recently modified recordings instead of skipping them'},
     }
     subparsers = parser.add_subparsers(dest='mode', help='operation mode')
     subparsers.required = True # required argument added in Python 3.7
@@ -479,29 +4468,40 @@ def prov2r_parse_args(argv=[]):
     args = parser.parse_args(argv)
     logging.getLogger().setLevel(LOGLEVELS[min(args.verbose, len(LOGLEVELS)-1)])
     args.addattr('process_mode_args', MODES[args.mode]['process_mode_args'])
+    args.addattr('run_mode', MODES[args.mode]['run_mode'])
+    args.addattr('argv', list(argv))
+    args.addattr('start_time', datetime.now().isoformat())
+    args.addattr('phase_times', {})
 
     # return
     logging.debug("Parsed arguments: %s", args)
     return args
 
-def prov2r_make_command(args):
-    """ Creates a PANDA command using the specified args namespace.
+def panda_find_binary(args):
+    """ Returns the PANDA binary to use, or None if it cannot be found.
     """
-    # find PANDA binary
     panda_name = arg_format('panda-bin', args, split=False)
     if args.docker_image is not None:
         # running in docker - assume that the binary is in the path
-        panda_bin = panda_name
-    else:
-        # running on host - search for panda
-        panda_bin = shutil.which(panda_name)
-        if panda_bin is None:
-            dirs1 = filter(Path.is_dir, Path('.').glob('*-softmmu'))
-            dirs2 = filter(Path.is_dir, Path('.').glob('*/*-softmmu'))
-            path_extra = [str(p) for p in itertools.chain(dirs1, dirs2)]
-            panda_bin = shutil.which(panda_name, path=':'.join(path_extra))
+        return panda_name
+    # running on host - search for panda
+    panda_bin = shutil.which(panda_name)
+    if panda_bin is None:
+        dirs1 = filter(Path.is_dir, Path('.').glob('*-softmmu'))
+        dirs2 = filter(Path.is_dir, Path('.').glob('*/*-softmmu'))
+        path_extra = [str(p) for p in itertools.chain(dirs1, dirs2)]
+        panda_bin = shutil.which(panda_name, path=':'.join(path_extra))
+    return panda_bin
+
+def prov2r_make_command(args):
+    """ Creates a PANDA command using the specified args namespace.
+    """
+    # find PANDA binary
+    with timed(args, 'find-binary'):
+        panda_bin = panda_find_binary(args)
     if panda_bin is None:
-        logging.error('Could not find PANDA binary (%s) in shell path or locally.', panda_name)
+        logging.error('Could not find PANDA binary (%s) in shell path or locally.',
+                arg_format('panda-bin', args, split=False))
         sys.exit(1)
     else:
         logging.info('Using PANDA binary %s.', panda_bin)
@@ -516,21 +4516,38 @@ def prov2r_make_command(args):
             pass
     logging.debug('Using run-id %s.', args.run_id)
 
+    # resolve the cpu set of the run
+    if args.cpuset is None and args.cpus is not None:
+        try:
+            args.cpuset, args.cpuset_mems = cpuset_for_slot(args.cpu_slot, args.cpus)
+        except ValueError as e:
+            logging.error('Could not allocate cpu set: %s', e)
+            sys.exit(1)
+    if args.cpuset is not None:
+        logging.info('Pinning run to cpus %s (NUMA node %s).', args.cpuset, args.cpuset_mems)
+
     # create command components
     # the order is important — functions may modify args
-    cmd_mode = args.process_mode_args(args)
-    cmd_docker = process_docker_args(args)
-    cmd_common = process_common_args(args)
+    with timed(args, 'mode-args'):
+        cmd_mode = args.process_mode_args(args)
+    with timed(args, 'docker-args'):
+        cmd_docker = process_docker_args(args)
+    with timed(args, 'common-args'):
+        cmd_common = process_common_args(args)
+
+    # pin host runs to their cpu set - docker runs are pinned by docker
+    cmd_taskset = []
+    if args.cpuset is not None and args.docker_image is None:
+        cmd_taskset = arg_format('taskset', cpus=args.cpuset)
 
     # concatenate command parts and return
-    cmd = [*cmd_docker, panda_bin, *cmd_common, *cmd_mode]
+    cmd = [*cmd_docker, *cmd_taskset, panda_bin, *cmd_common, *cmd_mode]
     logging.info('Prepared command: %s', cmd)
     return cmd
 
 if __name__ == '__main__':
     args = prov2r_parse_args(sys.argv[1:])
-    cmd = prov2r_make_command(args)
-    subprocess.call(cmd)
+    sys.exit(args.run_mode(args))
 
 # ??? do we need this ???
 # export LD_LIBRARY_PATH=$(p_abs "${panda_path}/panda_plugins")
@@ -9,8 +9,17 @@
 # Additionally, the script will disable any USB storage devices plugged
 # at the time it runs. This is because the "bootstrap" volume presumably
 # resides on a USB storage device.
+# With -w, the script waits until the "bootstrap" volume is plugged.
+# This is used for VM images that are resumed from a snapshot, where
+# the volume is only attached after resuming.
 #
 
+if [ "$1" = "-w" ]; then
+    while [ ! -e /dev/disk/by-label/bootstrap ]; do
+        sleep 1
+    done
+fi
+
 mkdir /mnt/bootstrap
 if mount -L bootstrap /mnt/bootstrap 2>/dev/null; then
     if [ -x "/mnt/bootstrap/bootstrap.sh" ]; then